@@ -0,0 +1,117 @@
+# coding: utf-8
+"""
+Accuracy/throughput trade-off of the tagger decoding strategies: greedy,
+beam search (several beam sizes) and Viterbi.
+
+Accuracy is measured on a held-out file in MElt format given with
+``--gold`` (one sentence per line, ``word/TAG`` tokens separated by
+spaces), tagged with the model of ``--data-dir`` (the downloaded one by
+default). Without ``--gold``, only the throughput is reported, with the
+stand-in model from ``tests/toy_model.py`` unless ``--data-dir`` is given:
+it is too small for the strategies to tag held-out sentences differently,
+so an accuracy measured with it would say nothing about decoding quality.
+Throughput is measured on the synthetic corpus of ``bench_suite.py``.
+
+    python benchmarks/bench_decoding.py
+    python benchmarks/bench_decoding.py --gold ftb-test.melt --data-dir spacy_lefff/data
+"""
+
+import os
+import io
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spacy_lefff.melt_tagger import POSTagger, Token, WD_TAG_RE
+from tests.toy_model import build_toy_model
+from benchmarks.bench_suite import make_corpus
+
+CONFIGS = [
+    ("greedy", 1),
+    ("beam", 1),
+    ("beam", 3),
+    ("beam", 5),
+    ("beam", 10),
+    ("viterbi", None),
+]
+
+
+def read_gold(path):
+    sentences = []
+    with io.open(path, encoding="utf-8") as f:
+        for line in f:
+            items = [WD_TAG_RE.match(item) for item in line.split()]
+            sentences.append([m.groups() for m in items if m is not None])
+    return [sent for sent in sentences if sent]
+
+
+def tag(tagger, sentences, decoding, beam_size):
+    return [
+        [
+            t.label
+            for t in tagger.tag_token_sequence(
+                [Token(string=wd) for wd in sent],
+                beam_size=beam_size,
+                decoding=decoding,
+            )
+        ]
+        for sent in sentences
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--gold", default=None)
+    parser.add_argument("--data-dir", default=None)
+    parser.add_argument("--docs", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir
+    if args.gold:
+        gold = read_gold(args.gold)
+    else:
+        gold = None
+        if data_dir is None:
+            data_dir = tempfile.mkdtemp()
+            build_toy_model(data_dir)
+    tagger = POSTagger(data_dir=data_dir) if data_dir else POSTagger()
+    stream = [[wd for wd, _ in doc] for doc in make_corpus(args.docs)]
+    n_stream = sum(len(sent) for sent in stream)
+
+    if gold:
+        n_gold = sum(len(sent) for sent in gold)
+        print("%d held-out tokens, %d tokens timed" % (n_gold, n_stream))
+    else:
+        print("no --gold file: throughput only, %d tokens timed" % n_stream)
+    print("%-8s %6s %10s %10s" % ("decoding", "beam", "accuracy", "tok/s"))
+    for decoding, beam_size in CONFIGS:
+        accuracy = "-"
+        if gold:
+            words = [[wd for wd, _ in sent] for sent in gold]
+            predicted = tag(tagger, words, decoding, beam_size)
+            correct = sum(
+                p == t
+                for sent, labels in zip(gold, predicted)
+                for (_, t), p in zip(sent, labels)
+            )
+            accuracy = "%.4f" % (float(correct) / n_gold)
+        t0 = time.perf_counter()
+        tag(tagger, stream, decoding, beam_size)
+        elapsed = time.perf_counter() - t0
+        print(
+            "%-8s %6s %10s %10.0f"
+            % (
+                decoding,
+                beam_size if decoding == "beam" else "-",
+                accuracy,
+                n_stream / elapsed,
+            )
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
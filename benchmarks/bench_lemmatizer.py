@@ -0,0 +1,148 @@
+# coding: utf-8
+"""
+Memory and lookup latency of the LefffLemmatizer backends: the in-memory
+dict built from the .mlex file and the memory-mapped compiled table.
+
+Each backend is measured in its own process: load time, resident memory
+added by the load (peak RSS delta) and the mean latency of lemmatize()
+over a mix of known and unknown (form, tag) pairs. Without --mlex, a
+synthetic lexicon of --entries lines is generated.
+
+    python benchmarks/bench_lemmatizer.py --entries 500000
+    python benchmarks/bench_lemmatizer.py --mlex spacy_lefff/data/lefff-3.4.mlex
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CATEGORIES = ["nc", "v", "adj", "adv", "det", "prep", "np", "pro"]
+
+
+def rss_kb():
+    """current resident set size (peak RSS where /proc is not available)"""
+    try:
+        with io.open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes on Linux
+        return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def make_lexicon(path, entries, seed=0):
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyzéèàç"
+    with io.open(path, "w", encoding="utf-8") as f:
+        for _ in range(entries):
+            lemma = "".join(rng.choice(letters) for _ in range(rng.randint(3, 10)))
+            form = lemma + "".join(
+                rng.choice(letters) for _ in range(rng.randint(0, 3))
+            )
+            f.write("%s\t%s\t%s\t\n" % (form, rng.choice(CATEGORIES), lemma))
+
+
+def queries(mlex, n, seed=0):
+    rng = random.Random(seed)
+    pairs = []
+    with io.open(mlex, encoding="utf-8") as f:
+        for line in f:
+            els = line.split("\t")
+            pairs.append((els[0], els[1]))
+    picked = [rng.choice(pairs) for _ in range(n)]
+    # one query out of five misses
+    return [
+        (form + "zz", pos) if i % 5 == 0 else (form, pos)
+        for i, (form, pos) in enumerate(picked)
+    ]
+
+
+def worker(backend, mlex, n_queries):
+    from spacy_lefff import LefffLemmatizer
+
+    qs = queries(mlex, n_queries)
+    rss0 = rss_kb()
+    t0 = time.perf_counter()
+    lemmatizer = LefffLemmatizer(
+        data_dir=os.path.dirname(mlex),
+        lefff_file_name=os.path.basename(mlex),
+        mmap=backend == "mmap",
+    )
+    load_time = time.perf_counter() - t0
+    rss_load = rss_kb() - rss0
+    lemmatize = lemmatizer.lemmatize
+    t0 = time.perf_counter()
+    for form, pos in qs:
+        lemmatize(form, pos, True)
+    lookup_time = time.perf_counter() - t0
+    rss_lookup = rss_kb() - rss0
+    return {
+        "backend": backend,
+        "load_s": load_time,
+        "rss_mb": rss_load / 1024.0,
+        "rss_after_lookups_mb": rss_lookup / 1024.0,
+        "lookup_ns": 1e9 * lookup_time / len(qs),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--mlex", default=None)
+    parser.add_argument("--entries", type=int, default=500000)
+    parser.add_argument("--queries", type=int, default=200000)
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(worker(args.worker, args.mlex, args.queries)))
+        return 0
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mlex = os.path.join(tmp_dir, "lefff.mlex")
+        if args.mlex:
+            shutil.copy(args.mlex, mlex)
+        else:
+            make_lexicon(mlex, args.entries)
+        from spacy_lefff.lefff import compile_lexicon
+
+        t0 = time.perf_counter()
+        compile_lexicon(mlex)
+        print("compile time: %.2fs" % (time.perf_counter() - t0))
+        print(
+            "%8s %10s %10s %18s %12s"
+            % ("backend", "load s", "RSS MB", "RSS w/ lookups MB", "lookup ns")
+        )
+        for backend in ("dict", "mmap"):
+            out = subprocess.check_output(
+                [sys.executable, __file__, "--worker", backend, "--mlex", mlex]
+                + ["--queries", str(args.queries)]
+            )
+            res = json.loads(out.decode("utf-8").strip().splitlines()[-1])
+            print(
+                "%8s %10.3f %10.1f %18.1f %12.0f"
+                % (
+                    res["backend"],
+                    res["load_s"],
+                    res["rss_mb"],
+                    res["rss_after_lookups_mb"],
+                    res["lookup_ns"],
+                )
+            )
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+# coding: utf-8
+"""
+Throughput, latency, memory and load time of the tagger, the lemmatizer and
+the tagger feature extraction, for several configurations.
+
+Everything runs offline: the stand-in MElt model and Lefff lexicon from
+``tests/toy_model.py`` are built in a temporary directory, and the corpus
+is made of the toy sentences with a share of their words replaced by
+random (unknown) ones. Each configuration runs in its own process and
+reports:
+
+- ``tok/s``: tokens processed per second (fastest of ``--repeat`` passes),
+- ``p50 ms`` / ``p99 ms``: per-document latency (with a batch size above 1,
+  the time taken by the batch the document belongs to),
+- ``peak MB``: peak resident memory of the process,
+- ``load s``: time to create the component.
+
+The results are compared with a stored baseline (``--baseline``, by
+default ``benchmarks/baseline.json``, written with ``--save-baseline``).
+With ``--check``, the run fails when the throughput of a configuration
+drops by more than ``--tolerance`` from the baseline. Baselines are only
+comparable on the same machine.
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --only tagger --save-baseline
+    python benchmarks/bench_suite.py --check --tolerance 0.2
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+CONFIGS = [
+    ("tagger", {"beam_size": 1, "batch_size": 1}),
+    ("tagger", {"beam_size": 3, "batch_size": 1}),
+    ("tagger", {"beam_size": 5, "batch_size": 1}),
+    ("tagger", {"beam_size": 3, "batch_size": 64}),
+    ("lemmatizer", {"after_melt": False, "batch_size": 1}),
+    ("lemmatizer", {"after_melt": True, "batch_size": 1}),
+    ("lemmatizer", {"after_melt": True, "batch_size": 256}),
+    ("features", {}),
+]
+
+# coarse universal POS of the toy model tags, for the lemmatizer without MElt
+UPOS = {
+    "ADJ": "ADJ",
+    "ADV": "ADV",
+    "CLS": "PRON",
+    "DET": "DET",
+    "NC": "NOUN",
+    "NPP": "PROPN",
+    "PONCT": "PUNCT",
+    "V": "VERB",
+    "VINF": "VERB",
+    "VPP": "VERB",
+}
+
+
+def config_name(component, options):
+    return " ".join(
+        [component] + ["%s=%s" % (key, options[key]) for key in sorted(options)]
+    )
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / (1024.0**2) if sys.platform == "darwin" else rss / 1024.0
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def make_corpus(n_docs, oov_rate=0.1, seed=0):
+    """n_docs documents of 1 to 4 toy sentences, as lists of (word, tag)"""
+    from tests.toy_model import read_tagged_sentences
+
+    rng = random.Random(seed)
+    sentences = read_tagged_sentences()
+    letters = "abcdefghijklmnopqrstuvwxyzéèà"
+    docs = []
+    for _ in range(n_docs):
+        doc = []
+        for _ in range(rng.randint(1, 4)):
+            for wd, tag in rng.choice(sentences):
+                if tag != "PONCT" and rng.random() < oov_rate:
+                    wd = "".join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+                doc.append((wd, tag))
+        docs.append(doc)
+    return docs
+
+
+def make_docs(nlp, corpus):
+    from spacy.tokens import Doc
+
+    docs = []
+    for sent in corpus:
+        doc = Doc(nlp.vocab, words=[wd for wd, _ in sent])
+        for token, (_, tag) in zip(doc, sent):
+            token.pos_ = UPOS.get(tag, "X")
+        docs.append(doc)
+    return docs
+
+
+def run_docs(process, pipe, docs, batch_size):
+    """per-document latencies of processing docs"""
+    latencies = []
+    if batch_size == 1:
+        for doc in docs:
+            t0 = time.perf_counter()
+            process(doc)
+            latencies.append(time.perf_counter() - t0)
+        return latencies
+    for i in range(0, len(docs), batch_size):
+        batch = docs[i : i + batch_size]
+        t0 = time.perf_counter()
+        for _ in pipe(batch, batch_size=batch_size):
+            pass
+        latencies.extend([time.perf_counter() - t0] * len(batch))
+    return latencies
+
+
+def worker(component, options, data_dir, n_docs, seed, repeat):
+    import spacy
+    from spacy_lefff import POSTagger, LefffLemmatizer
+    from spacy_lefff.melt_tagger import Instance, Token, feat_select_options
+
+    nlp = spacy.blank("fr")
+    docs = make_docs(nlp, make_corpus(n_docs, seed=seed))
+    t0 = time.perf_counter()
+    if component == "lemmatizer":
+        lemmatizer = LefffLemmatizer(
+            data_dir=data_dir, after_melt=options["after_melt"], shared=False
+        )
+        load_time = time.perf_counter() - t0
+        if options["after_melt"]:
+            tagger = POSTagger(data_dir=data_dir)
+            for _ in tagger.pipe(docs):
+                pass
+        process = lemmatizer
+        pipe = lemmatizer.pipe
+        batch_size = options["batch_size"]
+    elif component == "tagger":
+        tagger = POSTagger(data_dir=data_dir, shared=False)
+        load_time = time.perf_counter() - t0
+        beam_size = options["beam_size"]
+        process = lambda doc: tagger(doc, beam_size=beam_size)
+        pipe = lambda docs, batch_size: tagger.pipe(
+            docs, batch_size=batch_size, beam_size=beam_size
+        )
+        batch_size = options["batch_size"]
+    else:
+        tagger = POSTagger(data_dir=data_dir, shared=False)
+        load_time = time.perf_counter() - t0
+        features = tagger.classifier.feature_index()
+
+        def process(doc):
+            # static and sequential features of every token, without the
+            # word features cache, a fixed tag standing for the predicted ones
+            tokens = [Token(string=w.text) for w in doc]
+            for i in range(len(tokens)):
+                inst = Instance(
+                    index=i,
+                    tokens=tokens,
+                    lex_dict=tagger.lex_dict,
+                    tag_dict=tagger.tag_dict,
+                    feat_selection=feat_select_options,
+                    features=features,
+                )
+                inst.get_features()
+                tokens[i].label = "NC"
+
+        pipe = None
+        batch_size = 1
+    # warm up the caches and the interpreter before timing
+    run_docs(process, pipe, docs[:10], batch_size)
+    # throughput of the fastest pass, latencies of all of them
+    latencies = []
+    best = float("inf")
+    for _ in range(repeat):
+        run = run_docs(process, pipe, docs, batch_size)
+        latencies.extend(run)
+        best = min(best, sum(run[::batch_size]))
+    n_tokens = sum(len(doc) for doc in docs)
+    return {
+        "tokens_per_s": n_tokens / best,
+        "p50_ms": 1e3 * percentile(latencies, 0.5),
+        "p99_ms": 1e3 * percentile(latencies, 0.99),
+        "peak_rss_mb": peak_rss_mb(),
+        "load_s": load_time,
+    }
+
+
+def compare(result, base):
+    """relative throughput change from base, as a string"""
+    if not base:
+        return "-"
+    return "%+.0f%%" % (100.0 * (result["tokens_per_s"] / base["tokens_per_s"] - 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--docs", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default=None, help="comma separated components")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        component, options = json.loads(args.worker)
+        res = worker(
+            component, options, args.data_dir, args.docs, args.seed, args.repeat
+        )
+        print(json.dumps(res))
+        return 0
+
+    from tests.toy_model import build_toy_model, build_toy_lexicon
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with io.open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    only = args.only.split(",") if args.only else None
+    data_dir = tempfile.mkdtemp()
+    build_toy_model(data_dir)
+    build_toy_lexicon(data_dir)
+
+    print(
+        "%-42s %10s %8s %8s %8s %7s %9s"
+        % ("config", "tok/s", "p50 ms", "p99 ms", "peak MB", "load s", "vs base")
+    )
+    results = {}
+    regressions = []
+    for component, options in CONFIGS:
+        if only and component not in only:
+            continue
+        name = config_name(component, options)
+        out = subprocess.check_output(
+            [sys.executable, __file__, "--worker", json.dumps([component, options])]
+            + ["--data-dir", data_dir, "--docs", str(args.docs)]
+            + ["--seed", str(args.seed), "--repeat", str(args.repeat)]
+        )
+        res = results[name] = json.loads(out.decode("utf-8").strip().splitlines()[-1])
+        base = baseline.get(name)
+        print(
+            "%-42s %10.0f %8.2f %8.2f %8.1f %7.3f %9s"
+            % (
+                name,
+                res["tokens_per_s"],
+                res["p50_ms"],
+                res["p99_ms"],
+                res["peak_rss_mb"],
+                res["load_s"],
+                compare(res, base),
+            )
+        )
+        if base and res["tokens_per_s"] < (1 - args.tolerance) * base["tokens_per_s"]:
+            regressions.append(name)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with io.open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        print("baseline saved to %s" % args.baseline)
+    if args.check and regressions:
+        print("FAIL: throughput regression for %s" % ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
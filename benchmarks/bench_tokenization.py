@@ -0,0 +1,96 @@
+# coding: utf-8
+"""
+Tokenization/tagging cost as a function of document size.
+
+The tagger used to rebuild its word list by repeatedly matching and
+stripping the joined document text, which is quadratic in the document
+length. This benchmark times the previous regex loop next to
+``melt_tokens`` and the whole ``POSTagger`` call (on the stand-in model
+from ``tests/toy_model.py``) for growing documents, and reports the cost
+per token. With ``--check`` it exits with an error when the per-token cost
+of the tagger grows more than ``--max-growth`` times from the smallest to
+the largest document.
+
+    python benchmarks/bench_tokenization.py --check
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spacy
+from spacy_lefff.melt_tagger import POSTagger, melt_tokens
+from tests.toy_model import build_toy_model, read_tagged_sentences
+
+
+def regex_tokenize(doc):
+    """word list as the tagger built it before tokens came from the Doc"""
+    token_re = re.compile(r"[^ ]+")
+    line = " ".join([w.text for w in doc])
+    wds = []
+    result = token_re.match(line)
+    while result:
+        wds.append(result.group())
+        line = token_re.sub("", line, 1)
+        line = line.strip(" \n")
+        result = token_re.match(line)
+    return wds
+
+
+def make_text(n_tokens):
+    words = [wd for sent in read_tagged_sentences() for wd, _ in sent]
+    return " ".join(words[i % len(words)] for i in range(n_tokens))
+
+
+def timeit(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="500,2000,8000,32000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--max-growth", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    nlp = spacy.blank("fr")
+    data_dir = tempfile.mkdtemp()
+    build_toy_model(data_dir)
+    tagger = POSTagger(data_dir=data_dir, split_sentences=True)
+
+    print(
+        "%8s %14s %14s %14s" % ("tokens", "regex us/tok", "doc us/tok", "tagger us/tok")
+    )
+    per_token = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        doc = nlp(make_text(size))
+        n = len(doc)
+        t_regex = timeit(lambda: regex_tokenize(doc), args.repeat)
+        t_doc = timeit(lambda: melt_tokens(doc), args.repeat)
+        t_tagger = timeit(lambda: tagger(doc), 1)
+        per_token.append(t_tagger / n)
+        print(
+            "%8d %14.2f %14.2f %14.2f"
+            % (n, 1e6 * t_regex / n, 1e6 * t_doc / n, 1e6 * t_tagger / n)
+        )
+    growth = per_token[-1] / per_token[0]
+    print("tagger per-token cost growth: %.2fx" % growth)
+    if args.check and growth > args.max_growth:
+        print("FAIL: tagging cost grows faster than linearly with document size")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,4 @@
 from .lefff import LefffLemmatizer
 from .melt_tagger import POSTagger
 from .downloader import Downloader
+from . import factories
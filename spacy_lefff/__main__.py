@@ -1,13 +1,32 @@
-def _optional_arg(argv):
-    download_dir = None
+# options of download_tagger, passed to Downloader
+DOWNLOAD_OPTIONS = ["archive", "mirror", "sha256", "manifest", "workers", "cache_dir"]
+
+
+def _parse_options(argv):
+    """download directory and keyword arguments of Downloader given on the
+    command line; an unknown option or a bad value ends the command"""
     try:
-        opts, args = getopt.getopt(argv, "d:", ["download_dir="])
-    except getopt.GetoptError:
-        return None
+        opts, args = getopt.getopt(
+            argv, "d:", ["download_dir="] + [name + "=" for name in DOWNLOAD_OPTIONS]
+        )
+    except getopt.GetoptError as e:
+        msg.fail("Invalid option: {}".format(e), exits=1)
+    if args:
+        msg.fail("Unexpected arguments: {}".format(" ".join(args)), exits=1)
+    download_dir = None
+    options = {}
     for opt, arg in opts:
-        if opt in ("-o", "--download_dir"):
+        name = opt.lstrip("-")
+        if name in ("d", "download_dir"):
             download_dir = arg
-    return download_dir
+        elif name == "workers":
+            try:
+                options[name] = int(arg)
+            except ValueError:
+                msg.fail("--workers expects a number, got {!r}".format(arg), exits=1)
+        else:
+            options[name] = arg
+    return download_dir, options
 
 
 if __name__ == "__main__":
@@ -15,17 +34,56 @@ if __name__ == "__main__":
     import getopt
     from wasabi import msg
 
-    commands = ["download_tagger"]
-    if len(sys.argv) < 3:
+    commands = ["download_tagger", "compile_model", "compile_lexicon", "tag"]
+    if len(sys.argv) < 2:
         msg.info("Available commands needs one parameter", ", ".join(commands), exits=1)
-    command = sys.argv.pop(1)
+    command = sys.argv.pop(1).replace("-", "_")
     if command == "download_tagger":
         from . import melt_tagger
         from . import downloader
 
-        download_dir = _optional_arg(sys.argv[1:])
+        download_dir, options = _parse_options(sys.argv[1:])
         download_dir = download_dir if download_dir else melt_tagger.DATA_DIR
-        downloader.Downloader(melt_tagger.PACKAGE, melt_tagger.URL_MODEL, download_dir)
+        downloader.Downloader(
+            melt_tagger.PACKAGE, melt_tagger.URL_MODEL, download_dir, **options
+        )
+    elif command == "compile_model":
+        import os
+        from . import melt_tagger
+        from . import downloader
+
+        download_dir, options = _parse_options(sys.argv[1:])
+        download_dir = download_dir if download_dir else melt_tagger.DATA_DIR
+        # the model where the tagger finds it (installed if needed)
+        model_dir = os.path.join(
+            downloader.Downloader(
+                melt_tagger.PACKAGE, melt_tagger.URL_MODEL, download_dir, **options
+            ).download_dir,
+            "models/fr",
+        )
+        compiled_dir = os.path.join(model_dir, melt_tagger.COMPILED_DIR)
+        with downloader.file_lock(compiled_dir + ".lock"):
+            compiled_dir = melt_tagger.compile_model(model_dir, compiled_dir)
+        msg.good("Compiled model written to {}".format(compiled_dir))
+    elif command == "compile_lexicon":
+        import os
+        from . import lefff
+        from . import downloader
+
+        data_dir, options = _parse_options(sys.argv[1:])
+        data_dir = data_dir if data_dir else lefff.DATA_DIR
+        lefff_path = os.path.join(data_dir, lefff.LEFFF_FILE_NAME)
+        if not os.path.exists(lefff_path):
+            msg.fail("No Lefff lexicon at {}".format(lefff_path), exits=1)
+        # the table where the lemmatizer looks for it
+        table_path = lefff.lexicon_table_path(lefff_path, options.get("cache_dir"))
+        with downloader.file_lock(table_path + ".lock"):
+            table_path = lefff.compile_lexicon(lefff_path, table_path)
+        msg.good("Compiled lexicon written to {}".format(table_path))
+    elif command == "tag":
+        from . import stream
+
+        sys.exit(stream.main(sys.argv[1:]))
     else:
         available = "Available: {}".format(", ".join(commands))
         msg.fail("Unknown command: {}".format(command), available, exits=1)
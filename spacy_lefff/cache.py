@@ -0,0 +1,185 @@
+# coding: utf8
+
+import json
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts its least recently used entries once it
+    holds more than maxsize of them, and counts lookup hits and misses.
+    A maxsize of 0 disables the cache, None makes it unbounded.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if self.maxsize == 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """drop every entry and reset the counters"""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+        }
+
+
+class SentenceCache(object):
+    """
+    Results of whole sentences, keyed by their normalized tokens and the
+    options they were processed with, so that repeated sentences are only
+    processed once. Entries are kept in an LRUCache of maxsize entries and,
+    if path is given, in an SQLite file that persists them across runs and
+    processes: lookups missing the memory fall back to it. Keys and values
+    must be JSON serializable (values read from the file are lists).
+    """
+
+    def __init__(self, maxsize=10000, path=None):
+        self.memory = LRUCache(maxsize)
+        self.path = path
+        self.disk_hits = 0
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            db.commit()
+            self._db = db
+        return self._db
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        if self.path is None:
+            return default
+        row = (
+            self._connect()
+            .execute("SELECT value FROM results WHERE key = ?", (disk_key(key),))
+            .fetchone()
+        )
+        if row is None:
+            return default
+        self.disk_hits += 1
+        value = json.loads(row[0])
+        self.memory[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.memory[key] = value
+        if self.path is not None:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?)",
+                (disk_key(key), json.dumps(value, ensure_ascii=False)),
+            )
+
+    def flush(self):
+        """write the pending entries to the file"""
+        if self._db is not None:
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def __len__(self):
+        return len(self.memory)
+
+    def clear(self):
+        """drop the entries kept in memory (not the ones in the file) and
+        reset the counters"""
+        self.memory.clear()
+        self.disk_hits = 0
+
+    @property
+    def hits(self):
+        return self.memory.hits + self.disk_hits
+
+    @property
+    def misses(self):
+        return self.memory.misses - self.disk_hits
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hit_rate,
+            disk_hits=self.disk_hits,
+            path=self.path,
+        )
+        return stats
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the unpickled cache opens its own connection
+        state["_db"] = None
+        return state
+
+
+def disk_key(key):
+    """text key of key in the file of a SentenceCache"""
+    return json.dumps(key, ensure_ascii=False, separators=(",", ":"))
+
+
+def data_id(key):
+    """short digest of the (JSON serializable) key of the data a component
+    loaded, to tell cached results of different models apart"""
+    return hashlib.sha1(disk_key(key).encode("utf-8")).hexdigest()[:16]
@@ -1,48 +1,459 @@
 import os
+import io
 import sys
+import time
 import logging
 import tarfile
 import shutil
+import hashlib
+import tempfile
 import requests
 import re
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 LOGGER = logging.getLogger(__name__)
 
+ARCHIVE_NAME = "model.tar.gz"
+CHUNK_SIZE = 1 << 20
+# archives at least this large are fetched as several ranges at once
+PARALLEL_MIN_SIZE = 16 << 20
+DOWNLOAD_WORKERS = 4
+TIMEOUT = 60
+# local copy of the archive, or mirror (directory or base URL) serving it,
+# for nodes without access to the release URL
+ARCHIVE_ENV = "SPACY_LEFFF_ARCHIVE"
+MIRROR_ENV = "SPACY_LEFFF_MIRROR"
+# the "data" extraction filter of recent Pythons (3.8.17+, 3.11.4+) also
+# checks each member; members are checked by is_unsafe_member anyway
+EXTRACT_OPTIONS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+FILTER_ERRORS = getattr(tarfile, "FilterError", ())
+# written in the data directory once it is completely installed
+INSTALLED_MARKER = ".installed"
+# shared cache of the downloaded (and compiled) data, outside the package
+CACHE_DIR_ENV = "SPACY_LEFFF_CACHE_DIR"
+MANIFEST_LINE_RE = re.compile(r"^([0-9a-fA-F]{64})\s+\*?(.+)$")
+
+
+class DownloadError(Exception):
+    """Raised when the model data cannot be fetched or verified"""
+
+    pass
+
 
 class Downloader(object):
-    def __init__(self, pkg, url=None, download_dir=DATA_DIR):
+    """
+    Installs the archive of package pkg (downloaded from url) into
+    download_dir/pkg, unless it is already there.
+
+    With cache_dir (by default the SPACY_LEFFF_CACHE_DIR environment
+    variable, or a user cache directory when download_dir is read-only),
+    the data goes to cache_dir/pkg/objects/<sha256 of the archive> instead,
+    shared by every environment using that cache: refs/ maps the hash of
+    each url to the archive it fetched. Installs hold a file lock, so that
+    concurrent first starts wait for a single download. download_dir is
+    set to the directory the data is installed in.
+
+    The archive is fetched in large chunks, as several byte ranges at once
+    when the server supports them, and an interrupted download resumes
+    from the partial files left by the previous attempt. It is verified
+    against sha256 (or its entry in manifest, a sha256sum file path or
+    URL) when one is given, then extracted into a temporary directory
+    which is renamed once complete. With archive (a local file) or mirror
+    (a directory or base URL serving the archive under the same name),
+    nothing is fetched from url; both default to the SPACY_LEFFF_ARCHIVE
+    and SPACY_LEFFF_MIRROR environment variables.
+    """
+
+    def __init__(
+        self,
+        pkg,
+        url=None,
+        download_dir=DATA_DIR,
+        sha256=None,
+        manifest=None,
+        archive=None,
+        mirror=None,
+        workers=DOWNLOAD_WORKERS,
+        cache_dir=None,
+    ):
         self._error = None
         self.url = url
         self.pkg = pkg
-        if not os.path.exists(os.path.join(download_dir, pkg)):
-            os.mkdir(os.path.join(download_dir, pkg))
-            self.download_dir = os.path.join(os.path.join(download_dir, pkg))
-            self._download_data()
-        else:
+        self.download_dir = os.path.join(download_dir, pkg)
+        options = dict(
+            sha256=sha256,
+            manifest=manifest,
+            archive=archive or os.environ.get(ARCHIVE_ENV),
+            mirror=mirror or os.environ.get(MIRROR_ENV),
+            workers=workers,
+        )
+        cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+        if cache_dir is None:
+            if is_set_up(self.download_dir):
+                LOGGER.info("data already set up")
+                return
+            if is_writable(download_dir):
+                # the lock is removed with the staging directory: waiting
+                # processes find the data set up once they hold it
+                staging = self.download_dir + ".download"
+                with file_lock(os.path.join(staging, "lock")):
+                    if not is_set_up(self.download_dir):
+                        self._download_data(self.download_dir, **options)
+                return
+            cache_dir = default_cache_dir()
+            LOGGER.info("{} is read-only, using {}".format(download_dir, cache_dir))
+        self.download_dir = self._cached_data(cache_dir, **options)
+
+    def _cached_data(self, cache_dir, sha256=None, **options):
+        """directory of the data in cache_dir, installed if needed"""
+        root = os.path.join(cache_dir, self.pkg)
+        ref = os.path.join(root, "refs", source_id(self.url or options["archive"]))
+        digest = sha256.lower() if sha256 else read_ref(ref)
+        if digest and is_set_up(os.path.join(root, "objects", digest)):
             LOGGER.info("data already set up")
+            return os.path.join(root, "objects", digest)
+        with file_lock(os.path.join(root, "lock")):
+            digest = sha256.lower() if sha256 else read_ref(ref)
+            if not (digest and is_set_up(os.path.join(root, "objects", digest))):
+                staging = os.path.join(root, "downloads", os.path.basename(ref))
+                digest = self._download_data(
+                    None, staging=staging, sha256=sha256, **options
+                )
+                target = os.path.join(root, "objects", digest)
+                if not is_set_up(target):
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    extract(os.path.join(staging, "archive"), target)
+                write_ref(ref, digest)
+                shutil.rmtree(staging, ignore_errors=True)
+        return os.path.join(root, "objects", digest)
+
+    def _download_data(
+        self,
+        target,
+        staging=None,
+        sha256=None,
+        manifest=None,
+        archive=None,
+        mirror=None,
+        workers=1,
+    ):
+        """install the archive into target and return its SHA-256. Without
+        target, the verified archive is left in staging/archive instead"""
+        staging = staging or target + ".download"
+        os.makedirs(staging, exist_ok=True)
+        url = self.url
+        if not (url or archive or mirror):
+            raise DownloadError("Couldn't fetch model data: no URL given.")
+        name = os.path.basename(url.split("?")[0]) if url else ARCHIVE_NAME
+        if mirror and os.path.isdir(mirror):
+            archive = os.path.join(mirror, name)
+        elif mirror:
+            url = mirror.rstrip("/") + "/" + name
+        if archive:
+            LOGGER.info("installing data for {} from {}...".format(self.pkg, archive))
+            path = archive
+        else:
+            LOGGER.info("downloading data for {}...".format(self.pkg))
+            path = os.path.join(staging, name)
+            if not os.path.exists(path):
+                fetch(url, path, workers=workers)
+        if sha256 is None and manifest:
+            sha256 = manifest_checksum(manifest, name)
+        digest = file_sha256(path)
+        if sha256 is not None and digest != sha256.lower():
+            if not archive:
+                # fetch it again next time
+                os.remove(path)
+            raise DownloadError(
+                "Checksum mismatch for {}: expected {}, got {}".format(
+                    name, sha256, digest
+                )
+            )
+        if sha256 is None:
+            LOGGER.warning("no checksum given for {}, not verified".format(name))
+        if target is None:
+            if archive:
+                shutil.copyfile(archive, os.path.join(staging, "archive"))
+            else:
+                os.rename(path, os.path.join(staging, "archive"))
+            return digest
+        extract(path, target)
+        shutil.rmtree(staging, ignore_errors=True)
+        LOGGER.info("download complete")
+        return digest
+
+
+def default_cache_dir():
+    """per-user cache directory, following XDG on Unix"""
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "spacy_lefff")
+
+
+def is_writable(path):
+    """whether path, or the directory it would be created in, is writable"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.access(path, os.W_OK)
+
+
+def source_id(source):
+    """short digest naming the data fetched from source (a URL or path)"""
+    return hashlib.sha256((source or "").encode("utf-8")).hexdigest()[:16]
+
+
+def read_ref(path):
+    """archive SHA-256 recorded in the ref file path, None if there is none"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
 
-    def _download_data(self):
-        LOGGER.info("downloading data for {}...".format(self.pkg))
-        r = requests.get(self.url, stream=True)
-        total_length = r.headers.get("content-length", 0)
-        pbar = tqdm(unit="B", unit_scale=True, total=int(total_length))
-        if total_length is None:
-            LOGGER.error("Couldn't fetch model data.")
-            raise Exception("Couldn't fetch model data.")
+def write_ref(path, digest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(digest + "\n")
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """exclusive lock on the file path (created if needed), held by one
+    process at a time"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
         else:
-            filename = "model.tar.gz"
-            path = os.path.join(self.download_dir, filename)
-            with open(path, "wb") as f:
-                for data in r.iter_content(chunk_size=4096):
-                    f.write(data)
-                    pbar.update(len(data))
-            if filename.endswith(".tar.gz"):
-                tar = tarfile.open(path, "r:gz")
-                for tarinfo in tar:
-                    tar.extract(tarinfo, self.download_dir)
-                tar.close()
-            # clean raw tar gz
-            os.remove(path)
-            LOGGER.info("download complete")
+            _msvcrt_lock(f)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _msvcrt_lock(f, interval=0.1):
+    """lock the first byte of f, waiting as long as another process holds
+    it (LK_LOCK gives up after 10 seconds)"""
+    while True:
+        f.seek(0)
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(interval)
+
+
+def is_set_up(path):
+    """whether path holds installed data: extracted by extract, which
+    leaves an INSTALLED_MARKER file, or put there by hand (or by older
+    versions), holding at least one data file then. A tree of directories
+    left by an interrupted run does not count, and an empty directory is
+    removed"""
+    if not os.path.isdir(path):
+        return False
+    if os.path.exists(os.path.join(path, INSTALLED_MARKER)):
+        return True
+    for _, _, filenames in os.walk(path):
+        if any(not name.endswith(".lock") for name in filenames):
+            return True
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+    return False
+
+
+def fetch(url, path, workers=DOWNLOAD_WORKERS, chunk_size=None):
+    """download url to path, resuming from the partial files of a previous
+    attempt, with workers concurrent range requests for large files"""
+    chunk_size = chunk_size or CHUNK_SIZE
+    size = None
+    ranges = False
+    if workers > 1:
+        try:
+            r = requests.head(url, allow_redirects=True, timeout=TIMEOUT)
+            if r.status_code == 200:
+                size = int(r.headers.get("content-length", 0)) or None
+                ranges = r.headers.get("accept-ranges", "").lower() == "bytes"
+        except (requests.RequestException, ValueError):
+            pass
+    if ranges and size is not None and size >= PARALLEL_MIN_SIZE:
+        bounds = [size * k // workers for k in range(workers + 1)]
+        parts = ["%s.part%d" % (path, k) for k in range(workers)]
+        with tqdm(unit="B", unit_scale=True, total=size) as pbar:
+            with ThreadPoolExecutor(workers) as pool:
+                futures = [
+                    pool.submit(
+                        fetch_range, url, part, start, end - 1, pbar, chunk_size
+                    )
+                    for part, start, end in zip(parts, bounds, bounds[1:])
+                ]
+                for future in futures:
+                    future.result()
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            for part in parts:
+                with open(part, "rb") as p:
+                    shutil.copyfileobj(p, f, chunk_size)
+        for part in parts:
+            os.remove(part)
+    else:
+        tmp_path = path + ".part"
+        with tqdm(unit="B", unit_scale=True, total=size) as pbar:
+            fetch_range(url, tmp_path, 0, None, pbar, chunk_size)
+    os.rename(tmp_path, path)
+    return path
+
+
+def fetch_range(url, path, start, end, pbar=None, chunk_size=None):
+    """download bytes start to end (inclusive, None for the end of the
+    file) of url to path, resuming from what path already holds"""
+    chunk_size = chunk_size or CHUNK_SIZE
+    have = os.path.getsize(path) if os.path.exists(path) else 0
+    if end is not None and start + have > end:
+        if pbar is not None:
+            pbar.update(have)
+        return path
+    headers = {}
+    if start + have or end is not None:
+        headers["Range"] = "bytes=%d-%s" % (start + have, "" if end is None else end)
+    r = requests.get(url, stream=True, headers=headers, timeout=TIMEOUT)
+    if r.status_code == 416 and end is None and have:
+        # the partial file is already complete
+        return path
+    if r.status_code == 200 and headers:
+        if start or end is not None:
+            raise DownloadError("{} does not support range requests".format(url))
+        # the server sends the whole file again
+        have = 0
+    elif r.status_code not in (200, 206):
+        raise DownloadError(
+            "Couldn't fetch model data from {} (HTTP {})".format(url, r.status_code)
+        )
+    length = r.headers.get("content-length")
+    expected = int(length) if length is not None else None
+    received = 0
+    if pbar is not None:
+        if pbar.total is None and expected is not None:
+            pbar.total = have + expected
+        pbar.update(have)
+    with open(path, "ab" if have else "wb") as f:
+        for data in r.iter_content(chunk_size=chunk_size):
+            f.write(data)
+            received += len(data)
+            if pbar is not None:
+                pbar.update(len(data))
+    if expected is not None and received != expected:
+        raise DownloadError(
+            "Incomplete download of {}: got {} of {} bytes".format(
+                url, received, expected
+            )
+        )
+    return path
+
+
+def file_sha256(path, chunk_size=CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(chunk_size), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def manifest_checksum(manifest, name):
+    """SHA-256 of name in manifest, a sha256sum file (path or URL)"""
+    if os.path.exists(manifest):
+        with open(manifest, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        r = requests.get(manifest, timeout=TIMEOUT)
+        if r.status_code != 200:
+            raise DownloadError(
+                "Couldn't fetch manifest {} (HTTP {})".format(manifest, r.status_code)
+            )
+        text = r.text
+    for line in text.splitlines():
+        m = MANIFEST_LINE_RE.match(line.strip())
+        if m and os.path.basename(m.group(2)) == name:
+            return m.group(1).lower()
+    raise DownloadError("{} is not listed in {}".format(name, manifest))
+
+
+def is_unsafe_member(tarinfo, root):
+    """whether extracting tarinfo into root would write outside of it: its
+    path, or the target of a link, leads out of root (following the links
+    already extracted), or it is a device file"""
+    root = os.path.realpath(root)
+
+    def outside(path):
+        return os.path.commonpath([root, os.path.realpath(path)]) != root
+
+    path = os.path.join(root, tarinfo.name)
+    if os.path.isabs(tarinfo.name) or outside(path):
+        return True
+    if tarinfo.issym():
+        return os.path.isabs(tarinfo.linkname) or outside(
+            os.path.join(os.path.dirname(path), tarinfo.linkname)
+        )
+    if tarinfo.islnk():
+        return outside(os.path.join(root, tarinfo.linkname))
+    return tarinfo.isdev()
+
+
+def extract(archive, target):
+    """extract archive into a temporary directory next to target, renamed
+    to target once complete"""
+    parent = os.path.dirname(os.path.abspath(target))
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix="." + os.path.basename(target))
+    # mkdtemp makes it private
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_dir, 0o777 & ~umask)
+    try:
+        tar = tarfile.open(archive, "r:gz")
+        try:
+            for tarinfo in tar:
+                if is_unsafe_member(tarinfo, tmp_dir):
+                    raise DownloadError(
+                        "Unsafe member {} in {}".format(tarinfo.name, archive)
+                    )
+                try:
+                    tar.extract(tarinfo, tmp_dir, **EXTRACT_OPTIONS)
+                except FILTER_ERRORS as e:
+                    raise DownloadError(
+                        "Unsafe member {} in {}: {}".format(tarinfo.name, archive, e)
+                    )
+        finally:
+            tar.close()
+        # marks a complete install, see is_set_up
+        io.open(os.path.join(tmp_dir, INSTALLED_MARKER), "w").close()
+        try:
+            os.rename(tmp_dir, target)
+        except OSError:
+            if not is_set_up(target):
+                raise
+            # installed by another process in the meantime
+            LOGGER.info("data already set up")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return target
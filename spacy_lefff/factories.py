@@ -0,0 +1,140 @@
+# coding: utf-8
+"""
+spaCy factories of the components, configurable from config.cfg:
+
+    [components.melt_tagger]
+    factory = "lefff_melt_tagger"
+    beam_size = 1
+    decoding = "greedy"
+    index = "mmap"
+
+"lefff_melt_tagger" creates a POSTagger and "lefff_lemmatizer" a
+LefffLemmatizer. These names leave "melt_tagger" and "french_lemmatizer"
+to the factories defined by code written for the previous versions.
+
+Their settings are the keyword arguments of the classes, index selecting
+how the model data is read: "memory" parses the original files, "mmap"
+maps a compiled copy (compiled if needed), "auto" uses the compiled copy
+when there is an up to date one.
+
+The components load their data on first use (lazy): spacy.load builds them
+before from_disk gives them the data saved with the pipeline, so nothing
+is read nor downloaded for a saved pipeline. With lazy = false, they load
+it when they are created.
+"""
+
+from spacy.language import Language
+
+from .lefff import LefffLemmatizer, DATA_DIR
+from .melt_tagger import POSTagger
+
+INDEX_BACKENDS = {"auto": None, "memory": False, "mmap": True}
+
+
+def _mmap(index):
+    if index not in INDEX_BACKENDS:
+        raise ValueError(
+            "Unknown index backend %r, expected one of %s"
+            % (index, ", ".join(INDEX_BACKENDS))
+        )
+    return INDEX_BACKENDS[index]
+
+
+@Language.factory(
+    "lefff_melt_tagger",
+    assigns=["token._.melt_tagger"],
+    default_config={
+        "data_dir": None,
+        "cache_dir": None,
+        "beam_size": 3,
+        "decoding": "beam",
+        "restrict_scoring": False,
+        "feat_options": None,
+        "split_sentences": False,
+        "batch_size": None,
+        "cache_size": 100000,
+        "sentence_cache_size": 0,
+        "sentence_cache_path": None,
+        "index": "auto",
+        "lazy": True,
+        "shared": True,
+    },
+)
+def make_melt_tagger(
+    nlp,
+    name,
+    data_dir,
+    cache_dir,
+    beam_size,
+    decoding,
+    restrict_scoring,
+    feat_options,
+    split_sentences,
+    batch_size,
+    cache_size,
+    sentence_cache_size,
+    sentence_cache_path,
+    index,
+    lazy,
+    shared,
+):
+    return POSTagger(
+        data_dir=data_dir or DATA_DIR,
+        cache_dir=cache_dir,
+        beam_size=beam_size,
+        decoding=decoding,
+        restrict_scoring=restrict_scoring,
+        feat_options=feat_options,
+        split_sentences=split_sentences,
+        batch_size=batch_size,
+        cache_size=cache_size,
+        sentence_cache_size=sentence_cache_size,
+        sentence_cache_path=sentence_cache_path,
+        mmap=_mmap(index),
+        lazy=lazy,
+        shared=shared,
+    )
+
+
+@Language.factory(
+    "lefff_lemmatizer",
+    assigns=["token._.lefff_lemma"],
+    default_config={
+        "data_dir": None,
+        "cache_dir": None,
+        "after_melt": False,
+        "default": False,
+        "batch_size": None,
+        "sentence_cache_size": 0,
+        "sentence_cache_path": None,
+        "index": "auto",
+        "lazy": True,
+        "shared": True,
+    },
+)
+def make_lefff_lemmatizer(
+    nlp,
+    name,
+    data_dir,
+    cache_dir,
+    after_melt,
+    default,
+    batch_size,
+    sentence_cache_size,
+    sentence_cache_path,
+    index,
+    lazy,
+    shared,
+):
+    return LefffLemmatizer(
+        data_dir=data_dir or DATA_DIR,
+        cache_dir=cache_dir,
+        after_melt=after_melt,
+        default=default,
+        batch_size=batch_size,
+        sentence_cache_size=sentence_cache_size,
+        sentence_cache_path=sentence_cache_path,
+        mmap=_mmap(index),
+        lazy=lazy,
+        shared=shared,
+    )
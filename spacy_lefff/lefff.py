@@ -3,13 +3,27 @@
 import os
 import logging
 import io
+import hashlib
+import threading
+from collections.abc import Mapping
 
+import srsly
+from spacy import util
 from spacy.tokens import Token
-from .mappings import SPACY_LEFFF_DIC, MELT_TO_LEFFF_DIC
+from spacy.util import minibatch
+from .mappings import SPACY_LEFFF_DIC, MELT_LEFFF_CATEGORIES
+from .store import StringTable, write_string_table
+from .cache import SentenceCache, data_id
+from .downloader import CACHE_DIR_ENV, default_cache_dir, file_lock, is_writable
+from . import registry
 
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 LEFFF_FILE_NAME = "lefff-3.4.mlex"
+# memory-mappable copies of the lexicon, inside the data directory
+COMPILED_DIR = "compiled"
 LOGGER = logging.getLogger(__name__)
+# Lefff categories the tag mappings refer to, the only ones loaded
+LEFFF_CATEGORIES = set(SPACY_LEFFF_DIC.values()).union(*MELT_LEFFF_CATEGORIES.values())
 
 
 class POSNotFoundError(KeyError):
@@ -36,6 +50,13 @@ class LefffLemmatizer(object):
         lefff_file_name=LEFFF_FILE_NAME,
         after_melt=False,
         default=False,
+        mmap=None,
+        shared=True,
+        lazy=False,
+        sentence_cache_size=0,
+        sentence_cache_path=None,
+        cache_dir=None,
+        batch_size=None,
     ):
         LOGGER.info("New LefffLemmatizer instantiated.")
         # register your new attribute token._.lefff_lemma
@@ -43,47 +64,444 @@ class LefffLemmatizer(object):
             Token.set_extension(self.name, default=None)
         else:
             LOGGER.info("Token {} already registered".format(self.name))
-        # In memory lemma mapping
-        self.lemma_dict = {}
         self.after_melt = after_melt
         self.default = default
-        with io.open(
-            os.path.join(data_dir, lefff_file_name), encoding="utf-8"
-        ) as lefff_file:
-            LOGGER.info("Reading lefff data...")
-            for line in lefff_file:
-                els = line.split("\t")
-                self.lemma_dict[(els[0], els[1])] = els[2]
+        self.lefff_path = os.path.join(data_dir, lefff_file_name)
+        self.table_path = lexicon_table_path(self.lefff_path, cache_dir)
+        self.mmap = mmap
+        self.shared = shared
+        # docs lemmatized together by pipe, overriding the batch size it is
+        # given (nlp.pipe always passes one)
+        self.batch_size = batch_size
+        # lemmas of whole sentences, so that repeated ones are looked up once
+        self.sentence_cache = None
+        if sentence_cache_size or sentence_cache_path:
+            self.sentence_cache = SentenceCache(
+                sentence_cache_size, sentence_cache_path
+            )
+        # identifies the lexicon in the sentence cache keys
+        self.lexicon_id = None
+        self.lemma_dict = None
+        self._indexes = {}
+        self._release = None
+        self._load_lock = threading.Lock()
+        if not lazy:
+            self.warmup()
+
+    @property
+    def loaded(self):
+        return self.lemma_dict is not None
+
+    def warmup(self, background=False):
+        """load the lexicon if it is not loaded yet. With background, load
+        it in a daemon thread and return the thread"""
+        if background:
+            thread = threading.Thread(target=self.warmup, daemon=True)
+            thread.start()
+            return thread
+        if self.lemma_dict is None:
+            with self._load_lock:
+                if self.lemma_dict is None:
+                    self._load()
+        return None
+
+    def _load(self):
+        lefff_path = self.lefff_path
+        table_path = self.table_path
+        mmap = self.mmap
+        if mmap is None:
+            # use the compiled lexicon when there is an up to date one
+            mmap = is_compiled(table_path, lefff_path)
+        if mmap:
+            # memory-mapped lemma table, shared by all the processes using it
+            if not is_compiled(table_path, lefff_path):
+                with file_lock(table_path + ".lock"):
+                    if not is_compiled(table_path, lefff_path):
+                        compile_lexicon(lefff_path, table_path)
+            key = registry.resource_key("Lefff compiled lexicon", table_path)
+            loader = lambda: MappedLemmas(StringTable(table_path))
+        else:
+            # In memory lemma mapping
+            key = registry.resource_key("Lefff lexicon", lefff_path)
+            loader = lambda: read_lefff(lefff_path)
+        # lemmatizers reading the same lexicon share it
+        if self.shared:
+            lemma_dict, self._release = registry.hold(self, key, loader)
+        else:
+            lemma_dict = loader()
+        self._set_lemma_dict(lemma_dict, key)
         LOGGER.info("Successfully loaded lefff lemmatizer")
 
+    def _set_lemma_dict(self, lemma_dict, key):
+        # the lemmas also depend on the tag mappings
+        self.lexicon_id = data_id([key, SPACY_LEFFF_DIC, MELT_LEFFF_CATEGORIES])
+        # form -> lemma index of each tag of the mappings (the ones of the
+        # MElt tags are built on first use unless after_melt is set)
+        self._indexes = {}
+        for tag in SPACY_LEFFF_DIC:
+            self._index(tag, False, lemma_dict)
+        if self.after_melt:
+            for tag in MELT_LEFFF_CATEGORIES:
+                # after_melt lemmatizes with lowercased MElt tags
+                self._index(tag.lower(), True, lemma_dict)
+        self.lemma_dict = lemma_dict
+
+    def release(self):
+        """release the lexicon shared through the registry; the lemmatizer
+        must not be used afterwards"""
+        if self._release is not None:
+            self._release()
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the unpickled lemmatizer owns its copy of the lexicon
+        state["_release"] = None
+        del state["_load_lock"]
+        # the indexes are rebuilt on use
+        state["_indexes"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_lock = threading.Lock()
+
+    def _lexicon_data(self):
+        """msgpack serialization of the lemma tables"""
+        self.warmup()
+        return srsly.msgpack_dumps({"tables": lemma_tables(self.lemma_dict)})
+
+    def _set_lexicon_data(self, bytes_data):
+        """load the lemma tables serialized by _lexicon_data, in place of
+        the lexicon the lemmatizer was loaded with (if any)"""
+        lemma_dict = LemmaTables(srsly.msgpack_loads(bytes_data)["tables"])
+        key = ["Lefff serialized lexicon", hashlib.sha1(bytes_data).hexdigest()]
+        with self._load_lock:
+            self.release()
+            self._release = None
+            self._set_lemma_dict(lemma_dict, key)
+            if self.sentence_cache is not None:
+                self.sentence_cache.clear()
+        return
+
+    def to_bytes(self, exclude=tuple()):
+        """serialize the lexicon, see to_disk"""
+        serializers = {"lexicon": self._lexicon_data}
+        return util.to_bytes(serializers, exclude)
+
+    def from_bytes(self, bytes_data, exclude=tuple()):
+        """load a lexicon serialized with to_bytes"""
+        deserializers = {"lexicon": self._set_lexicon_data}
+        util.from_bytes(bytes_data, deserializers, exclude)
+        return self
+
+    def to_disk(self, path, exclude=tuple()):
+        """write the lemmas of the lexicon (the categories the mappings
+        refer to) to path/lexicon.msgpack, as nlp.to_disk does for the
+        pipeline components"""
+        serializers = {
+            "lexicon.msgpack": lambda p: p.write_bytes(self._lexicon_data()),
+        }
+        util.to_disk(path, serializers, exclude)
+
+    def from_disk(self, path, exclude=tuple()):
+        """load a lexicon written by to_disk, without reading the .mlex
+        file"""
+        deserializers = {
+            "lexicon.msgpack": lambda p: self._set_lexicon_data(p.read_bytes()),
+        }
+        util.from_disk(path, deserializers, exclude)
+        return self
+
+    def _index(self, tag, from_melt, lemma_dict=None):
+        """form -> lemma index of tag (a spaCy POS, or a MElt tag with
+        from_melt)"""
+        index = self._indexes.get((tag, from_melt))
+        if index is None:
+            if lemma_dict is None:
+                lemma_dict = self.lemma_dict
+            index = lemma_dict.index(tag_categories(tag, from_melt))
+            self._indexes[(tag, from_melt)] = index
+        return index
+
     def lemmatize(self, text, pos, from_melt=False):
+        if self.lemma_dict is None:
+            self.warmup()
         text = text.lower() if pos != "PROPN" else text
-        try:
-            if from_melt:
-                if pos in MELT_TO_LEFFF_DIC:
-                    pos = MELT_TO_LEFFF_DIC[pos]
-                return self.lemma_dict[(text, pos)]
-            else:
-                if (pos in SPACY_LEFFF_DIC) and (
-                    (text, SPACY_LEFFF_DIC[pos]) in self.lemma_dict
-                ):
-                    return self.lemma_dict[(text, SPACY_LEFFF_DIC[pos])]
-                else:
-                    raise POSNotFoundError
-        except:
-            # if nothing was matched in leff lemmatizer, notify it
-            if self.default:
-                return text
-            return None
+        lemma = self._index(pos, from_melt).get(text)
+        # if nothing was matched in leff lemmatizer, notify it
+        if lemma is None and self.default:
+            return text
+        return lemma
 
-    def __call__(self, doc):
-        for token in doc:
-            from_melt = False
-            if self.after_melt and token._.melt_tagger:
-                from_melt = True
-                t = token._.melt_tagger.lower()
-            else:
-                t = token.pos_
-            lemma = self.lemmatize(token.text, t, from_melt)
+    def lemmatize_many(self, texts, tags, from_melt=False):
+        """lemmas of the forms in texts given the tags of the same index
+        (spaCy POS, or MElt tags with from_melt, which can also be a list
+        of flags), as lemmatize() returns them: each distinct form and tag
+        is looked up once, in the index of the tag"""
+        if self.lemma_dict is None:
+            self.warmup()
+        default = self.default
+        if isinstance(from_melt, bool):
+            from_melt = [from_melt] * len(tags)
+        indexes = self._indexes
+        lemmas = {}
+        result = []
+        for text, tag, melt in zip(texts, tags, from_melt):
+            key = (text, tag, melt)
+            lemma = lemmas.get(key, lemmas)
+            if lemma is lemmas:
+                index = indexes.get((tag, melt))
+                if index is None:
+                    index = self._index(tag, melt)
+                form = text.lower() if tag != "PROPN" else text
+                lemma = index.get(form)
+                if lemma is None and default:
+                    lemma = form
+                lemmas[key] = lemma
+            result.append(lemma)
+        return result
+
+    def _token_pos(self, token):
+        """tag used to lemmatize token, and whether it is a MElt tag"""
+        if self.after_melt and token._.melt_tagger:
+            return token._.melt_tagger.lower(), True
+        return token.pos_, False
+
+    def _tokens_pos(self, tokens):
+        """texts, tags and MElt flags of tokens, for lemmatize_many"""
+        keys = [(token.text,) + self._token_pos(token) for token in tokens]
+        return [list(column) for column in zip(*keys)] or [[], [], []]
+
+    def set_lemmas(self, tokens):
+        """lemmatize tokens (a doc, span or list of tokens) with one
+        lemmatize_many call"""
+        tokens = list(tokens)
+        lemmas = self.lemmatize_many(*self._tokens_pos(tokens))
+        for token, lemma in zip(tokens, lemmas):
             token._.lefff_lemma = lemma
+        return lemmas
+
+    def __call__(self, doc):
+        self.warmup()
+        if self.sentence_cache is not None:
+            self._lemmatize_sentences(doc)
+            self.sentence_cache.flush()
+            return doc
+        self.set_lemmas(doc)
         return doc
+
+    def _lemmatize_sentences(self, doc):
+        """lemmatize doc sentence by sentence, taking the lemmas of the
+        sentences already seen from the sentence cache"""
+        from .melt_tagger import sentence_spans
+
+        cache = self.sentence_cache
+        if doc.has_annotation("SENT_START"):
+            spans = doc.sents
+        else:
+            spans = sentence_spans(doc)
+        for span in spans:
+            texts, tags, from_melt = self._tokens_pos(span)
+            cache_key = (
+                self.lexicon_id,
+                self.default,
+                tuple(zip(texts, tags, from_melt)),
+            )
+            lemmas = cache.get(cache_key)
+            if lemmas is None:
+                lemmas = cache[cache_key] = self.lemmatize_many(texts, tags, from_melt)
+            for token, lemma in zip(span, lemmas):
+                token._.lefff_lemma = lemma
+
+    def pipe(self, docs, batch_size=1000):
+        """lemmatize a stream of docs, batch_size (or self.batch_size) docs
+        at a time: each distinct (form, tag) pair of a batch is looked up
+        once (or each distinct sentence, with a sentence cache)"""
+        self.warmup()
+        for batch in minibatch(docs, size=self.batch_size or batch_size):
+            if self.sentence_cache is not None:
+                for doc in batch:
+                    self._lemmatize_sentences(doc)
+                self.sentence_cache.flush()
+            else:
+                self.set_lemmas(token for doc in batch for token in doc)
+            yield from batch
+
+
+def tag_categories(tag, from_melt=False):
+    """Lefff categories a spaCy POS (or a MElt tag, in any case, with
+    from_melt) is looked up in, by order of preference"""
+    if from_melt:
+        return MELT_LEFFF_CATEGORIES.get(tag.upper(), ())
+    category = SPACY_LEFFF_DIC.get(tag)
+    return (category,) if category else ()
+
+
+def lemma_tables(lemma_dict):
+    """form -> lemma dict of each Lefff category of lemma_dict (LemmaTables
+    or MappedLemmas)"""
+    if isinstance(lemma_dict, LemmaTables):
+        return lemma_dict.tables
+    tables = {}
+    for key, lemma in lemma_dict.table.items():
+        form, category = key.rsplit("\t", 1)
+        tables.setdefault(category, {})[form] = lemma
+    return tables
+
+
+class LemmaTables(Mapping):
+    """
+    (form, category) -> lemma mapping of a Lefff lexicon, stored as a
+    form -> lemma dict per Lefff category (tables). index() merges them
+    into the lookup table of a tag.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self._merged = {}
+
+    def __getitem__(self, key):
+        form, category = key
+        table = self.tables.get(category)
+        if table is None:
+            raise KeyError(key)
+        return table[form]
+
+    def get(self, key, default=None):
+        table = self.tables.get(key[1])
+        if table is None:
+            return default
+        return table.get(key[0], default)
+
+    def __contains__(self, key):
+        table = self.tables.get(key[1])
+        return table is not None and key[0] in table
+
+    def __iter__(self):
+        for category, table in self.tables.items():
+            for form in table:
+                yield (form, category)
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+    def index(self, categories):
+        """form -> lemma dict of the forms of categories, the lemma of the
+        first category having the form winning"""
+        categories = tuple(categories)
+        if len(categories) == 1:
+            return self.tables.get(categories[0], {})
+        merged = self._merged.get(categories)
+        if merged is None:
+            merged = {}
+            for category in reversed(categories):
+                merged.update(self.tables.get(category, {}))
+            self._merged[categories] = merged
+        return merged
+
+    def __getstate__(self):
+        # merged indexes are rebuilt on use
+        return {"tables": self.tables, "_merged": {}}
+
+
+class MappedLemmas(object):
+    """(form, pos) -> lemma mapping backed by a memory-mapped string table"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __contains__(self, key):
+        return "\t".join(key) in self.table
+
+    def __getitem__(self, key):
+        return self.table["\t".join(key)]
+
+    def get(self, key, default=None):
+        return self.table.get("\t".join(key), default)
+
+    def __len__(self):
+        return len(self.table)
+
+    def index(self, categories):
+        """form -> lemma lookup of the forms of categories"""
+        return MappedIndex(self.table, categories)
+
+
+class MappedIndex(object):
+    """form -> lemma lookup of a tag in a memory-mapped string table,
+    trying each of its categories in turn"""
+
+    def __init__(self, table, categories):
+        self.table = table
+        self.suffixes = ["\t" + category for category in categories]
+
+    def get(self, form, default=None):
+        get = self.table.get
+        for suffix in self.suffixes:
+            lemma = get(form + suffix)
+            if lemma is not None:
+                return lemma
+        return default
+
+
+def read_lefff(lefff_path, categories=LEFFF_CATEGORIES):
+    """LemmaTables of a Lefff .mlex file, with the entries of categories
+    (the ones the tag mappings refer to by default, all of them if None)"""
+    tables = {}
+    with io.open(lefff_path, encoding="utf-8") as lefff_file:
+        LOGGER.info("Reading lefff data...")
+        for line in lefff_file:
+            els = line.split("\t")
+            if categories is not None and els[1] not in categories:
+                continue
+            table = tables.get(els[1])
+            if table is None:
+                table = tables[els[1]] = {}
+            table[els[0]] = els[2]
+    return LemmaTables(tables)
+
+
+def lexicon_table_path(lefff_path, cache_dir=None):
+    """path of the compiled lexicon of the .mlex file lefff_path: in the
+    compiled folder next to it, or in cache_dir (SPACY_LEFFF_CACHE_DIR by
+    default, the user cache directory when that folder cannot be written),
+    under a digest of lefff_path"""
+    name = os.path.basename(lefff_path) + ".tbl"
+    local_path = os.path.join(os.path.dirname(lefff_path), COMPILED_DIR, name)
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV)
+    if not cache_dir:
+        if is_compiled(local_path, lefff_path) or is_writable(
+            os.path.dirname(local_path)
+        ):
+            return local_path
+        cache_dir = default_cache_dir()
+    return os.path.join(cache_dir, "lefff", data_id(os.path.realpath(lefff_path)), name)
+
+
+def compile_lexicon(lefff_path, table_path=None, cache_dir=None):
+    """write the lemmas of a Lefff .mlex file to a string table keyed by
+    form and pos, which MappedLemmas reads; by default the table goes where
+    LefffLemmatizer looks for it, see lexicon_table_path"""
+    if table_path is None:
+        table_path = lexicon_table_path(lefff_path, cache_dir)
+    LOGGER.info("Compiling lefff data to %s..." % table_path)
+    # read first: a missing lexicon leaves nothing behind
+    lemma_dict = read_lefff(lefff_path)
+    os.makedirs(os.path.dirname(table_path), exist_ok=True)
+    write_string_table(
+        table_path,
+        (("\t".join(key), lemma) for key, lemma in lemma_dict.items()),
+        kind="str",
+    )
+    return table_path
+
+
+def is_compiled(table_path, lefff_path=None):
+    """whether table_path holds a compiled lexicon at least as recent as
+    the .mlex file lefff_path"""
+    if not os.path.exists(table_path):
+        return False
+    if lefff_path is not None and os.path.exists(lefff_path):
+        return os.path.getmtime(lefff_path) <= os.path.getmtime(table_path)
+    return True
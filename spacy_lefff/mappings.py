@@ -14,25 +14,36 @@ SPACY_LEFFF_DIC = {
     "PUNCT": "poncts",
 }
 
-MELT_TO_LEFFF_DIC = {
-    "ADJ": "adj",
-    "ADJWH": "adj",
-    "ADV": "adv",
-    "ADVW": "adv",
-    "P": "prep",
-    "P+D": "prep",
-    "P+PRO": "prep",
-    "NOUN": "nc",
-    "NPP": "np",
-    "DET": "det",
-    "DETWH": "det",
-    "VIMP": "v",
-    "VINF": "v",
-    "VPP": "v",
-    "VPR": "v",
-    "VS": "v",
-    "PRO": "pro",
-    "PROREL": "pro",
-    "PROWH": "pro",
-    "PUNCT": "poncts",
+# Lefff categories each MElt tag is looked up in, by order of preference
+MELT_LEFFF_CATEGORIES = {
+    "ADJ": ("adj",),
+    "ADJWH": ("adj",),
+    "ADV": ("adv", "advneg"),
+    "ADVW": ("adv",),
+    "ADVWH": ("adv",),
+    "CC": ("coo",),
+    "CLO": ("cla", "cld", "clr", "cll", "clg", "clar", "cldr"),
+    "CLR": ("clr",),
+    "CLS": ("cln", "ilimp"),
+    "CS": ("csu", "que"),
+    "DET": ("det",),
+    "DETWH": ("det",),
+    "I": ("pres",),
+    "NC": ("nc",),
+    "NOUN": ("nc",),
+    "NPP": ("np",),
+    "P": ("prep",),
+    "P+D": ("prep",),
+    "P+PRO": ("prep",),
+    "PONCT": ("poncts", "ponctw"),
+    "PUNCT": ("poncts", "ponctw"),
+    "PRO": ("pro", "prel", "pri"),
+    "PROREL": ("prel", "pro"),
+    "PROWH": ("pri", "pro"),
+    "V": ("v", "auxAvoir", "auxEtre"),
+    "VIMP": ("v", "auxAvoir", "auxEtre"),
+    "VINF": ("v", "auxAvoir", "auxEtre"),
+    "VPP": ("v", "auxAvoir", "auxEtre"),
+    "VPR": ("v", "auxAvoir", "auxEtre"),
+    "VS": ("v", "auxAvoir", "auxEtre"),
 }
@@ -23,12 +23,15 @@ import sys
 import re
 import math
 import tempfile
+import shutil
 import codecs
 import operator
 import time
 import optparse
 import unicodedata
 import subprocess
+import threading
+import hashlib
 from collections import defaultdict
 import logging
 
@@ -39,24 +42,53 @@ hyphen = re.compile("\-")
 equals = re.compile("=")
 upper = re.compile("^([A-Z]|[^_].*[A-Z])")
 allcaps = re.compile("^[A-Z]+$")
+SENT_END_PUNCT = frozenset([".", "!", "?", "...", "…", "?!", "!?"])
+SENT_CLOSING_PUNCT = frozenset(['"', "»", "”", ")", "]"])
 
 import numpy as np
+import srsly
 
 from json import dumps, loads
 import io
 from spacy.tokens import Token as tk
+from spacy import util
+from spacy.util import minibatch
 from .lefff import LefffLemmatizer
-from .downloader import Downloader
+from .downloader import Downloader, file_lock
+from .cache import LRUCache, SentenceCache, data_id
+from .stats import Stats
+from .store import StringTable, write_string_table
+from . import registry
 
 LOGGER = logging.getLogger(__name__)
 
 PACKAGE = "tagger"
+# memory-mappable copy of the model, inside the model directory
+COMPILED_DIR = "compiled"
+# decoding strategies of the tagger
+DECODINGS = ("greedy", "beam", "viterbi")
+MODEL_FILES = (
+    "lexicon.json",
+    "tag_dict.json",
+    "classes.json",
+    "feature_map.json",
+    "weights.npy",
+    "bias_weights.npy",
+)
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
 URL_MODEL = (
     "https://github.com/sammous/spacy-lefff-model/releases/latest/download/model.tar.gz"
 )
 
+# most frequent French words, used to warm up the word features cache
+FRENCH_FUNCTION_WORDS = (
+    "de la le et les des en un une du à a est il que qui pour dans ne pas "
+    "par sur au plus se ce sont avec elle ils elles on nous vous je "
+    "son sa ses leur leurs cette ces aux ou mais comme été être avoir fait "
+    "y lui tout tous si bien sans entre sous après avant . , ; : ! ? ( ) \" ' -"
+).split()
+
 # extra options dict for feature selection
 feat_select_options = {
     # previous default values
@@ -101,183 +133,825 @@ class POSTagger(Downloader):
         package=PACKAGE,
         url=URL_MODEL,
         print_probas=False,
+        split_sentences=False,
+        cache_size=100000,
+        mmap=None,
+        shared=True,
+        lazy=False,
+        stats=None,
+        decoding="beam",
+        restrict_scoring=False,
+        sentence_cache_size=0,
+        sentence_cache_path=None,
+        cache_dir=None,
+        beam_size=3,
+        batch_size=None,
+        feat_options=None,
     ):
-        super(POSTagger, self).__init__(package, url=url, download_dir=data_dir)
         if not tk.get_extension(self.name):
             tk.set_extension(self.name, default=None)
         else:
             LOGGER.info("Token {} already registered".format(self.name))
-
-        model_dir_path = (
+        self.data_dir = data_dir
+        self.package = package
+        self.url = url
+        # shared cache of the model, see Downloader
+        self.cache_dir = cache_dir
+        self._default_model_dir = not model_dir_path
+        self.model_dir_path = (
             model_dir_path
             if model_dir_path
             else os.path.join(data_dir, package, "models/fr")
         )
+        self.lexicon_file_path = lexicon_file_path
+        self.tag_file_path = tag_file_path
+        self.mmap = mmap
+        self.shared = shared
+        # static word features, shared by every instance of the tagger
+        self.cache = LRUCache(cache_size)
+        # legal classes of each word
+        self.legal_cache = LRUCache(cache_size)
+        # ambiguity classes of the context words
+        self.ambiguity_cache = LRUCache(cache_size)
+        # only score the legal classes of words known to the lexicons
+        self.restrict_scoring = restrict_scoring
+        # tags of whole sentences, so that repeated ones are tagged once
+        self.sentence_cache = None
+        if sentence_cache_size or sentence_cache_path:
+            self.sentence_cache = SentenceCache(
+                sentence_cache_size, sentence_cache_path
+            )
+        # identifies the model (and lexicons) in the sentence cache keys
+        self.model_id = None
+        # counters and timings, only collected when asked for
+        self.stats = Stats() if stats is True else (stats or None)
+        if self.stats is not None:
+            self.stats.watch_cache("word_features", self.cache)
+            self.stats.watch_cache("legal_classes", self.legal_cache)
+            self.stats.watch_cache("ambiguity_classes", self.ambiguity_cache)
+            if self.sentence_cache is not None:
+                self.stats.watch_cache("sentences", self.sentence_cache)
+        # print the probability of the tag along to the tag itself
+        self.print_probas = print_probas
+        # tag each sentence as its own sequence instead of the whole doc
+        self.split_sentences = split_sentences
+        # default decoding strategy, see tag_token_sequences
+        if decoding not in DECODINGS:
+            raise ValueError(
+                "Unknown decoding %r, expected one of %s"
+                % (decoding, ", ".join(DECODINGS))
+            )
+        self.decoding = decoding
+        # defaults of the pipeline calls: beam size and feature selection
+        # (feat_options overrides some of feat_select_options)
+        self.beam_size = beam_size
+        self.feat_options = (
+            dict(feat_select_options, **feat_options)
+            if feat_options
+            else feat_select_options
+        )
+        # docs tagged together by pipe, overriding the batch size it is
+        # given (nlp.pipe always passes one)
+        self.batch_size = batch_size
+        self.lex_dict = self.tag_dict = self.classifier = None
+        self._release = None
+        self._load_lock = threading.Lock()
+        if not lazy:
+            self.warmup()
+        return
+
+    @property
+    def loaded(self):
+        return self.classifier is not None
+
+    def warmup(self, background=False):
+        """download and load the model if it is not loaded yet. With
+        background, load it in a daemon thread and return the thread"""
+        if background:
+            thread = threading.Thread(target=self.warmup, daemon=True)
+            thread.start()
+            return thread
+        if self.classifier is None:
+            with self._load_lock:
+                if self.classifier is None:
+                    self._load()
+        return None
+
+    def _load(self):
+        super(POSTagger, self).__init__(
+            self.package,
+            url=self.url,
+            download_dir=self.data_dir,
+            cache_dir=self.cache_dir,
+        )
+        if self._default_model_dir:
+            # the data may have been installed in the cache directory
+            self.model_dir_path = os.path.join(self.download_dir, "models/fr")
+        model_dir_path = self.model_dir_path
+        compiled_dir = os.path.join(model_dir_path, COMPILED_DIR)
+        mmap = self.mmap
+        if mmap is None:
+            # use the compiled model when there is an up to date one
+            mmap = (
+                self.lexicon_file_path is None
+                and self.tag_file_path is None
+                and is_compiled(compiled_dir, model_dir_path)
+            )
         lexicon_file_path = (
-            lexicon_file_path
-            if lexicon_file_path
+            self.lexicon_file_path
+            if self.lexicon_file_path
             else os.path.join(model_dir_path, "lexicon.json")
         )
         tag_file_path = (
-            tag_file_path
-            if tag_file_path
+            self.tag_file_path
+            if self.tag_file_path
             else os.path.join(model_dir_path, "tag_dict.json")
         )
+        if mmap:
+            # memory-map a compiled copy of the model, shared by all the
+            # processes using it
+            if not is_compiled(compiled_dir, model_dir_path):
+                # processes starting together compile the model once
+                with file_lock(compiled_dir + ".lock"):
+                    if not is_compiled(compiled_dir, model_dir_path):
+                        compile_model(
+                            model_dir_path,
+                            compiled_dir,
+                            lexicon_file_path,
+                            tag_file_path,
+                        )
+            key = registry.resource_key(
+                "MElt compiled model",
+                os.path.join(compiled_dir, "classes.json"),
+                os.path.join(compiled_dir, "weights.npy"),
+            )
+            loader = lambda: self._read_compiled(compiled_dir)
+        else:
+            key = registry.resource_key(
+                "MElt model",
+                lexicon_file_path,
+                tag_file_path,
+                *[os.path.join(model_dir_path, name) for name in MODEL_FILES[2:]]
+            )
+            loader = lambda: self._read_model(
+                model_dir_path, lexicon_file_path, tag_file_path
+            )
+        # the lexicons and the classifier are only read: taggers loaded
+        # from the same files share them
+        if self.shared:
+            tables, self._release = registry.hold(self, key, loader)
+        else:
+            tables = loader()
+        self.model_id = data_id(key)
+        self.lex_dict, self.tag_dict, self.classifier = tables
+        return
 
+    def _read_model(self, model_path, lexicon_file_path, tag_file_path):
         LOGGER.info("  TAGGER: Loading lexicon...")
-        self.lex_dict = unserialize(lexicon_file_path)
+        lex_dict = unserialize(lexicon_file_path)
         LOGGER.info("  TAGGER: Loading tags...")
-        self.tag_dict = unserialize(tag_file_path)
-        self.classifier = MaxEntClassifier()
-        self.cache = {}
-        self._load_model(model_dir_path)
-        # print the probability of the tag along to the tag itself
-        self.print_probas = print_probas
-        return
-
-    def _load_model(self, model_path):
+        tag_dict = unserialize(tag_file_path)
+        classifier = MaxEntClassifier()
         try:
-            self.classifier.load(model_path)
+            classifier.load(model_path)
         except Exception as e:
             sys.exit("Error: Failure load POS model from %s (%s)" % (model_path, e))
+        return lex_dict, tag_dict, classifier
+
+    def _read_compiled(self, compiled_dir):
+        LOGGER.info("  TAGGER: Mapping lexicon and tags...")
+        lex_dict = StringTable(os.path.join(compiled_dir, "lexicon.tbl"))
+        tag_dict = StringTable(os.path.join(compiled_dir, "tag_dict.tbl"))
+        classifier = MaxEntClassifier()
+        try:
+            classifier.load_compiled(compiled_dir)
+        except Exception as e:
+            sys.exit("Error: Failure load POS model from %s (%s)" % (compiled_dir, e))
+        return lex_dict, tag_dict, classifier
+
+    def release(self):
+        """release the model shared through the registry; the tagger must
+        not be used afterwards"""
+        if self._release is not None:
+            self._release()
         return
 
-    def tag_token_sequence(self, tokens, feat_options=feat_select_options, beam_size=3):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the unpickled tagger owns its copy of the model
+        state["_release"] = None
+        del state["_load_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_lock = threading.Lock()
+
+    def _model_data(self):
+        """msgpack serialization of the lexicons and the classifier"""
+        self.warmup()
+        classifier = self.classifier
+        return srsly.msgpack_dumps(
+            {
+                "lex_dict": dict(self.lex_dict),
+                "tag_dict": dict(self.tag_dict),
+                "classes": list(classifier.classes),
+                "feature_map": dict(classifier.feature2int),
+                "weights": np.ascontiguousarray(classifier.weights),
+                "bias_weights": np.ascontiguousarray(classifier.bias_weights),
+            }
+        )
+
+    def _set_model_data(self, bytes_data):
+        """load the model serialized by _model_data, in place of the one
+        the tagger was loaded with (if any)"""
+        data = srsly.msgpack_loads(bytes_data)
+        classifier = MaxEntClassifier()
+        classifier.classes = data["classes"]
+        classifier.feature2int = data["feature_map"]
+        classifier.weights = data["weights"]
+        classifier.bias_weights = data["bias_weights"]
+        with self._load_lock:
+            self.release()
+            self._release = None
+            self.lex_dict = data["lex_dict"]
+            self.tag_dict = data["tag_dict"]
+            self.classifier = classifier
+            self.model_id = data_id(
+                ["MElt serialized model", hashlib.sha1(bytes_data).hexdigest()]
+            )
+            self.clear_cache()
+        return
+
+    def to_bytes(self, exclude=tuple()):
+        """serialize the model (lexicons and classifier), see to_disk"""
+        serializers = {"model": self._model_data}
+        return util.to_bytes(serializers, exclude)
+
+    def from_bytes(self, bytes_data, exclude=tuple()):
+        """load a model serialized with to_bytes"""
+        deserializers = {"model": self._set_model_data}
+        util.from_bytes(bytes_data, deserializers, exclude)
+        return self
+
+    def to_disk(self, path, exclude=tuple()):
+        """write the model (lexicons and classifier) to path/model.msgpack,
+        as nlp.to_disk does for the pipeline components"""
+        serializers = {
+            "model.msgpack": lambda p: p.write_bytes(self._model_data()),
+        }
+        util.to_disk(path, serializers, exclude)
+
+    def from_disk(self, path, exclude=tuple()):
+        """load a model written by to_disk, without reading the model files
+        nor downloading them"""
+        deserializers = {
+            "model.msgpack": lambda p: self._set_model_data(p.read_bytes()),
+        }
+        util.from_disk(path, deserializers, exclude)
+        return self
+
+    def tag_token_sequence(
+        self, tokens, feat_options=feat_select_options, beam_size=3, decoding=None
+    ):
         """N-best breath search for the best tag sequence for each sentence"""
-        # maintain N-best sequences of tagged tokens
-        sequences = [([], 0.0)]  # log prob.
-        for i, token in enumerate(tokens):
-            n_best_sequences = []
-            # cache static features
-            cached_inst = Instance(
-                label=tokens[i].label,
-                index=i,
-                tokens=tokens,
-                feat_selection=feat_options,
-                lex_dict=self.lex_dict,
-                tag_dict=self.tag_dict,
-                cache=self.cache,
+        return self.tag_token_sequences(
+            [tokens], feat_options=feat_options, beam_size=beam_size, decoding=decoding
+        )[0]
+
+    def tag_token_sequences(
+        self, token_seqs, feat_options=feat_select_options, beam_size=3, decoding=None
+    ):
+        """best tag sequence for each sentence, with the decoding strategy
+        (self.decoding by default):
+        - greedy: tag each token with its best class given the previous tags,
+        - beam: N-best breath search (beam_size hypotheses),
+        - viterbi: exact search over the tag histories seen by the model.
+        The beam and viterbi searches run in lockstep over the sentences: at
+        each position, the hypotheses of every sentence still running are
+        scored with a single classifier call"""
+        decoding = decoding or self.decoding
+        if decoding not in DECODINGS:
+            raise ValueError(
+                "Unknown decoding %r, expected one of %s"
+                % (decoding, ", ".join(DECODINGS))
             )
-            cached_inst.get_static_features()
-            # get possible tags: union of tags found in tag_dict and
-            # lex_dict
-            wd = token.string
-            wasCap = token.wasCap
-            legit_tags1 = self.tag_dict.get(wd, {})
-            legit_tags2 = self.lex_dict.get(wd, {})
-            #            legit_tags2 = {} # self.lex_dict.get(wd,{})
-            #            print >> sys.stderr, "legit_tags1: ", [t for t in legit_tags1]
-            for j, seq in enumerate(sequences):
-                seq_j, log_pr_j = sequences[j]
-                tokens_j = seq_j + tokens[i:]  # tokens with previous labels
-                # classify token
-                inst = Instance(
-                    label=tokens[i].label,
-                    index=i,
-                    tokens=tokens_j,
-                    feat_selection=feat_options,
-                    lex_dict=self.lex_dict,
-                    tag_dict=self.tag_dict,
-                    cache=self.cache,
+        self.warmup()
+        # build the feature vectors as weight rows when the model allows it
+        features = self.classifier.feature_index()
+        # number of previous tags seen by the sequential features
+        lwin = max(feat_options.get("win", 2), feat_options.get("pwin", 2))
+        if decoding == "greedy":
+            return self._tag_greedy(token_seqs, feat_options, features, lwin)
+        # hypotheses assigning the same last tags only differ by their score
+        # so far: viterbi keeps the best of them, and no other pruning
+        recombine = decoding == "viterbi"
+        if recombine:
+            # initial room per position, grown as needed
+            beam_size = len(self.classifier.classes)
+        stats = self.stats
+        if stats is not None:
+            clock = time.perf_counter
+            t_features = t_scoring = t_beam = 0.0
+        # maintain N-best hypotheses for each sentence
+        beams = [Beam(len(tokens), beam_size) for tokens in token_seqs]
+        for i in range(max([len(tokens) for tokens in token_seqs], default=0)):
+            if stats is not None:
+                t0 = clock()
+            active = [k for k, tokens in enumerate(token_seqs) if i < len(tokens)]
+            fvs = [
+                self._hypotheses_features(
+                    token_seqs[k], i, beams[k].histories, feat_options, features
                 )
-                inst.fv = cached_inst.fv[:]
-                inst.get_sequential_features()
-                label_pr_distrib = self.classifier.class_distribution(inst.fv)
-                # extend sequence j with current token
-                for (cl, pr) in label_pr_distrib:
-                    # make sure that cl is a legal tag
-                    if legit_tags1 or legit_tags2:
-                        if (cl not in legit_tags1) and (cl not in legit_tags2):
-                            continue
-                    labelled_token = Token(
+                for k in active
+            ]
+            legal = [self._legal_classes(token_seqs[k][i]) for k in active]
+            if stats is not None:
+                t1 = clock()
+            # classify token for all the hypotheses at once
+            distribs, columns = self._score_hypotheses(fvs, legal, features)
+            if stats is not None:
+                t2 = clock()
+            for k, legal_k, distribs_k, columns_k in zip(
+                active, legal, distribs, columns
+            ):
+                self._extend_beam(
+                    beams[k], i, legal_k, distribs_k, columns_k, lwin, recombine
+                )
+            if stats is not None:
+                t3 = clock()
+                t_features += t1 - t0
+                t_scoring += t2 - t1
+                t_beam += t3 - t2
+                stats.incr("hypotheses_scored", sum(map(len, fvs)))
+        if stats is not None:
+            stats.incr("sequences_tagged", len(token_seqs))
+            stats.incr("tokens_tagged", sum([len(tokens) for tokens in token_seqs]))
+            stats.observe("feature_extraction", t_features)
+            stats.observe("classifier_scoring", t_scoring)
+            stats.observe("beam_bookkeeping", t_beam)
+        # return sequence with highest prob.
+        return [
+            beam.best_sequence(tokens, self.classifier.classes)
+            for beam, tokens in zip(beams, token_seqs)
+        ]
+
+    def _tag_greedy(self, token_seqs, feat_options, features, lwin):
+        """tag each token with the legal class of highest weight given the
+        tags of the previous tokens (no probability is computed)"""
+        stats = self.stats
+        if stats is not None:
+            t0 = time.perf_counter()
+        classify = self.classifier.categorize
+        n_classes = len(self.classifier.classes)
+        tagged_seqs = []
+        for tokens in token_seqs:
+            history = ()
+            sequence = []
+            for i, token in enumerate(tokens):
+                (fv,) = self._hypotheses_features(
+                    tokens, i, [history], feat_options, features
+                )
+                legal = self._legal_classes(token)
+                cl = classify(fv, legal if len(legal) < n_classes else None)
+                history = (history + (cl,))[-lwin:]
+                sequence.append(
+                    Token(
                         string=token.string,
                         pos=token.pos,
                         comment=token.comment,
-                        wasCap=wasCap,
+                        wasCap=token.wasCap,
                         label=cl,
-                        proba=pr,
-                        label_pr_distrib=label_pr_distrib,
                     )
-                    n_best_sequences.append(
-                        (seq_j + [labelled_token], log_pr_j + math.log(pr))
+                )
+            tagged_seqs.append(sequence)
+        if stats is not None:
+            stats.incr("sequences_tagged", len(token_seqs))
+            stats.incr("tokens_tagged", sum([len(tokens) for tokens in token_seqs]))
+            stats.observe("greedy_decoding", time.perf_counter() - t0)
+        return tagged_seqs
+
+    def _hypotheses_features(self, tokens, i, histories, feat_options, features=None):
+        """feature vectors of token i for each hypothesis, given the tags
+        it assigned to the previous tokens (histories)"""
+        # static features are computed once for all the hypotheses
+        inst = Instance(
+            label=tokens[i].label,
+            index=i,
+            tokens=tokens,
+            feat_selection=feat_options,
+            lex_dict=self.lex_dict,
+            tag_dict=self.tag_dict,
+            cache=self.cache,
+            features=features,
+            ambiguity=self.ambiguity_cache,
+        )
+        inst.get_static_features()
+        static_fv = inst.fv
+        fvs = []
+        sequential = {}
+        for history in histories:
+            # hypotheses ending with the same tags share their features
+            seq_fv = sequential.get(history)
+            if seq_fv is None:
+                inst.fv = []
+                inst.left_labels = list(history)
+                inst.get_sequential_features()
+                seq_fv = sequential[history] = inst.fv
+            fvs.append(static_fv + seq_fv)
+        return fvs
+
+    def _legal_classes(self, token):
+        """indices of the classes token can be tagged with: the tags of the
+        word in tag_dict and lex_dict, every class for unknown words"""
+        wd = token.string
+        legal = self.legal_cache.get(wd)
+        if legal is not None:
+            return legal
+        legit_tags1 = self.tag_dict.get(wd, {})
+        legit_tags2 = self.lex_dict.get(wd, {})
+        classes = self.classifier.classes
+        legal = ()
+        if legit_tags1 or legit_tags2:
+            legal = tuple(
+                c
+                for c, cl in enumerate(classes)
+                if cl in legit_tags1 or cl in legit_tags2
+            )
+        if not legal:
+            legal = tuple(range(len(classes)))
+        self.legal_cache[wd] = legal
+        return legal
+
+    def _score_hypotheses(self, fvs, legal, features):
+        """class distributions of the hypotheses of each sentence (fvs holds
+        their feature vectors and legal the legal classes of their token),
+        and the classes of their columns (None for every class). Unless
+        restrict_scoring is set, every class is scored, with one classifier
+        call. Otherwise only the legal classes are, with one call for each
+        set of legal classes, and the distributions are normalized over
+        them; unknown words still get every class"""
+        if features is not None:
+            distributions = self.classifier.index_distributions
+        else:
+            distributions = self.classifier.class_distributions
+        n_classes = len(self.classifier.classes)
+        groups = {}
+        for a, legal_a in enumerate(legal):
+            if self.restrict_scoring and len(legal_a) < n_classes:
+                groups.setdefault(legal_a, []).append(a)
+            else:
+                groups.setdefault(None, []).append(a)
+        distribs = [None] * len(fvs)
+        columns = [None] * len(fvs)
+        for group_columns, members in groups.items():
+            group_distribs = distributions(
+                [fv for a in members for fv in fvs[a]], columns=group_columns
+            )
+            row = 0
+            for a in members:
+                distribs[a] = group_distribs[row : row + len(fvs[a])]
+                columns[a] = group_columns
+                row += len(fvs[a])
+        return distribs, columns
+
+    def _extend_beam(self, beam, i, legal, distribs, columns, lwin, recombine=False):
+        """extend each hypothesis of beam with the legal classes of token i
+        (distribs holds their distributions over the classes in columns, or
+        over every class if columns is None) and keep the beam_size best
+        ones. With recombine, only the best of the candidates ending with
+        the same lwin tags is kept"""
+        n_legal = len(legal)
+        probs = distribs[:, legal] if columns is None else distribs
+        prev_scores = beam.scores[i - 1][: len(probs)].tolist() if i else [0.0]
+        log = math.log
+        cand_scores = []
+        for log_pr_j, probs_j in zip(prev_scores, probs.tolist()):
+            cand_scores.extend([log_pr_j + log(pr) for pr in probs_j])
+        cand_scores = np.array(cand_scores)
+        n = len(cand_scores)
+        k = beam.beam_size
+        if recombine:
+            # candidates end with the last lwin - 1 tags of their parent and
+            # their own tag: keep the best one for each such history (the
+            # last one among equal scores)
+            suffixes = {}
+            suffix_ids = np.array(
+                [
+                    suffixes.setdefault(
+                        history[len(history) - lwin + 1 :], len(suffixes)
                     )
-            # sort sequences
-            n_best_sequences.sort(key=operator.itemgetter(1))
-            # debug_n_best_sequence(n_best_sequences)
-            # keep N best
-            sequences = n_best_sequences[-beam_size:]
-        # return sequence with highest prob.
-        best_sequence = sequences[-1][0]
-        # print >> sys.stderr, "Best tok seq:", [(t.string,t.label) for t in best_sequence]
-        return best_sequence
+                    for history in beam.histories
+                ],
+                dtype=np.intp,
+            )
+            index = np.arange(n)
+            keys = suffix_ids[index // n_legal] * n_legal + index % n_legal
+            order = np.lexsort((index, cand_scores, keys))
+            last = np.ones(n, dtype=bool)
+            last[:-1] = keys[order[1:]] != keys[order[:-1]]
+            keep = order[last]
+        elif n > k:
+            # partial selection of the k best candidates; among equal
+            # scores, the last candidates win, as with a stable sort
+            kth = np.partition(cand_scores, n - k)[n - k]
+            above = np.flatnonzero(cand_scores > kth)
+            ties = np.flatnonzero(cand_scores == kth)
+            keep = np.concatenate([above, ties[len(ties) - (k - len(above)) :]])
+        else:
+            keep = np.arange(n)
+        # best hypothesis last
+        keep = keep[np.lexsort((keep, cand_scores[keep]))]
+        if self.stats is not None:
+            self.stats.incr("candidates", n)
+            self.stats.incr("candidates_pruned", n - len(keep))
+        parents = keep // n_legal
+        labels = np.asarray(legal)[keep % n_legal]
+        beam.extend(
+            i,
+            parents,
+            labels,
+            cand_scores[keep],
+            probs[parents, keep % n_legal],
+            distribs,
+            columns,
+            self.classifier.classes,
+            lwin,
+        )
+        return
 
     def __call__(
         self,
         doc,
         handle_comments=False,
-        feat_options=feat_select_options,
-        beam_size=3,
+        feat_options=None,
+        beam_size=None,
         lowerCaseCapOnly=False,
         zh_mode=False,
+        split_sentences=None,
+        decoding=None,
+    ):
+        LOGGER.debug("  TAGGER: POS Tagging...")
+        self._tag_docs(
+            [doc],
+            handle_comments=handle_comments,
+            feat_options=feat_options,
+            beam_size=beam_size,
+            lowerCaseCapOnly=lowerCaseCapOnly,
+            split_sentences=split_sentences,
+            decoding=decoding,
+        )
+        return doc
+
+    def pipe(self, docs, batch_size=128, **kwargs):
+        """tag a stream of docs, batch_size (or self.batch_size) docs at a
+        time: the sentences of a batch go through the beam search together,
+        so feature vectors are scored with one classifier call per position
+        for the whole batch"""
+        for batch in minibatch(docs, size=self.batch_size or batch_size):
+            self._tag_docs(batch, **kwargs)
+            yield from batch
+
+    def sentences(self, doc):
+        """sentence spans of doc: doc.sents when sentence boundaries were
+        set by the pipeline (parser, senter, sentencizer), the built-in
+        punctuation/newline segmentation otherwise"""
+        if doc.has_annotation("SENT_START"):
+            return list(doc.sents)
+        return list(sentence_spans(doc))
+
+    def _tag_docs(
+        self,
+        docs,
+        handle_comments=False,
+        feat_options=None,
+        beam_size=None,
+        lowerCaseCapOnly=False,
+        split_sentences=None,
+        decoding=None,
     ):
-        LOGGER.info("  TAGGER: POS Tagging...")
-        t0 = time.time()
+        """tag docs, each doc (or each sentence with split_sentences) being
+        one sequence"""
+        if split_sentences is None:
+            split_sentences = self.split_sentences
+        if feat_options is None:
+            feat_options = self.feat_options
+        if beam_size is None:
+            beam_size = self.beam_size
         # process sentences
-        s_ct = 0
-        if handle_comments:
-            comment_re = re.compile(r"^{.*} ")
-            split_re = re.compile(r"(?<!\}) ")
-            token_re = re.compile(r"(?:{[^}]*} *)?[^ ]+")
-        else:
-            split_re = re.compile(r" ")
-            token_re = re.compile(r"[^ ]+")
-        line = " ".join([w.text for w in doc])
-        wasCapOnly = 0
-        if lowerCaseCapOnly and len(line) > 10:
-            wasCapOnly = CAPONLYLINE_RE.match(line)
-        if wasCapOnly:
-            wasCapOnly = 1
-        else:
-            wasCapOnly = 0
-        if wasCapOnly:
-            line = line.lower()
-        #                LOGGER.info( "CAPONLY: "+line
-        wds = []
-        #            wds = split_re.split(line)
-        result = token_re.match(line)
-        while result:
-            wds.append(result.group())
-            line = token_re.sub("", line, 1)
-            line = line.strip(" \n")
-            result = token_re.match(line)
-        tokens = []
-        for wd in wds:
-            token = Token(string=wd, wasCap=wasCapOnly)
-            tokens.append(token)
-        tagged_tokens = self.tag_token_sequence(
-            tokens, feat_options=feat_options, beam_size=beam_size
+        words = []
+        token_seqs = []
+        for doc in docs:
+            for span in self.sentences(doc) if split_sentences else [doc]:
+                span_words, tokens = melt_tokens(
+                    span,
+                    handle_comments=handle_comments,
+                    lowerCaseCapOnly=lowerCaseCapOnly,
+                )
+                words.append(span_words)
+                token_seqs.append(tokens)
+        label_seqs = self._tag_labels(
+            token_seqs,
+            feat_options=feat_options,
+            beam_size=beam_size,
+            decoding=decoding,
         )
-        if self.print_probas:
-            tagged_sent = " ".join([tok.__pstr__() for tok in tagged_tokens])
+        for span_words, labels in zip(words, label_seqs):
+            for w, label in zip(span_words, labels):
+                w._.melt_tagger = label
+        if self.stats is not None:
+            self.stats.incr("docs_tagged", len(docs))
+            self.stats.notify()
+        return docs
+
+    def _tag_labels(self, token_seqs, feat_options, beam_size, decoding):
+        """tags of the best sequence for each of token_seqs. With a sentence
+        cache, the sequences it holds are not tagged again, and the others
+        are tagged once each"""
+        cache = self.sentence_cache
+        if cache is None:
+            tagged_seqs = self.tag_token_sequences(
+                token_seqs,
+                feat_options=feat_options,
+                beam_size=beam_size,
+                decoding=decoding,
+            )
+            return [[t.label for t in tokens] for tokens in tagged_seqs]
+        self.warmup()
+        decoding = decoding or self.decoding
+        keys = [
+            self.sentence_key(tokens, beam_size, decoding, feat_options)
+            for tokens in token_seqs
+        ]
+        label_seqs = [cache.get(key) for key in keys]
+        missed = {}
+        for key, tokens, labels in zip(keys, token_seqs, label_seqs):
+            if labels is None:
+                missed.setdefault(key, tokens)
+        if missed:
+            tagged_seqs = self.tag_token_sequences(
+                list(missed.values()),
+                feat_options=feat_options,
+                beam_size=beam_size,
+                decoding=decoding,
+            )
+            for key, tokens in zip(missed, tagged_seqs):
+                missed[key] = cache[key] = [t.label for t in tokens]
+            cache.flush()
+        return [
+            missed[key] if labels is None else labels
+            for key, labels in zip(keys, label_seqs)
+        ]
+
+    def sentence_key(
+        self, tokens, beam_size=3, decoding=None, feat_options=feat_select_options
+    ):
+        """key of the tags of tokens in the sentence cache: their strings,
+        the model, the search options and the feature selection (None for
+        the default one)"""
+        decoding = decoding or self.decoding
+        if feat_options == feat_select_options:
+            feat_options = None
         else:
-            tagged_sent = " ".join([tok.__str__() for tok in tagged_tokens])
-        for w, t in zip(doc, tagged_tokens):
-            w._.melt_tagger = t.label
-        return doc
+            feat_options = tuple(sorted(feat_options.items()))
+        return (
+            self.model_id,
+            decoding,
+            beam_size if decoding == "beam" else None,
+            self.restrict_scoring,
+            tuple([token.string for token in tokens]),
+        ) + ((feat_options,) if feat_options else ())
+
+    def warm_cache(self, words=FRENCH_FUNCTION_WORDS, feat_options=feat_select_options):
+        """compute and cache the static word features of words (by default
+        the most frequent French function words and punctuation marks)"""
+        self.warmup()
+        features = self.classifier.feature_index()
+        for word in words:
+            Instance(
+                index=0,
+                tokens=[Token(string=word)],
+                feat_selection=feat_options,
+                lex_dict=self.lex_dict,
+                tag_dict=self.tag_dict,
+                cache=self.cache,
+                features=features,
+                ambiguity=self.ambiguity_cache,
+            ).get_word_features()
+        return
+
+    def clear_cache(self):
+        self.cache.clear()
+        self.legal_cache.clear()
+        self.ambiguity_cache.clear()
+        if self.sentence_cache is not None:
+            self.sentence_cache.clear()
+        return
 
     def load_tag_dictionary(self, filepath):
+        self.warmup()
         LOGGER.info("  TAGGER: Loading tag dictionary...")
         self.tag_dict = unserialize(filepath)
+        self.model_id = data_id(
+            [self.model_id, registry.resource_key("tags", filepath)]
+        )
+        self.legal_cache.clear()
+        self.ambiguity_cache.clear()
+        if self.sentence_cache is not None:
+            self.sentence_cache.clear()
         LOGGER.info("  TAGGER: Loading tag dictionary: done")
         return
 
     def load_lexicon(self, filepath):
+        self.warmup()
         LOGGER.info("  TAGGER: Loading external lexicon...")
         self.lex_dict = unserialize(filepath)
+        self.model_id = data_id(
+            [self.model_id, registry.resource_key("lexicon", filepath)]
+        )
+        # cached suffix features depend on the lexicon
+        self.clear_cache()
         LOGGER.info("  TAGGER: Loading external lexicon: done")
         return
 
 
+class Beam:
+    """
+    N-best hypotheses of a sentence, stored as back-pointers: for each
+    position, the tag, parent hypothesis, log probability and tag
+    probability of every hypothesis kept, best one last. histories holds
+    the last tags of the current hypotheses, which is all the sequential
+    features need.
+    """
+
+    def __init__(self, length, beam_size):
+        self.beam_size = beam_size
+        self.labels = np.zeros((length, beam_size), dtype=np.intp)
+        self.parents = np.zeros((length, beam_size), dtype=np.intp)
+        self.scores = np.zeros((length, beam_size))
+        self.probas = np.zeros((length, beam_size))
+        # class distributions of the hypotheses extended at each position,
+        # and their classes (None for every class)
+        self.distribs = [None] * length
+        self.columns = [None] * length
+        self.histories = [()]
+        return
+
+    def extend(
+        self, i, parents, labels, scores, probas, distribs, columns, classes, lwin
+    ):
+        width = len(parents)
+        if width > self.labels.shape[1]:
+            self._grow(width)
+        self.parents[i, :width] = parents
+        self.labels[i, :width] = labels
+        self.scores[i, :width] = scores
+        self.probas[i, :width] = probas
+        self.distribs[i] = distribs
+        self.columns[i] = columns
+        histories = self.histories
+        self.histories = [
+            (histories[j] + (classes[c],))[-lwin:]
+            for j, c in zip(parents.tolist(), labels.tolist())
+        ]
+        return
+
+    def _grow(self, width):
+        """make room for width hypotheses per position"""
+        for name in ("labels", "parents", "scores", "probas"):
+            array = getattr(self, name)
+            grown = np.zeros((array.shape[0], width), dtype=array.dtype)
+            grown[:, : array.shape[1]] = array
+            setattr(self, name, grown)
+        return
+
+    def best_sequence(self, tokens, classes):
+        """tagged copies of tokens along the best hypothesis"""
+        sequence = []
+        h = len(self.histories) - 1
+        for i in range(len(tokens) - 1, -1, -1):
+            token = tokens[i]
+            parent = self.parents[i, h]
+            columns = self.columns[i]
+            names = classes if columns is None else [classes[c] for c in columns]
+            sequence.append(
+                Token(
+                    string=token.string,
+                    pos=token.pos,
+                    comment=token.comment,
+                    wasCap=token.wasCap,
+                    label=classes[self.labels[i, h]],
+                    proba=float(self.probas[i, h]),
+                    label_pr_distrib=list(
+                        zip(names, self.distribs[i][parent].tolist())
+                    ),
+                )
+            )
+            h = parent
+        sequence.reverse()
+        return sequence
+
+
 ############################ my_token.py ############################
 
 
@@ -350,18 +1024,156 @@ class Token:
 ############################ classifier.py ############################
 
 
+# templates whose features carry a value after the key: name=key=value
+VALUED_TEMPLATE_RE = re.compile(r"^(suff\d+|(lex|tdict)(-uc)?-u)$")
+
+
+class FeatureIndex:
+    """
+    Weight rows of the model features, by template: features are looked up
+    from their template name, key (and value) without building their
+    "name=key=value" string. Boolean keys and integer values are indexed
+    under their Python value as well as their string.
+    """
+
+    def __init__(self, feature2int):
+        self.templates = {}
+        for feature, fint in feature2int.items():
+            name, sep, rest = feature.partition("=")
+            if not sep:
+                continue
+            table = self.templates.setdefault(name, {})
+            if VALUED_TEMPLATE_RE.match(name):
+                key, sep, value = rest.rpartition("=")
+                if not sep:
+                    continue
+                table = table.setdefault(value, {})
+                if value.isdigit():
+                    self.templates[name][int(value)] = table
+                table[key] = fint
+            else:
+                table[rest] = fint
+                if rest in ("True", "False"):
+                    table[rest == "True"] = fint
+        return
+
+    def get(self, name, key, value=-1):
+        """weight row of the feature, None if the model does not know it"""
+        table = self.templates.get(name)
+        if table is None:
+            return None
+        if value != -1:
+            table = table.get(value)
+            if table is None:
+                return None
+        return table.get(key)
+
+
+class MappedFeatureIndex:
+    """
+    FeatureIndex of a memory-mapped model: its templates build the
+    "name=key=value" string of a feature and look it up in the mapped
+    feature map, so that nothing is loaded in the process.
+    """
+
+    def __init__(self, feature2int):
+        self.feature2int = feature2int
+        # Instance finds the tables with templates.get(name)
+        self.templates = self
+        self._tables = {}
+
+    def get(self, name, key=None, value=-1):
+        """table of the template name (as FeatureIndex.templates.get), or
+        the weight row of the feature if key is given"""
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = MappedTemplate(
+                self.feature2int, name + "=", VALUED_TEMPLATE_RE.match(name) is not None
+            )
+        if key is None:
+            return table
+        if value != -1:
+            table = table.get(value)
+        return table.get(key)
+
+
+class MappedTemplate:
+    """features of a template in a mapped feature map; a valued template
+    first gives the table of a value, as the dicts of FeatureIndex. The
+    rows of the last keys looked up (at most cache_size) are kept."""
+
+    __slots__ = ("feature2int", "prefix", "suffix", "values", "cache", "cache_size")
+
+    def __init__(self, feature2int, prefix, valued=False, suffix="", cache_size=1024):
+        self.feature2int = feature2int
+        self.prefix = prefix
+        self.suffix = suffix
+        # tables of the values of a valued template
+        self.values = {} if valued else None
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def get(self, key):
+        if self.values is not None:
+            table = self.values.get(key)
+            if table is None:
+                table = self.values[key] = MappedTemplate(
+                    self.feature2int, self.prefix, suffix="=%s" % key
+                )
+            return table
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        fint = self.feature2int.get("%s%s%s" % (self.prefix, key, self.suffix))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = fint
+        return fint
+
+
 class MaxEntClassifier:
     def __init__(self):
         self.classes = []
         self.feature2int = {}
         self.weights = np.zeros((0, 0))
         self.bias_weights = np.zeros((0, 0))
+        # directory of the memory-mapped model, if loaded from one
+        self.compiled_dir = None
+        self._feature_index = None
         return
 
+    def __getstate__(self):
+        if self.compiled_dir is not None:
+            # the unpickled copy maps the same files
+            return {"compiled_dir": self.compiled_dir}
+        state = self.__dict__.copy()
+        # rebuilt on demand from feature2int
+        state["_feature_index"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__init__()
+        if len(state) == 1 and "compiled_dir" in state:
+            self.load_compiled(state["compiled_dir"])
+        else:
+            self.__dict__.update(state)
+
+    def feature_index(self):
+        """FeatureIndex of the model, built on first use (a
+        MappedFeatureIndex over the feature map of a compiled model)"""
+        if self._feature_index is None:
+            if self.compiled_dir is not None:
+                self._feature_index = MappedFeatureIndex(self.feature2int)
+            else:
+                self._feature_index = FeatureIndex(self.feature2int)
+        return self._feature_index
+
     def load(self, dirpath):
         LOGGER.info("  TAGGER: Loading model from %s..." % dirpath)
         self.classes = unserialize(os.path.join(dirpath, "classes.json"))
         self.feature2int = unserialize(os.path.join(dirpath, "feature_map.json"))
+        self._feature_index = None
         self.weights = np.load(
             os.path.join(dirpath, "weights.npy"), allow_pickle=True, encoding="latin1"
         )
@@ -382,43 +1194,116 @@ class MaxEntClassifier:
         LOGGER.info("  TAGGER (TRAIN): Dumping model in %s: done." % dirpath)
         return
 
-    def categorize(self, features):
+    def dump_compiled(self, dirpath):
+        """write the model in the layout read by load_compiled: plain .npy
+        arrays and a string table for the feature map"""
+        _save_array(self.weights, os.path.join(dirpath, "weights.npy"))
+        _save_array(self.bias_weights, os.path.join(dirpath, "bias_weights.npy"))
+        write_string_table(
+            os.path.join(dirpath, "feature_map.tbl"), self.feature2int.items()
+        )
+        serialize(self.classes, os.path.join(dirpath, "classes.json"))
+        return
+
+    def load_compiled(self, dirpath):
+        """memory-map a model written by dump_compiled: processes loading the
+        same directory share the weights and the feature map"""
+        LOGGER.info("  TAGGER: Mapping model from %s..." % dirpath)
+        self.classes = unserialize(os.path.join(dirpath, "classes.json"))
+        self.feature2int = StringTable(os.path.join(dirpath, "feature_map.tbl"))
+        self._feature_index = None
+        self.weights = np.load(os.path.join(dirpath, "weights.npy"), mmap_mode="r")
+        self.bias_weights = np.load(os.path.join(dirpath, "bias_weights.npy"))
+        self.compiled_dir = dirpath
+        return
+
+    def categorize(self, features, legal=None):
         """sum over feature weights and return class that receives
-        highest overall weight
+        highest overall weight (among the class indices in legal, if given:
+        only their weights are summed)
         """
-        weights = self.bias_weights
-        for f in features:
-            fint = self.feature2int.get(f, None)
-            if not fint:
-                continue
-            fweights = self.weights[fint]
-            # summing bias and fweights
-            weights = weights + fweights
-        # find highest weight sum
-        best_weight = weights.max()
+        weights = self.scores(self.feature_indices(features), columns=legal)
+        best_cl_index = np.argmax(weights)
+        if legal is not None:
+            best_cl_index = legal[best_cl_index]
         # return class corresponding to highest weight sum
-        best_cl_index = np.nonzero(weights == best_weight)[0][0]
         return self.classes[best_cl_index]
 
+    def feature_indices(self, features):
+        """map a feature list to the array of weight rows it activates
+        (features unknown to the model are dropped); a list of weight rows,
+        as built with the FeatureIndex, is returned as an array"""
+        if features and not isinstance(features[0], str):
+            return np.asarray(features, dtype=np.intp)
+        get = self.feature2int.get
+        return np.fromiter(
+            (fint for fint in map(get, features) if fint is not None), dtype=np.intp
+        )
+
+    def _rows(self, indices, columns=None):
+        """weight rows in indices, restricted to columns if given"""
+        if columns is None:
+            return self.weights[indices]
+        return self.weights[np.ix_(indices, columns)]
+
+    def _bias(self, columns=None):
+        if columns is None:
+            return self.bias_weights
+        return self.bias_weights[np.asarray(columns, dtype=np.intp)]
+
+    def scores(self, indices, columns=None):
+        """bias plus the sum of the weight rows in indices; rows are
+        gathered in one call and summed in feature order. With columns,
+        only the scores of these classes are computed"""
+        bias = self._bias(columns)
+        rows = np.empty((len(indices) + 1, len(bias)))
+        rows[0] = bias
+        rows[1:] = self._rows(indices, columns)
+        return rows.sum(axis=0)
+
+    def batch_scores(self, batch_indices, columns=None):
+        """scores for several index arrays at once, one row per array"""
+        bias = self._bias(columns)
+        n_rows = max([len(indices) for indices in batch_indices], default=0) + 1
+        # padding rows are zeros, so the sum along axis 1 stays in feature
+        # order for every vector
+        rows = np.zeros((len(batch_indices), n_rows, len(bias)))
+        rows[:, 0] = bias
+        lengths = np.fromiter(map(len, batch_indices), dtype=np.intp)
+        if lengths.sum():
+            vec_ids = np.repeat(np.arange(len(batch_indices)), lengths)
+            positions = np.arange(len(vec_ids)) - np.repeat(
+                np.cumsum(lengths) - lengths, lengths
+            )
+            rows[vec_ids, positions + 1] = self._rows(
+                np.concatenate(batch_indices), columns
+            )
+        return rows.sum(axis=1)
+
+    @staticmethod
+    def softmax(scores):
+        """numerically stable softmax over the last axis"""
+        scores = np.exp(scores - scores.max(axis=-1, keepdims=True))
+        return scores / scores.sum(axis=-1, keepdims=True)
+
     def class_distribution(self, features):
         """probability distribution over the different classes"""
-        # print >> sys.stderr, "event: %s" % features
-        weights = self.bias_weights
-        for f in features:
-            fint = self.feature2int.get(f, None)
-            if fint is None:
-                continue
-            fweights = self.weights[fint]
-            # summing bias and fweights
-            weights = weights + fweights
-        # exponentiation of weight sum
-        scores = list(map(math.exp, list(weights)))
-        # compute normalization constant Z
-        z = sum(scores)
-        # compute probabilities
-        probs = [s / z for s in scores]
+        probs = self.softmax(self.scores(self.feature_indices(features)))
         # return class/prob map
-        return list(zip(self.classes, probs))
+        return list(zip(self.classes, probs.tolist()))
+
+    def class_distributions(self, feature_vectors, columns=None):
+        """probability distributions for a batch of feature vectors (e.g.
+        every beam hypothesis of a token), as an array with one row per
+        vector and one column per class (per class in columns, if given:
+        the distributions are then normalized over these classes)"""
+        batch_indices = [self.feature_indices(fv) for fv in feature_vectors]
+        return self.softmax(self.batch_scores(batch_indices, columns))
+
+    def index_distributions(self, batch_indices, columns=None):
+        """class_distributions for vectors of weight rows, as built by an
+        Instance given the model FeatureIndex"""
+        return self.softmax(self.batch_scores(batch_indices, columns))
 
 
 ############################ instance.py ############################
@@ -433,10 +1318,16 @@ class Instance:
         lex_dict={},
         tag_dict={},
         feat_selection={},
-        cache={},
+        cache=None,
+        features=None,
+        ambiguity=None,
     ):
         self.label = label
+        # feature strings, or weight rows when given the FeatureIndex of
+        # the model (features it does not know are then left out)
         self.fv = []
+        self.features = features
+        self.templates = features.templates if features is not None else None
         self.feat_selection = feat_selection
         # token
         self.token = tokens[index]
@@ -445,7 +1336,10 @@ class Instance:
         # lexicons
         self.lex_dict = lex_dict
         self.tag_dict = tag_dict
-        self.cache = cache  # TODO
+        # word features and ambiguity classes caches, shared by the
+        # instances of a tagger
+        self.cache = cache
+        self.ambiguity = ambiguity
         # contexts
         win = feat_selection.get("win", 2)
         pwin = feat_selection.get("pwin", 2)
@@ -468,31 +1362,49 @@ class Instance:
             self.right_wds += ["</s>"]
         self.lex_left_tags = {}
         self.lex_right_tags = {}
-        if self.lex_dict:
-            self.lex_left_tags = [
-                "|".join(list(self.lex_dict.get(tok.string, {"unk": 1}).keys()))
-                for tok in lconx
-                if tok is not None
+        if self.lex_dict or self.tag_dict:
+            left = [
+                self.ambiguity_classes(tok.string) for tok in lconx if tok is not None
             ]
-            self.lex_right_tags = [
-                "|".join(list(self.lex_dict.get(tok.string, {"unk": 1}).keys()))
-                for tok in rconx
-                if tok is not None
+            right = [
+                self.ambiguity_classes(tok.string) for tok in rconx if tok is not None
             ]
+        if self.lex_dict:
+            self.lex_left_tags = [lex for lex, _ in left]
+            self.lex_right_tags = [lex for lex, _ in right]
         if self.tag_dict:
-            self.train_left_tags = [
-                "|".join(list(self.tag_dict.get(tok.string, {"unk": 1}).keys()))
-                for tok in lconx
-                if tok is not None
-            ]
-            self.train_right_tags = [
-                "|".join(list(self.tag_dict.get(tok.string, {"unk": 1}).keys()))
-                for tok in rconx
-                if tok is not None
-            ]
+            self.train_left_tags = [train for _, train in left]
+            self.train_right_tags = [train for _, train in right]
         return
 
+    def ambiguity_classes(self, word):
+        """ambiguity classes of word in lex_dict and tag_dict: its tags
+        joined by "|" ("unk" if it is unknown, None without the lexicon).
+        They are memoized in the ambiguity cache shared by the instances of
+        a tagger"""
+        cache = self.ambiguity
+        if cache is not None:
+            classes = cache.get(word)
+            if classes is not None:
+                return classes
+        classes = (
+            "|".join(self.lex_dict.get(word, {"unk": 1})) if self.lex_dict else None,
+            "|".join(self.tag_dict.get(word, {"unk": 1})) if self.tag_dict else None,
+        )
+        if cache is not None:
+            cache[word] = classes
+        return classes
+
     def add(self, name, key, value=-1):
+        if self.templates is not None:
+            # FeatureIndex.get, inlined
+            table = self.templates.get(name)
+            if table is not None and value != -1:
+                table = table.get(value)
+            fint = table.get(key) if table is not None else None
+            if fint is not None:
+                self.fv.append(fint)
+            return fint
         if value == -1:
             f = "%s=%s" % (name, key)
         else:
@@ -559,6 +1471,18 @@ class Instance:
         sln = self.feat_selection.get("sln", 4)  # 5
         word = self.word
         index = self.index
+        # word string-based features (the lexicon based suffix confidence
+        # class included) only depend on the word: use the cache
+        signature = (pln, sln, self.features is None)
+        cached = self.cache.get(word) if self.cache is not None else None
+        if cached is not None and cached[0] == signature:
+            # if wd has been seen, use cache
+            _, head, uc, auc = cached
+            self.add_cached_feats(head)
+            self.add("niuc", uc and index > 0)
+            if auc is not None:
+                self.fv.append(auc)
+            return
         dico = self.lex_dict
         lex_tags = dico.get(word, {})
         # selecting the suffix confidence class for the word
@@ -571,31 +1495,30 @@ class Instance:
                 if v == "0":
                     val = 0
                     break
-        # word string-based features
-        if word in self.cache:
-            # if wd has been seen, use cache
-            self.add_cached_features(self.cache[word])
-        else:
-            # word string
-            self.add("wd", word)
-            # suffix/prefix
-            wd_ln = len(word)
-            if pln > 0:
-                for i in range(1, pln + 1):
-                    if wd_ln >= i:
-                        self.add("pref%i" % i, word[:i])
-            if sln > 0:
-                for i in range(1, sln + 1):
-                    if wd_ln >= i:
-                        self.add("suff%i" % i, word[-i:], val)
+        start = len(self.fv)
+        # word string
+        self.add("wd", word)
+        # suffix/prefix
+        wd_ln = len(word)
+        if pln > 0:
+            for i in range(1, pln + 1):
+                if wd_ln >= i:
+                    self.add("pref%i" % i, word[:i])
+        if sln > 0:
+            for i in range(1, sln + 1):
+                if wd_ln >= i:
+                    self.add("suff%i" % i, word[-i:], val)
         # regex-based features
         self.add("nb", number.search(word) is not None)
         self.add("hyph", hyphen.search(word) is not None)
         #        self.add( 'eq', equals.search(word) != None )
-        uc = upper.search(word)
-        self.add("uc", uc is not None)
-        self.add("niuc", uc is not None and index > 0)
-        self.add("auc", allcaps.match(word) is not None)
+        uc = upper.search(word) is not None
+        self.add("uc", uc)
+        head = tuple(self.fv[start:])
+        self.add("niuc", uc and index > 0)
+        auc = self.add("auc", allcaps.match(word) is not None)
+        if self.cache is not None:
+            self.cache[word] = (signature, head, uc, auc)
         return
 
     def get_conx_features(self):
@@ -781,6 +1704,150 @@ def word_list(file_path, t=5):
     return filtered_wd_list
 
 
+def melt_tokens(span, handle_comments=False, lowerCaseCapOnly=False):
+    """build the tagger tokens straight from the spaCy tokens of span, in a
+    single pass; returns the spaCy tokens that get a tag along with their
+    tagger tokens. Whitespace tokens are not tagged. With handle_comments,
+    a {...} comment is attached to the word following it."""
+    words = []
+    comments = []
+    pending = []
+    comment = None
+    for w in span:
+        if w.is_space:
+            continue
+        text = w.text
+        if handle_comments and (pending or text.startswith("{")):
+            pending.append(w)
+            if text.endswith("}"):
+                comment = "".join([p.text_with_ws for p in pending]).strip() + " "
+                pending = []
+            continue
+        words.append(w)
+        comments.append(comment)
+        comment = None
+    # an unclosed brace does not open a comment
+    for w in pending:
+        words.append(w)
+        comments.append(None)
+    texts = [w.text for w in words]
+    wasCapOnly = 0
+    if lowerCaseCapOnly:
+        line = " ".join(texts)
+        if len(line) > 10 and CAPONLYLINE_RE.match(line):
+            wasCapOnly = 1
+            texts = [text.lower() for text in texts]
+    tokens = [
+        Token(string=text, wasCap=wasCapOnly, comment=comment)
+        for text, comment in zip(texts, comments)
+    ]
+    return words, tokens
+
+
+def sentence_spans(doc):
+    """cheap sentence segmentation for docs without sentence boundaries:
+    a sentence ends after a run of final punctuation marks (and closing
+    quotes/brackets), or after a whitespace token holding a line break"""
+    start = i = 0
+    n = len(doc)
+    while i < n:
+        tok = doc[i]
+        if tok.text in SENT_END_PUNCT:
+            end = i + 1
+            while end < n and (
+                doc[end].text in SENT_END_PUNCT or doc[end].text in SENT_CLOSING_PUNCT
+            ):
+                end += 1
+        elif tok.is_space and "\n" in tok.text:
+            end = i + 1
+        else:
+            i += 1
+            continue
+        # trailing whitespace stays with the sentence it follows
+        while end < n and doc[end].is_space:
+            end += 1
+        yield doc[start:end]
+        start = i = end
+    if start < n:
+        yield doc[start:n]
+
+
+def serialize(datastruct, filepath, encoding="utf-8"):
+    """write datastruct as JSON to filepath, atomically"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)))
+    with io.open(fd, "w", encoding=encoding) as _file:
+        _file.write(dumps(datastruct, ensure_ascii=False))
+    os.replace(tmp_path, filepath)
+    return
+
+
+def _save_array(array, filepath):
+    """np.save array (without pickling) to filepath, atomically"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)))
+    with io.open(fd, "wb") as _file:
+        np.save(_file, np.ascontiguousarray(array), allow_pickle=False)
+    os.replace(tmp_path, filepath)
+    return
+
+
+def compile_model(
+    model_dir_path, compiled_dir=None, lexicon_file_path=None, tag_file_path=None
+):
+    """write a memory-mappable copy of the MElt model found in
+    model_dir_path (weights, feature map, lexicon and tag dictionary) to
+    compiled_dir, <model_dir_path>/compiled by default"""
+    compiled_dir = compiled_dir or os.path.join(model_dir_path, COMPILED_DIR)
+    lexicon_file_path = lexicon_file_path or os.path.join(
+        model_dir_path, "lexicon.json"
+    )
+    tag_file_path = tag_file_path or os.path.join(model_dir_path, "tag_dict.json")
+    LOGGER.info("  TAGGER: Compiling model to %s..." % compiled_dir)
+    # read everything first: a missing model leaves nothing behind
+    tables = [
+        (unserialize(lexicon_file_path), "lexicon.tbl"),
+        (unserialize(tag_file_path), "tag_dict.tbl"),
+    ]
+    classifier = MaxEntClassifier()
+    classifier.load(model_dir_path)
+    # the model is written to a temporary directory, renamed once complete
+    parent = os.path.dirname(os.path.abspath(compiled_dir))
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix="." + os.path.basename(compiled_dir))
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_dir, 0o777 & ~umask)
+    try:
+        for table, name in tables:
+            write_string_table(os.path.join(tmp_dir, name), table.items(), kind="json")
+        classifier.dump_compiled(tmp_dir)
+        if os.path.exists(compiled_dir):
+            # an outdated copy: processes mapping it keep their files
+            old_dir = tempfile.mkdtemp(dir=parent, prefix=".old-")
+            os.rename(compiled_dir, os.path.join(old_dir, "compiled"))
+            os.rename(tmp_dir, compiled_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.rename(tmp_dir, compiled_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    LOGGER.info("  TAGGER: Compiling model to %s: done" % compiled_dir)
+    return compiled_dir
+
+
+def is_compiled(compiled_dir, model_dir_path=None):
+    """whether compiled_dir holds a complete compiled model, at least as
+    recent as the model files of model_dir_path"""
+    marker = os.path.join(compiled_dir, "classes.json")
+    if not os.path.exists(marker):
+        return False
+    if model_dir_path is not None:
+        compiled_mtime = os.path.getmtime(marker)
+        for name in MODEL_FILES:
+            filepath = os.path.join(model_dir_path, name)
+            if os.path.exists(filepath) and os.path.getmtime(filepath) > compiled_mtime:
+                return False
+    return True
+
+
 def unserialize(filepath, encoding="utf-8"):
     _file = codecs.open(filepath, "r", encoding=encoding)
     datastruct = loads(_file.read())
@@ -0,0 +1,82 @@
+# coding: utf8
+"""
+Process-wide registry of the data loaded by the components, so that
+several pipelines (or several components) built on the same files share a
+single read-only copy of it.
+
+Entries are keyed by the resolved paths and modification times of the
+files they were loaded from, and reference counted: every acquire() must
+be paired with a release(), and an entry is dropped once nothing holds it
+any more. unload() drops entries regardless of their count.
+"""
+
+import os
+import weakref
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+_LOCK = threading.RLock()
+_ENTRIES = {}
+
+
+def resource_key(kind, *paths):
+    """key of the data of type kind loaded from paths"""
+    key = [kind]
+    for path in paths:
+        path = os.path.realpath(path)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        key.append((path, mtime))
+    return tuple(key)
+
+
+def acquire(key, loader):
+    """shared value for key, calling loader() to load it if no one holds
+    it yet"""
+    with _LOCK:
+        entry = _ENTRIES.get(key)
+        if entry is None:
+            LOGGER.info("Loading %s..." % (key[0],))
+            entry = _ENTRIES[key] = [loader(), 0]
+        else:
+            LOGGER.info("Reusing loaded %s" % (key[0],))
+        entry[1] += 1
+        return entry[0]
+
+
+def release(key, value):
+    """release one reference to the value acquired for key, dropping it
+    when it was the last one"""
+    with _LOCK:
+        entry = _ENTRIES.get(key)
+        if entry is None or entry[0] is not value:
+            # unloaded (and maybe loaded again) in the meantime
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _ENTRIES[key]
+
+
+def hold(owner, key, loader):
+    """acquire the value of key on behalf of owner; the reference is
+    released when owner is garbage collected, or earlier by calling the
+    returned finalizer"""
+    value = acquire(key, loader)
+    return value, weakref.finalize(owner, release, key, value)
+
+
+def unload(key=None):
+    """drop key (every entry if key is None) from the registry; components
+    still holding the value keep it until they are released"""
+    with _LOCK:
+        if key is None:
+            _ENTRIES.clear()
+        else:
+            _ENTRIES.pop(key, None)
+
+
+def loaded():
+    """reference count of each entry of the registry"""
+    with _LOCK:
+        return {key: entry[1] for key, entry in _ENTRIES.items()}
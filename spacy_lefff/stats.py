@@ -0,0 +1,101 @@
+# coding: utf8
+"""
+Counters and timing histograms filled by the components when they are given
+a Stats object, to be exported to a metrics system. Components without one
+skip all the bookkeeping.
+"""
+
+import math
+from collections import defaultdict
+
+# upper bounds of the histogram buckets, in seconds: 1us to ~1000s
+BUCKET_BOUNDS = [1e-6 * 2**k for k in range(31)]
+
+
+class Histogram(object):
+    """Distribution of observed durations (in seconds), kept as counts in
+    power-of-two buckets along with their count, sum, min and max."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= BUCKET_BOUNDS[0]:
+            b = 0
+        else:
+            b = min(len(BUCKET_BOUNDS), int(math.ceil(math.log2(value / 1e-6))))
+        self.buckets[b] += 1
+
+    def percentile(self, q):
+        """upper bound of the bucket holding the q quantile (0 <= q <= 1)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for b, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return BUCKET_BOUNDS[b] if b < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+        }
+
+
+class Stats(object):
+    """
+    Counters and histograms of a component. callback, if given, is called
+    with snapshot() after each batch the component processes. Caches
+    registered with watch_cache() report their hit rate in the snapshot.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.caches = {}
+
+    def incr(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, seconds):
+        self.histograms[name].observe(seconds)
+
+    def watch_cache(self, name, cache):
+        self.caches[name] = cache
+
+    def snapshot(self):
+        return {
+            "counters": dict(self.counters),
+            "histograms": {
+                name: hist.snapshot() for name, hist in self.histograms.items()
+            },
+            "caches": {name: cache.stats() for name, cache in self.caches.items()},
+        }
+
+    def reset(self):
+        """reset the counters and histograms (not the watched caches)"""
+        self.counters.clear()
+        self.histograms.clear()
+
+    def notify(self):
+        if self.callback is not None:
+            self.callback(self.snapshot())
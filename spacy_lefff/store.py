@@ -0,0 +1,183 @@
+# coding: utf8
+"""
+Read-only string tables stored in a single file and memory-mapped, so that
+several processes mapping the same file share one copy of the data in the
+page cache instead of each building its own Python dict.
+
+A table maps unicode keys to int, str or JSON values. Keys are found
+through an open-addressing hash index (crc32, linear probing) stored in the
+file, so a lookup only touches a few pages and never loads the table.
+"""
+
+import os
+import io
+import json
+import mmap
+import struct
+import tempfile
+from array import array
+from zlib import crc32
+from collections.abc import Mapping
+
+from .cache import LRUCache
+
+MAGIC = b"LFSTBL01"
+HEADER = struct.Struct("=8s5q")
+VALUE_KINDS = {"int": 0, "str": 1, "json": 2}
+
+
+def _dump_value(value, kind):
+    if kind == "str":
+        return value.encode("utf-8")
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_string_table(path, items, kind="int"):
+    """write the (key, value) pairs of items to path as a string table;
+    kind is the type of the values: int, str or json. The file is written
+    next to path and renamed, so readers never see a partial table."""
+    keys = []
+    values = []
+    for key, value in items:
+        keys.append(key.encode("utf-8"))
+        values.append(value)
+    n = len(keys)
+    n_slots = 1
+    while n_slots < 2 * n:
+        n_slots *= 2
+    mask = n_slots - 1
+    slots = [0] * n_slots
+    for e, key in enumerate(keys):
+        h = crc32(key) & mask
+        while slots[h]:
+            h = (h + 1) & mask
+        slots[h] = e + 1
+    key_offsets = [0]
+    for key in keys:
+        key_offsets.append(key_offsets[-1] + len(key))
+    if kind == "int":
+        val_blob = b""
+        val_index = values
+    else:
+        encoded = [_dump_value(value, kind) for value in values]
+        val_blob = b"".join(encoded)
+        val_index = [0]
+        for value in encoded:
+            val_index.append(val_index[-1] + len(value))
+    key_blob = b"".join(keys)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with io.open(fd, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC, VALUE_KINDS[kind], n, n_slots, len(key_blob), len(val_blob)
+                )
+            )
+            f.write(array("q", slots).tobytes())
+            f.write(array("q", key_offsets).tobytes())
+            f.write(array("q", val_index).tobytes())
+            f.write(key_blob)
+            f.write(val_blob)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return path
+
+
+class StringTable(Mapping):
+    """
+    Memory-mapped, read-only mapping written by write_string_table.
+    Decoded JSON values are kept in a small LRU cache (cache_size entries).
+    Pickling a table only pickles its path: the unpickled copy maps the
+    same file.
+    """
+
+    def __init__(self, path, cache_size=10000):
+        self.path = path
+        self.cache_size = cache_size
+        with io.open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, kind, n, n_slots, keys_len, vals_len = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            raise ValueError("%s is not a string table" % path)
+        self._kind = kind
+        self._n = n
+        self._mask = n_slots - 1
+        view = memoryview(self._mm)
+        offset = HEADER.size
+        self._slots = view[offset : offset + 8 * n_slots].cast("q")
+        offset += 8 * n_slots
+        self._key_offsets = view[offset : offset + 8 * (n + 1)].cast("q")
+        offset += 8 * (n + 1)
+        n_vals = n if kind == VALUE_KINDS["int"] else n + 1
+        self._values = view[offset : offset + 8 * n_vals].cast("q")
+        offset += 8 * n_vals
+        self._keys_start = offset
+        self._vals_start = offset + keys_len
+        self._decoded = LRUCache(cache_size) if kind == VALUE_KINDS["json"] else None
+
+    def __reduce__(self):
+        return (self.__class__, (self.path, self.cache_size))
+
+    def _find(self, key):
+        """entry number of key, -1 if it is not in the table"""
+        kb = key.encode("utf-8")
+        mask = self._mask
+        slots = self._slots
+        offsets = self._key_offsets
+        start = self._keys_start
+        mm = self._mm
+        h = crc32(kb) & mask
+        while True:
+            e = slots[h] - 1
+            if e < 0:
+                return -1
+            if mm[start + offsets[e] : start + offsets[e + 1]] == kb:
+                return e
+            h = (h + 1) & mask
+
+    def _value(self, e):
+        if self._kind == VALUE_KINDS["int"]:
+            return self._values[e]
+        raw = self._mm[
+            self._vals_start + self._values[e] : self._vals_start + self._values[e + 1]
+        ]
+        if self._kind == VALUE_KINDS["str"]:
+            return raw.decode("utf-8")
+        return json.loads(raw)
+
+    def get(self, key, default=None):
+        if not isinstance(key, str):
+            return default
+        decoded = self._decoded
+        if decoded is not None:
+            value = decoded.get(key)
+            if value is not None:
+                return value
+        e = self._find(key)
+        if e < 0:
+            return default
+        value = self._value(e)
+        if decoded is not None:
+            decoded[key] = value
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self._find(key) >= 0
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        start = self._keys_start
+        offsets = self._key_offsets
+        for e in range(self._n):
+            yield self._mm[start + offsets[e] : start + offsets[e + 1]].decode("utf-8")
@@ -0,0 +1,373 @@
+# coding: utf-8
+"""
+Bulk tagging and lemmatization of large corpora, run as
+
+    python -m spacy_lefff tag [FILES...] [options]
+
+The input (the files one after the other, stdin without files) is read in
+batches of records, so that the memory used does not depend on its size:
+
+- text: one document per line,
+- jsonl: one JSON object per line, the document being in its --field,
+- conllu: one pre-tokenized sentence per block of token lines.
+
+The records go through POSTagger and LefffLemmatizer (after the tokenizer
+of spacy.blank("fr"), or of the spaCy pipeline given with --model), in
+worker processes with --workers, and are written in the same order to
+stdout (or --output) as text (word/TAG/lemma tokens), jsonl or conllu.
+
+Progress lines on stderr give the throughput and the byte offset of the
+input written so far: a run that stopped can go on from there with
+--offset, its output being appended to --output.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from collections import deque
+
+FORMATS = ("text", "jsonl", "conllu")
+
+
+def read_records(paths, input_format="text", offset=0):
+    """records of the input files (stdin if paths is empty), starting at
+    byte offset of their concatenation, as (end offset, record) pairs:
+    a line of text, the object of a JSON line, or the lines of a CoNLL-U
+    sentence"""
+    position = 0
+    for path in paths or ["-"]:
+        if path == "-":
+            f = sys.stdin.buffer
+            # stdin cannot seek: read up to the offset
+            while position < offset:
+                chunk = f.read(min(offset - position, 1 << 20))
+                if not chunk:
+                    break
+                position += len(chunk)
+        else:
+            size = os.path.getsize(path)
+            if position + size <= offset:
+                position += size
+                continue
+            f = io.open(path, "rb")
+            if offset > position:
+                f.seek(offset - position)
+                position = offset
+        try:
+            for end, record in _file_records(f, input_format, position):
+                position = end
+                yield end, record
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+
+
+def _file_records(f, input_format, position):
+    block = []
+    for line in f:
+        position += len(line)
+        line = line.decode("utf-8").rstrip("\r\n")
+        if input_format == "text":
+            yield position, line
+        elif input_format == "jsonl":
+            if line.strip():
+                yield position, json.loads(line)
+        elif line.strip():
+            block.append(line)
+        elif block:
+            yield position, block
+            block = []
+    if block:
+        yield position, block
+
+
+def conllu_words(lines):
+    """forms of the token lines of a CoNLL-U sentence (without multiword
+    tokens and empty nodes)"""
+    return [
+        line.split("\t")[1]
+        for line in lines
+        if not line.startswith("#") and line.split("\t")[0].isdigit()
+    ]
+
+
+class StreamTagger(object):
+    """tags batches of records with a spaCy pipeline holding the MElt
+    tagger and the Lefff lemmatizer, and formats the results"""
+
+    def __init__(
+        self,
+        input_format="text",
+        output_format="text",
+        field="text",
+        model=None,
+        tagger=True,
+        lemmatizer=True,
+        data_dir=None,
+        beam_size=3,
+        decoding="beam",
+        index="auto",
+        batch_size=256,
+    ):
+        import spacy
+        from . import factories  # registers the components
+
+        self.input_format = input_format
+        self.output_format = output_format
+        self.field = field
+        self.tagger = tagger
+        self.lemmatizer = lemmatizer
+        self.batch_size = batch_size
+        self.nlp = spacy.load(model) if model else spacy.blank("fr")
+        if tagger:
+            self.nlp.add_pipe(
+                "lefff_melt_tagger",
+                name="melt_tagger",
+                config={
+                    "data_dir": data_dir,
+                    "beam_size": beam_size,
+                    "decoding": decoding,
+                    "index": index,
+                },
+            )
+        if lemmatizer:
+            self.nlp.add_pipe(
+                "lefff_lemmatizer",
+                config={"data_dir": data_dir, "after_melt": tagger, "index": index},
+            )
+
+    def make_doc(self, record):
+        from spacy.tokens import Doc
+
+        if self.input_format == "conllu":
+            return Doc(self.nlp.vocab, words=conllu_words(record))
+        text = record if self.input_format == "text" else record[self.field]
+        return self.nlp.make_doc(text)
+
+    def __call__(self, records):
+        """formatted results of records, and their number of tokens"""
+        docs = (self.make_doc(record) for record in records)
+        for _, proc in self.nlp.pipeline:
+            if hasattr(proc, "pipe"):
+                docs = proc.pipe(docs, batch_size=self.batch_size)
+            else:
+                docs = (proc(doc) for doc in docs)
+        docs = list(docs)
+        format_doc = getattr(self, "_format_" + self.output_format)
+        lines = [format_doc(doc, record) for doc, record in zip(docs, records)]
+        return lines, sum(len(doc) for doc in docs)
+
+    def _annotations(self, token):
+        tag = token._.melt_tagger if self.tagger else None
+        lemma = token._.lefff_lemma if self.lemmatizer else None
+        return tag, lemma
+
+    def _format_text(self, doc, record):
+        items = []
+        for token in doc:
+            tag, lemma = self._annotations(token)
+            item = token.text
+            if self.tagger:
+                item += "/" + (tag or "_")
+            if self.lemmatizer:
+                item += "/" + (lemma or "_")
+            items.append(item)
+        return " ".join(items) + "\n"
+
+    def _format_jsonl(self, doc, record):
+        result = dict(record) if self.input_format == "jsonl" else {}
+        if self.input_format != "jsonl":
+            result["text"] = doc.text
+        tokens = []
+        for token in doc:
+            tag, lemma = self._annotations(token)
+            entry = {"text": token.text}
+            if token.pos_:
+                entry["pos"] = token.pos_
+            if self.tagger:
+                entry["tag"] = tag
+            if self.lemmatizer:
+                entry["lemma"] = lemma
+            tokens.append(entry)
+        result["tokens"] = tokens
+        return json.dumps(result, ensure_ascii=False) + "\n"
+
+    def _format_conllu(self, doc, record):
+        if self.input_format == "conllu":
+            # fill in the LEMMA and XPOS columns of the token lines
+            lines = []
+            tokens = iter(doc)
+            for line in record:
+                cols = line.split("\t")
+                if not line.startswith("#") and cols[0].isdigit():
+                    tag, lemma = self._annotations(next(tokens))
+                    if lemma is not None:
+                        cols[2] = lemma
+                    if tag is not None:
+                        cols[4] = tag
+                lines.append("\t".join(cols))
+            return "\n".join(lines) + "\n\n"
+        lines = ["# text = " + doc.text.replace("\n", " ")]
+        for i, token in enumerate(doc):
+            tag, lemma = self._annotations(token)
+            cols = [str(i + 1), token.text, lemma or "_", token.pos_ or "_"]
+            cols += [tag or "_", "_", "_", "_", "_"]
+            cols.append("_" if token.whitespace_ else "SpaceAfter=No")
+            lines.append("\t".join(cols))
+        return "\n".join(lines) + "\n\n"
+
+
+# tagger of the worker processes, built by _init_worker
+_worker_tagger = None
+
+
+def _init_worker(options):
+    global _worker_tagger
+    _worker_tagger = StreamTagger(**options)
+
+
+def _run_worker(records):
+    return _worker_tagger(records)
+
+
+def batches(records, batch_size):
+    """lists of batch_size (end offset, record) pairs"""
+    batch = []
+    for item in records:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tag_batches(records, options, batch_size=256, workers=0):
+    """(end offset, formatted results, number of tokens) of each batch of
+    records, in the input order. With workers, the batches are tagged in
+    that many processes, at most two batches per worker being read ahead"""
+    if workers < 1:
+        tagger = StreamTagger(**options)
+        for batch in batches(records, batch_size):
+            lines, n_tokens = tagger([record for _, record in batch])
+            yield batch[-1][0], lines, n_tokens
+        return
+    pool = multiprocessing.Pool(workers, _init_worker, (options,))
+    try:
+        pending = deque()
+        for batch in batches(records, batch_size):
+            items = [record for _, record in batch]
+            pending.append((batch[-1][0], pool.apply_async(_run_worker, (items,))))
+            if len(pending) >= 2 * workers:
+                end, result = pending.popleft()
+                yield (end,) + result.get()
+        while pending:
+            end, result = pending.popleft()
+            yield (end,) + result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class Progress(object):
+    """throughput of the run, reported to out every interval seconds (over
+    the last interval), and over the whole run at the end"""
+
+    def __init__(self, offset=0, interval=10.0, out=None):
+        self.offset = offset
+        self.interval = interval
+        self.out = out or sys.stderr
+        self.docs = self.tokens = 0
+        self.start = time.perf_counter()
+        # counts and time of the last report
+        self.last = (0, 0, self.start)
+
+    def update(self, offset, docs, tokens):
+        self.offset = offset
+        self.docs += docs
+        self.tokens += tokens
+        if self.interval and time.perf_counter() - self.last[2] >= self.interval:
+            self.report(since=self.last)
+
+    def report(self, prefix="", since=None):
+        docs, tokens, start = since or (0, 0, self.start)
+        now = time.perf_counter()
+        elapsed = max(now - start, 1e-9)
+        self.out.write(
+            "%s%d docs, %d tokens, %.0f docs/s, %.0f tok/s, offset %d\n"
+            % (
+                prefix,
+                self.docs,
+                self.tokens,
+                (self.docs - docs) / elapsed,
+                (self.tokens - tokens) / elapsed,
+                self.offset,
+            )
+        )
+        self.out.flush()
+        self.last = (self.docs, self.tokens, now)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m spacy_lefff tag", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("files", nargs="*", help="input files (stdin if none)")
+    parser.add_argument("--input_format", choices=FORMATS, default="text")
+    parser.add_argument("--output_format", choices=FORMATS, default="text")
+    parser.add_argument("--field", default="text", help="text field of jsonl")
+    parser.add_argument("--output", default=None, help="output file (stdout)")
+    parser.add_argument("--model", default=None, help="spaCy pipeline to run first")
+    parser.add_argument("--no_tagger", action="store_true")
+    parser.add_argument("--no_lemmatizer", action="store_true")
+    parser.add_argument("--data_dir", default=None)
+    parser.add_argument("--beam_size", type=int, default=3)
+    parser.add_argument("--decoding", default="beam")
+    parser.add_argument("--index", default="auto")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--offset", type=int, default=0, help="input byte offset")
+    parser.add_argument("--stats_interval", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    options = dict(
+        input_format=args.input_format,
+        output_format=args.output_format,
+        field=args.field,
+        model=args.model,
+        tagger=not args.no_tagger,
+        lemmatizer=not args.no_lemmatizer,
+        data_dir=args.data_dir,
+        beam_size=args.beam_size,
+        decoding=args.decoding,
+        index=args.index,
+        batch_size=args.batch_size,
+    )
+    if args.output:
+        # a resumed run appends to the output of the previous one
+        out = io.open(args.output, "a" if args.offset else "w", encoding="utf-8")
+    else:
+        out = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", newline="\n")
+    progress = Progress(args.offset, args.stats_interval)
+    records = read_records(args.files, args.input_format, args.offset)
+    status = "stopped: "
+    try:
+        for end, lines, n_tokens in tag_batches(
+            records, options, args.batch_size, args.workers
+        ):
+            out.writelines(lines)
+            out.flush()
+            progress.update(end, len(lines), n_tokens)
+        status = "done: "
+    finally:
+        # the offset to resume from when the run was interrupted
+        progress.report(status)
+        if args.output:
+            out.close()
+        else:
+            out.detach()
+    return 0
@@ -1,46 +1,60 @@
 import pytest
 import spacy
 import os
-from spacy.language import Language
 from spacy_lefff import POSTagger, LefffLemmatizer
 from spacy_lefff.melt_tagger import DATA_DIR, PACKAGE
-
-
-@Language.factory("french_lemmatizer")
-def create_french_lemmatizer(nlp, name):
-    return LefffLemmatizer()
-
-
-@Language.factory("french_lemmatizer_after_melt")
-def create_french_lemmatizer_with_melt(nlp, name):
-    return LefffLemmatizer(after_melt=True)
-
-
-@Language.factory("melt_tagger")
-def create_melt_tagger(nlp, name):
-    return POSTagger()
+from .toy_model import build_toy_model, build_toy_lexicon
 
 
 @pytest.fixture(scope="session")
 def nlp():
     nlp = spacy.load("fr_core_news_sm")
-    nlp.add_pipe("french_lemmatizer", after="parser")
+    nlp.add_pipe("lefff_lemmatizer", name="french_lemmatizer", after="parser")
     return nlp
 
 
 @pytest.fixture(scope="session")
 def nlp_pos():
     nlp = spacy.load("fr_core_news_sm")
-    nlp.add_pipe("melt_tagger", after="parser")
+    nlp.add_pipe("lefff_melt_tagger", name="melt_tagger", after="parser")
     return nlp
 
 
 @pytest.fixture(scope="session")
 def add_lefff_lemma_nlp(nlp_pos):
-    nlp_pos.add_pipe("french_lemmatizer_after_melt", after="melt_tagger")
+    nlp_pos.add_pipe(
+        "lefff_lemmatizer",
+        name="french_lemmatizer_after_melt",
+        after="melt_tagger",
+        config={"after_melt": True},
+    )
     return nlp_pos
 
 
 @pytest.fixture(scope="session")
 def model_dir():
     return os.path.join(DATA_DIR, PACKAGE, "models/fr")
+
+
+@pytest.fixture(scope="session")
+def toy_data_dir(tmpdir_factory):
+    """data directory holding a small stand-in MElt model and Lefff lexicon"""
+    data_dir = tmpdir_factory.mktemp("toy_data").strpath
+    build_toy_model(data_dir)
+    build_toy_lexicon(data_dir)
+    return data_dir
+
+
+@pytest.fixture(scope="session")
+def toy_tagger(toy_data_dir):
+    return POSTagger(data_dir=toy_data_dir)
+
+
+@pytest.fixture(scope="session")
+def blank_nlp():
+    return spacy.blank("fr")
+
+
+@pytest.fixture(scope="session")
+def toy_lemmatizer(toy_data_dir):
+    return LefffLemmatizer(data_dir=toy_data_dir)
@@ -0,0 +1,59 @@
+# coding: utf-8
+
+import pickle
+
+from spacy_lefff.cache import LRUCache, SentenceCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+    assert len(cache) == 2
+
+
+def test_lru_stats():
+    cache = LRUCache(maxsize=10)
+    cache["a"] = 1
+    cache.get("a")
+    cache.get("b")
+    assert cache.stats() == {
+        "size": 1,
+        "maxsize": 10,
+        "hits": 1,
+        "misses": 1,
+        "hit_rate": 0.5,
+    }
+    cache.clear()
+    assert len(cache) == 0 and cache.hits == 0 and cache.misses == 0
+
+
+def test_lru_disabled():
+    cache = LRUCache(maxsize=0)
+    cache["a"] = 1
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_sentence_cache_disk(tmpdir):
+    path = tmpdir.join("sentences.sqlite").strpath
+    cache = SentenceCache(maxsize=1, path=path)
+    cache[("m", ("Le", "chat"))] = ["DET", "NC"]
+    cache[("m", ("Bonjour",))] = ["I"]
+    cache.flush()
+    # evicted from memory, still in the file
+    assert cache.get(("m", ("Le", "chat"))) == ["DET", "NC"]
+    assert cache.get(("m", ("Au", "revoir"))) is None
+    assert cache.stats()["disk_hits"] == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+    # persisted across instances
+    copy = pickle.loads(pickle.dumps(SentenceCache(maxsize=10, path=path)))
+    assert copy.get(("m", ("Bonjour",))) == ["I"]
+    assert copy.get(("m", ("Bonjour",))) == ["I"]
+    assert copy.memory.hits == 1 and copy.disk_hits == 1
+    assert SentenceCache(maxsize=10).get(("m", ("Bonjour",))) is None
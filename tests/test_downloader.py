@@ -4,11 +4,18 @@
 import os
 import io
 import pytest
+import hashlib
 import tarfile
 import tempfile
+import threading
+import subprocess
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from mock import patch, Mock, MagicMock
 import requests
 from spacy_lefff import Downloader
+from spacy_lefff import downloader
+from spacy_lefff.downloader import DownloadError
 from spacy_lefff.melt_tagger import URL_MODEL
 
 
@@ -65,12 +72,18 @@ def test_downloader(mock_tarfile, mock_get, _tmp_dir):
     content_disposition = (
         'attachment; filename="model.tar.gz"; filename*=UTF-8' "model.tar.gz"
     )
-    model_tarfile = tarfile.open(os.path.join(_tmp_dir.strpath, "model.tar.gz"), "r:gz")
-    headers = {"content-disposition": content_disposition, "content-length": 100000}
+    model_path = os.path.join(_tmp_dir.strpath, "model.tar.gz")
+    model_tarfile = tarfile.open(model_path, "r:gz")
+    headers = {
+        "content-disposition": content_disposition,
+        "content-length": os.path.getsize(model_path),
+    }
     mock_resp = _mock_response(headers=headers)
+    with open(model_path, "rb") as f:
+        mock_resp.iter_content.return_value = [f.read()]
     mock_get.return_value = mock_resp
     mock_tarfile.open.return_value = model_tarfile
-    d = Downloader("test", download_dir=_tmp_dir.strpath, url=URL_MODEL)
+    d = Downloader("test", download_dir=_tmp_dir.strpath, url=URL_MODEL, workers=1)
     test_folder = os.path.join(_tmp_dir.strpath, "test")
     m = os.path.join(test_folder, "model")
     assert len(_tmp_dir.listdir()) == 2  # test folder, temp model tar
@@ -95,4 +108,281 @@ def test_downloader_data_already_set_up(_tmp_dir, caplog):
     """
     if not os.path.exists(os.path.join(_tmp_dir.strpath, "test")):
         os.mkdir(os.path.join(_tmp_dir.strpath, "test"))
+        _tmp_dir.join("test", "model").write("TEST")
     d = Downloader("test", download_dir=_tmp_dir.strpath, url=URL_MODEL)
+
+
+class ModelServer(BaseHTTPRequestHandler):
+    """serves the bytes of the class attribute files, with range requests;
+    fail_after cuts the next response after that many bytes"""
+
+    files = {}
+    requests = []
+    fail_after = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        type(self).requests.append((self.command, self.headers.get("Range")))
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start, end = 0, len(data) - 1
+        status = 200
+        if self.headers.get("Range"):
+            first, last = self.headers["Range"].split("=")[1].split("-")
+            start, end = int(first), int(last) if last else len(data) - 1
+            if start >= len(data):
+                self.send_error(416)
+                return
+            status = 206
+        chunk = data[start : end + 1]
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(chunk)))
+        if status == 206:
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, end, len(data))
+            )
+        self.end_headers()
+        if body:
+            if type(self).fail_after is not None:
+                chunk = chunk[: type(self).fail_after]
+                type(self).fail_after = None
+                self.wfile.write(chunk)
+                self.close_connection = True
+                return
+            self.wfile.write(chunk)
+
+
+@pytest.fixture
+def model_server(tmpdir):
+    """local HTTP stand-in serving a model archive (and its manifest)"""
+    tmpfile = tmpdir.join("weights.bin")
+    tmpfile.write_binary(os.urandom(200000))
+    archive = tmpdir.join("model.tar.gz").strpath
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(tmpfile.strpath, "models/fr/weights.bin")
+    with open(archive, "rb") as f:
+        data = f.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    ModelServer.files = {
+        "/model.tar.gz": data,
+        "/SHA256SUMS": ("%s  model.tar.gz\n" % sha256).encode("utf-8"),
+    }
+    ModelServer.requests = []
+    ModelServer.fail_after = None
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ModelServer)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    yield url, archive, sha256, tmpfile.read_binary()
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_verified(model_server, tmpdir):
+    url, _, sha256, weights = model_server
+    download_dir = tmpdir.mkdir("data").strpath
+    Downloader(
+        "tagger",
+        url=url + "/model.tar.gz",
+        download_dir=download_dir,
+        manifest=url + "/SHA256SUMS",
+    )
+    with open(os.path.join(download_dir, "tagger/models/fr/weights.bin"), "rb") as f:
+        assert f.read() == weights
+    # nothing but the installed data is left behind
+    assert os.listdir(download_dir) == ["tagger"]
+
+
+def test_download_checksum_mismatch(model_server, tmpdir):
+    url, _, sha256, _ = model_server
+    download_dir = tmpdir.mkdir("data").strpath
+    with pytest.raises(DownloadError):
+        Downloader(
+            "tagger",
+            url=url + "/model.tar.gz",
+            download_dir=download_dir,
+            sha256="0" * 64,
+        )
+    # no half installed data
+    assert not os.path.exists(os.path.join(download_dir, "tagger"))
+
+
+def test_download_resume(model_server, tmpdir, monkeypatch):
+    url, _, sha256, weights = model_server
+    monkeypatch.setattr(downloader, "CHUNK_SIZE", 4096)
+    download_dir = tmpdir.mkdir("data").strpath
+    ModelServer.fail_after = 50000
+    with pytest.raises(Exception):
+        Downloader("tagger", url=url + "/model.tar.gz", download_dir=download_dir)
+    assert not os.path.exists(os.path.join(download_dir, "tagger"))
+    ModelServer.requests = []
+    Downloader(
+        "tagger", url=url + "/model.tar.gz", download_dir=download_dir, sha256=sha256
+    )
+    # the second attempt only asked for the missing bytes
+    (resumed,) = [r for method, r in ModelServer.requests if method == "GET"]
+    assert int(resumed[len("bytes=") : -1]) >= 40000
+    with open(os.path.join(download_dir, "tagger/models/fr/weights.bin"), "rb") as f:
+        assert f.read() == weights
+
+
+def test_download_parallel(model_server, tmpdir, monkeypatch):
+    url, _, sha256, weights = model_server
+    monkeypatch.setattr(downloader, "PARALLEL_MIN_SIZE", 1)
+    download_dir = tmpdir.mkdir("data").strpath
+    Downloader(
+        "tagger",
+        url=url + "/model.tar.gz",
+        download_dir=download_dir,
+        sha256=sha256,
+        workers=3,
+    )
+    ranges = [r for method, r in ModelServer.requests if method == "GET"]
+    assert len(ranges) == 3 and all(ranges)
+    with open(os.path.join(download_dir, "tagger/models/fr/weights.bin"), "rb") as f:
+        assert f.read() == weights
+
+
+def test_install_from_archive(model_server, tmpdir, monkeypatch):
+    _, archive, sha256, weights = model_server
+    # an empty directory left by an interrupted download is not data
+    download_dir = tmpdir.mkdir("data")
+    download_dir.mkdir("tagger")
+    Downloader(
+        "tagger",
+        url=URL_MODEL,
+        download_dir=download_dir.strpath,
+        archive=archive,
+        sha256=sha256,
+    )
+    assert download_dir.join("tagger/models/fr/weights.bin").read_binary() == weights
+    # or from a mirror directory, given in the environment
+    monkeypatch.setenv("SPACY_LEFFF_MIRROR", os.path.dirname(archive))
+    Downloader("other", url=URL_MODEL, download_dir=download_dir.strpath)
+    assert download_dir.join("other/models/fr/weights.bin").read_binary() == weights
+    assert ModelServer.requests == []
+
+
+def test_shared_cache_dir(model_server, tmpdir, monkeypatch):
+    url, _, sha256, weights = model_server
+    cache_dir = tmpdir.mkdir("cache")
+    monkeypatch.setenv("SPACY_LEFFF_CACHE_DIR", cache_dir.strpath)
+    # environments starting together download and extract the model once
+    downloaders = []
+    threads = [
+        threading.Thread(
+            target=lambda: downloaders.append(
+                Downloader("tagger", url=url + "/model.tar.gz", workers=1)
+            )
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [method for method, _ in ModelServer.requests].count("GET") == 1
+    data_dir = cache_dir.join("tagger", "objects", sha256)
+    assert {d.download_dir for d in downloaders} == {data_dir.strpath}
+    assert data_dir.join("models/fr/weights.bin").read_binary() == weights
+    assert cache_dir.join("tagger", "downloads").listdir() == []
+    # the archive is found through its url, or its checksum
+    ModelServer.requests = []
+    d = Downloader("tagger", url=url + "/model.tar.gz", cache_dir=cache_dir.strpath)
+    assert d.download_dir == data_dir.strpath
+    d = Downloader("tagger", url="http://elsewhere/model.tar.gz", sha256=sha256)
+    assert d.download_dir == data_dir.strpath
+    assert ModelServer.requests == []
+
+
+def test_read_only_data_dir(model_server, tmpdir, monkeypatch):
+    _, archive, sha256, weights = model_server
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("xdg").strpath)
+    monkeypatch.setattr(downloader.os, "access", lambda path, mode: False)
+    d = Downloader(
+        "tagger", url=URL_MODEL, download_dir=tmpdir.strpath, archive=archive
+    )
+    assert (
+        d.download_dir
+        == tmpdir.join("xdg", "spacy_lefff", "tagger", "objects", sha256).strpath
+    )
+    assert not tmpdir.join("tagger").exists()
+    with open(os.path.join(d.download_dir, "models/fr/weights.bin"), "rb") as f:
+        assert f.read() == weights
+
+
+def test_extract_unsafe_links(tmpdir):
+    outside = tmpdir.mkdir("outside")
+    payload = tmpdir.join("payload")
+    payload.write("EVIL")
+    archive = tmpdir.join("evil.tar.gz").strpath
+    with tarfile.open(archive, "w:gz") as tar:
+        link = tarfile.TarInfo("models/link")
+        link.type = tarfile.SYMTYPE
+        link.linkname = outside.strpath
+        tar.addfile(link)
+        tar.add(payload.strpath, "models/link/evil.txt")
+    with pytest.raises(DownloadError):
+        downloader.extract(archive, tmpdir.join("data").strpath)
+    assert outside.listdir() == []
+    assert not tmpdir.join("data").exists()
+    # relative links out of the archive, and hard links, are rejected too
+    for linktype, linkname in (
+        (tarfile.SYMTYPE, "../../outside"),
+        (tarfile.LNKTYPE, "../payload"),
+    ):
+        with tarfile.open(archive, "w:gz") as tar:
+            link = tarfile.TarInfo("models/link")
+            link.type = linktype
+            link.linkname = linkname
+            tar.addfile(link)
+        with pytest.raises(DownloadError):
+            downloader.extract(archive, tmpdir.join("data").strpath)
+    # names merely starting with two dots are fine
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(payload.strpath, "..models")
+    downloader.extract(archive, tmpdir.join("data").strpath)
+    assert tmpdir.join("data", "..models").read() == "EVIL"
+
+
+def test_download_command_options(tmpdir):
+    # a mistyped option ends the command instead of dropping the others
+    command = [sys.executable, "-m", "spacy_lefff", "download_tagger"]
+    download_dir = tmpdir.join("dl")
+    for argv in (
+        ["-d", download_dir.strpath, "--sha256=abc", "--bogus=1"],
+        ["-d", download_dir.strpath, "--workers", "x"],
+    ):
+        result = subprocess.run(command + argv, capture_output=True)
+        assert result.returncode == 1
+        assert b"Traceback" not in result.stderr
+    assert not download_dir.exists()
+
+
+def test_file_lock_waits_on_windows(tmpdir, monkeypatch):
+    # msvcrt.locking fails while another process holds the lock
+    calls = []
+
+    def locking(fd, mode, nbytes):
+        calls.append(mode)
+        if mode == msvcrt.LK_NBLCK and len(calls) < 4:
+            raise OSError("locked")
+
+    msvcrt = Mock(LK_LOCK=1, LK_NBLCK=2, LK_UNLCK=0, locking=locking)
+    monkeypatch.setattr(downloader, "fcntl", None)
+    monkeypatch.setattr(downloader, "msvcrt", msvcrt, raising=False)
+    monkeypatch.setattr(downloader.time, "sleep", lambda interval: None)
+    with downloader.file_lock(tmpdir.join("lock").strpath):
+        assert calls == [msvcrt.LK_NBLCK] * 4
+    assert calls[-1] == msvcrt.LK_UNLCK
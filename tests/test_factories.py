@@ -0,0 +1,97 @@
+# coding: utf-8
+
+import os
+import shutil
+import pytest
+import spacy
+from mock import patch
+from spacy_lefff import POSTagger, LefffLemmatizer
+
+TEXT = "Nous avons mangé des pommes rouges. Il y a des maisons à Paris."
+
+
+def test_tagger_factory(toy_data_dir):
+    nlp = spacy.blank("fr")
+    tagger = nlp.add_pipe(
+        "lefff_melt_tagger",
+        config={
+            "data_dir": toy_data_dir,
+            "beam_size": 1,
+            "decoding": "greedy",
+            "batch_size": 8,
+            "cache_size": 10,
+            "index": "memory",
+        },
+    )
+    assert isinstance(tagger, POSTagger)
+    # loaded on first use
+    assert not tagger.loaded
+    tagger.warmup()
+    assert (tagger.beam_size, tagger.decoding, tagger.batch_size) == (1, "greedy", 8)
+    assert tagger.classifier.compiled_dir is None
+    assert tagger.cache.maxsize == 10
+    expected = POSTagger(data_dir=toy_data_dir, decoding="greedy")
+    expected = [w._.melt_tagger for w in expected(spacy.blank("fr")(TEXT))]
+    assert [w._.melt_tagger for w in nlp(TEXT)] == expected
+    assert [w._.melt_tagger for doc in nlp.pipe([TEXT] * 3) for w in doc] == (
+        expected * 3
+    )
+    with pytest.raises(ValueError):
+        spacy.blank("fr").add_pipe("lefff_melt_tagger", config={"index": "disk"})
+
+
+def test_lemmatizer_factory(toy_data_dir):
+    nlp = spacy.blank("fr")
+    nlp.add_pipe("lefff_melt_tagger", config={"data_dir": toy_data_dir})
+    lemmatizer = nlp.add_pipe(
+        "lefff_lemmatizer",
+        config={
+            "data_dir": toy_data_dir,
+            "after_melt": True,
+            "default": True,
+            "lazy": True,
+        },
+    )
+    assert isinstance(lemmatizer, LefffLemmatizer)
+    assert lemmatizer.after_melt and lemmatizer.default
+    assert not lemmatizer.loaded
+    doc = nlp("Il y a des maisons.")
+    assert [w._.lefff_lemma for w in doc][4] == "maison"
+
+
+def test_user_factories(toy_data_dir):
+    # code written for the previous versions defines its own factories
+    from spacy.language import Language
+
+    @Language.factory("melt_tagger")
+    def create_melt_tagger(nlp, name):
+        return POSTagger(data_dir=toy_data_dir)
+
+    @Language.factory("french_lemmatizer")
+    def create_french_lemmatizer(nlp, name):
+        return LefffLemmatizer(data_dir=toy_data_dir, after_melt=True)
+
+    nlp = spacy.blank("fr")
+    nlp.add_pipe("melt_tagger")
+    nlp.add_pipe("french_lemmatizer")
+    assert [w._.lefff_lemma for w in nlp("des maisons")] == ["un", "maison"]
+
+
+def test_pipeline_to_disk(toy_data_dir, tmpdir):
+    data_dir = tmpdir.join("data").strpath
+    shutil.copytree(toy_data_dir, data_dir)
+    nlp = spacy.blank("fr")
+    nlp.add_pipe("lefff_melt_tagger", config={"data_dir": data_dir})
+    nlp.add_pipe("lefff_lemmatizer", config={"data_dir": data_dir, "after_melt": True})
+    expected = [(w._.melt_tagger, w._.lefff_lemma) for w in nlp(TEXT)]
+    nlp.to_disk(tmpdir.join("pipeline").strpath)
+    # the components come from the pipeline directory: their data and the
+    # network are not needed
+    shutil.rmtree(data_dir)
+    with patch("spacy_lefff.downloader.requests") as requests:
+        nlp = spacy.load(tmpdir.join("pipeline").strpath)
+        assert nlp.get_pipe("lefff_melt_tagger").loaded
+        assert nlp.get_pipe("lefff_lemmatizer").loaded
+        assert [(w._.melt_tagger, w._.lefff_lemma) for w in nlp(TEXT)] == expected
+    assert not requests.mock_calls
+    assert not os.path.exists(data_dir)
@@ -1,8 +1,20 @@
 # coding: utf-8
 import pytest
+import pickle
 
+import os
+import sys
+import subprocess
 import spacy
-from spacy_lefff import LefffLemmatizer
+from spacy_lefff import LefffLemmatizer, lefff
+from spacy_lefff.lefff import (
+    LemmaTables,
+    MappedLemmas,
+    compile_lexicon,
+    is_compiled,
+    read_lefff,
+)
+from .toy_model import build_toy_lexicon
 
 """
 Test suite coming from spacy.
@@ -47,3 +59,166 @@ def test_lemmatizer_exception():
 def test_lemmatizer_default():
     french_lemmatizer = LefffLemmatizer(default=True)
     assert french_lemmatizer.lemmatize("Apple", "NOUN") == "apple"
+
+
+def test_lemmatizer_pipe(toy_lemmatizer, blank_nlp):
+    texts = ["une maison à Paris .", "Les abaissements de température sont gênants"]
+    docs = []
+    for text in texts:
+        doc = blank_nlp(text)
+        for token in doc:
+            token.pos_ = "NOUN" if token.i % 2 else "DET"
+        docs.append(doc)
+    expected = [[toy_lemmatizer.lemmatize(t.text, t.pos_) for t in doc] for doc in docs]
+    lemmatized = list(toy_lemmatizer.pipe(iter(docs), batch_size=1))
+    assert [[t._.lefff_lemma for t in doc] for doc in lemmatized] == expected
+    assert lemmatized[0][0]._.lefff_lemma == "un"
+    assert lemmatized[1][1]._.lefff_lemma == "abaissement"
+
+
+def test_lemmatize_many(toy_lemmatizer, toy_data_dir):
+    forms = ["Maisons", "ai", "Paris", "Paris", "xyz", "a", "maisons", "."]
+    tags = ["NOUN", "VERB", "PROPN", "NOUN", "NOUN", "v", "nc", "XYZ"]
+    from_melt = [False, False, False, False, False, True, True, False]
+    for lemmatizer in (
+        toy_lemmatizer,
+        LefffLemmatizer(data_dir=toy_data_dir, default=True),
+        LefffLemmatizer(data_dir=toy_data_dir, mmap=True),
+    ):
+        expected = [lemmatizer.lemmatize(*args) for args in zip(forms, tags, from_melt)]
+        assert lemmatizer.lemmatize_many(forms, tags, from_melt) == expected
+        assert lemmatizer.lemmatize_many(forms[:5], tags[:5]) == expected[:5]
+    assert toy_lemmatizer.lemmatize_many([], []) == []
+
+
+def test_melt_tag_tables(toy_lemmatizer, toy_data_dir):
+    words = [("il", "CLS"), ("le", "CLO"), ("a", "V"), ("acheter", "VINF")]
+    words += [("maisons", "NC"), ("Paris", "NPP"), ("!", "PONCT"), (",", "PONCT")]
+    words += [("du", "P+D"), ("que", "CS"), ("qui", "PROWH"), ("et", "CC")]
+    expected = ["cln", "cla", "avoir", "acheter", "maison", "Paris", "!", ","]
+    expected += ["du", "que", "qui", "et"]
+    for lemmatizer in (
+        toy_lemmatizer,
+        LefffLemmatizer(data_dir=toy_data_dir, mmap=True),
+    ):
+        for form, tag in words:
+            # after_melt passes lowercased tags
+            assert lemmatizer.lemmatize(form, tag, from_melt=True) == (
+                lemmatizer.lemmatize(form, tag.lower(), from_melt=True)
+            )
+        forms, tags = zip(*words)
+        assert lemmatizer.lemmatize_many(forms, tags, True) == expected
+    # one form -> lemma table per Lefff category
+    assert toy_lemmatizer.lemma_dict.tables["cln"] == {"il": "cln"}
+    assert toy_lemmatizer.lemma_dict[("il", "cln")] == "cln"
+    # the MElt tag indexes are only built up front with after_melt
+    lemmatizer = LefffLemmatizer(data_dir=toy_data_dir)
+    assert not [key for key in lemmatizer._indexes if key[1]]
+    assert lemmatizer.lemmatize("a", "v", from_melt=True) == "avoir"
+    assert list(lemmatizer._indexes)[-1] == ("v", True)
+    lemmatizer = LefffLemmatizer(data_dir=toy_data_dir, after_melt=True)
+    assert ("v", True) in lemmatizer._indexes
+    # MElt tags without a mapping have no lemmas
+    assert lemmatizer.lemmatize("et", "ET", from_melt=True) is None
+
+
+def test_unmapped_categories(tmpdir):
+    lefff_path = tmpdir.join("lexicon.mlex").strpath
+    with open(lefff_path, "w") as f:
+        f.write("chat\tnc\tchat\t\nchat\tepsilon\tchat\t\n")
+    assert dict(read_lefff(lefff_path)) == {("chat", "nc"): "chat"}
+    assert len(read_lefff(lefff_path, categories=None)) == 2
+
+
+def test_lemmatizer_mmap(toy_lemmatizer, toy_data_dir):
+    lemmatizer = LefffLemmatizer(data_dir=toy_data_dir, mmap=True)
+    lemmatizer = pickle.loads(pickle.dumps(lemmatizer))
+    for form, pos in [("maisons", "NOUN"), ("a", "VERB"), ("xyz", "NOUN")]:
+        assert lemmatizer.lemmatize(form, pos) == toy_lemmatizer.lemmatize(form, pos)
+    assert lemmatizer.lemmatize("ai", "v", from_melt=True) == "avoir"
+
+
+def test_compiled_lexicon_autodetect(tmpdir):
+    lefff_path = build_toy_lexicon(tmpdir.strpath)
+    assert isinstance(LefffLemmatizer(data_dir=tmpdir.strpath).lemma_dict, LemmaTables)
+    table_path = compile_lexicon(lefff_path)
+    assert is_compiled(table_path, lefff_path)
+    lemmatizer = LefffLemmatizer(data_dir=tmpdir.strpath)
+    assert isinstance(lemmatizer.lemma_dict, MappedLemmas)
+    assert lemmatizer.lemmatize("maisons", "NOUN") == "maison"
+    os.utime(lefff_path, (1e10, 1e10))
+    assert isinstance(LefffLemmatizer(data_dir=tmpdir.strpath).lemma_dict, LemmaTables)
+
+
+def test_compiled_lexicon_cache_dir(tmpdir):
+    data_dir = tmpdir.mkdir("data").strpath
+    build_toy_lexicon(data_dir)
+    cache_dir = tmpdir.join("cache").strpath
+    lemmatizer = LefffLemmatizer(data_dir=data_dir, cache_dir=cache_dir, mmap=True)
+    assert isinstance(lemmatizer.lemma_dict, MappedLemmas)
+    assert lemmatizer.table_path.startswith(cache_dir)
+    assert lemmatizer.lemmatize("maisons", "NOUN") == "maison"
+    assert not os.path.exists(os.path.join(data_dir, "compiled"))
+    # picked up by the next lemmatizer using the cache
+    lemmatizer = LefffLemmatizer(data_dir=data_dir, cache_dir=cache_dir)
+    assert isinstance(lemmatizer.lemma_dict, MappedLemmas)
+
+
+def test_serialization(toy_lemmatizer, toy_data_dir, tmpdir):
+    missing = tmpdir.join("missing").strpath
+    lemmatizer = LefffLemmatizer(data_dir=missing, lazy=True)
+    lemmatizer.from_bytes(toy_lemmatizer.to_bytes())
+    assert lemmatizer.loaded
+    assert lemmatizer.lemmatize("maisons", "NOUN") == "maison"
+    assert dict(lemmatizer.lemma_dict) == dict(toy_lemmatizer.lemma_dict)
+    # from a compiled lexicon too
+    mapped = LefffLemmatizer(data_dir=toy_data_dir, mmap=True, shared=False)
+    mapped.to_disk(tmpdir.join("lemmatizer").strpath)
+    lemmatizer = LefffLemmatizer(data_dir=missing, lazy=True)
+    lemmatizer.from_disk(tmpdir.join("lemmatizer").strpath)
+    assert dict(lemmatizer.lemma_dict) == dict(toy_lemmatizer.lemma_dict)
+    assert lemmatizer.lemmatize("maisons", "NOUN") == "maison"
+
+
+def test_compiled_lexicon_read_only(tmpdir, monkeypatch):
+    data_dir = tmpdir.mkdir("data").strpath
+    build_toy_lexicon(data_dir)
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("xdg").strpath)
+    monkeypatch.setattr(lefff, "is_writable", lambda path: False)
+    lemmatizer = LefffLemmatizer(data_dir=data_dir, mmap=True)
+    assert lemmatizer.table_path.startswith(tmpdir.join("xdg").strpath)
+    assert isinstance(lemmatizer.lemma_dict, MappedLemmas)
+    assert not os.path.exists(os.path.join(data_dir, "compiled"))
+
+
+def test_compile_lexicon_command(tmpdir):
+    data_dir = tmpdir.mkdir("data").strpath
+    build_toy_lexicon(data_dir)
+    cache_dir = tmpdir.join("cache").strpath
+    command = [sys.executable, "-m", "spacy_lefff", "compile_lexicon"]
+    subprocess.check_call(command + ["-d", data_dir, "--cache_dir", cache_dir])
+    # found by the lemmatizers using the same cache
+    lemmatizer = LefffLemmatizer(data_dir=data_dir, cache_dir=cache_dir)
+    assert isinstance(lemmatizer.lemma_dict, MappedLemmas)
+
+
+def test_lazy_lemmatizer(toy_data_dir):
+    lemmatizer = LefffLemmatizer(data_dir=toy_data_dir, lazy=True)
+    assert not lemmatizer.loaded
+    assert lemmatizer.lemmatize("maisons", "NOUN") == "maison"
+    assert lemmatizer.loaded
+    lemmatizer = LefffLemmatizer(data_dir=toy_data_dir, lazy=True)
+    assert lemmatizer.warmup(background=True).join() is None
+    assert lemmatizer.loaded
+
+
+def test_lemmatizer_sentence_cache(toy_data_dir, blank_nlp):
+    lemmatizer = LefffLemmatizer(data_dir=toy_data_dir, sentence_cache_size=10)
+    uncached = LefffLemmatizer(data_dir=toy_data_dir)
+    text = "Les maisons sont belles. Les maisons sont belles."
+    expected = [w._.lefff_lemma for w in uncached(blank_nlp(text))]
+    assert [w._.lefff_lemma for w in lemmatizer(blank_nlp(text))] == expected
+    assert lemmatizer.sentence_cache.hits == 1
+    docs = list(lemmatizer.pipe([blank_nlp(text)]))
+    assert [w._.lefff_lemma for w in docs[0]] == expected
+    assert lemmatizer.sentence_cache.stats()["hits"] == 3
@@ -1,10 +1,31 @@
 # coding: utf-8
 
 from spacy_lefff import POSTagger, LefffLemmatizer
-from spacy_lefff.melt_tagger import DATA_DIR, PACKAGE
+from spacy_lefff.melt_tagger import (
+    DATA_DIR,
+    PACKAGE,
+    Instance,
+    MappedFeatureIndex,
+    Token,
+    compile_model,
+    feat_select_options,
+    is_compiled,
+    melt_tokens,
+    sentence_spans,
+)
+from spacy_lefff.cache import LRUCache
+from spacy_lefff.downloader import is_set_up
+from .toy_model import build_toy_model
 import pytest
 import spacy
 import os
+import math
+import itertools
+import pickle
+import subprocess
+import sys
+import tarfile
+import numpy as np
 
 
 def test_sentence_one(add_lefff_lemma_nlp):
@@ -64,3 +85,455 @@ def test_load_tag(model_dir):
     tag = os.path.join(model_dir, "tag_dict.json")
     french_pos_tagger.load_lexicon(tag)
     assert french_pos_tagger.tag_dict == tag_dict
+
+
+def test_class_distribution(toy_tagger):
+    classifier = toy_tagger.classifier
+    features = list(classifier.feature2int)[:40] + ["unknown=feature"]
+    weights = classifier.bias_weights
+    for f in features:
+        if f in classifier.feature2int:
+            weights = weights + classifier.weights[classifier.feature2int[f]]
+    scores = [math.exp(w) for w in weights]
+    expected = [s / sum(scores) for s in scores]
+    distrib = classifier.class_distribution(features)
+    assert [cl for cl, _ in distrib] == classifier.classes
+    assert [pr for _, pr in distrib] == pytest.approx(expected, rel=1e-12)
+
+
+def test_class_distributions_batch(toy_tagger):
+    classifier = toy_tagger.classifier
+    features = list(classifier.feature2int)
+    batch = [features[:10], [], features[10:50], features[:3] + features[:3]]
+    probs = classifier.class_distributions(batch)
+    assert probs.shape == (len(batch), len(classifier.classes))
+    for fv, row in zip(batch, probs):
+        assert row.tolist() == [pr for _, pr in classifier.class_distribution(fv)]
+
+
+def test_sentence_spans(blank_nlp):
+    doc = blank_nlp("Il y a des maisons. Le chat mange !  Elle dit « Non. »\nPuis")
+    sents = [span.text for span in sentence_spans(doc)]
+    assert sents == [
+        "Il y a des maisons.",
+        "Le chat mange !  ",
+        "Elle dit « Non. »\n",
+        "Puis",
+    ]
+
+
+def test_split_sentences(toy_tagger, blank_nlp):
+    text = "Le chat mange la souris. Paris est une ville française."
+    doc = toy_tagger(blank_nlp(text), split_sentences=True)
+    tags = [w._.melt_tagger for w in doc]
+    expected = []
+    for sent in ("Le chat mange la souris.", "Paris est une ville française."):
+        expected += [w._.melt_tagger for w in toy_tagger(blank_nlp(sent))]
+    assert tags == expected
+    assert tags == ["DET", "NC", "V", "DET", "NC", "PONCT"] + [
+        "NPP",
+        "V",
+        "DET",
+        "NC",
+        "ADJ",
+        "PONCT",
+    ]
+
+
+def test_melt_tokens(blank_nlp):
+    doc = blank_nlp(" Il y  a {note} des maisons.\n")
+    words, tokens = melt_tokens(doc, handle_comments=True)
+    assert [w.text for w in words] == ["Il", "y", "a", "des", "maisons", "."]
+    assert [t.string for t in tokens] == [w.text for w in words]
+    assert tokens[3].comment == "{note} "
+    words, tokens = melt_tokens(blank_nlp("IL Y A DES MAISONS."), lowerCaseCapOnly=True)
+    assert [t.string for t in tokens] == ["il", "y", "a", "des", "maisons", "."]
+    assert all(t.wasCap for t in tokens)
+
+
+def test_tagger_whitespace_alignment(toy_tagger, blank_nlp):
+    doc = toy_tagger(blank_nlp(" Le chat  mange la souris.\n"))
+    assert [w._.melt_tagger for w in doc] == [
+        None,
+        "DET",
+        "NC",
+        None,
+        "V",
+        "DET",
+        "NC",
+        "PONCT",
+        None,
+    ]
+
+
+def test_word_features_cache(toy_data_dir, blank_nlp):
+    tagger = POSTagger(data_dir=toy_data_dir, cache_size=1000)
+    uncached = POSTagger(data_dir=toy_data_dir, cache_size=0)
+    tagger.warm_cache(["le", "la", "."])
+    assert len(tagger.cache) == 3
+    text = "Le chat mange la souris. La ville est belle."
+    for _ in range(2):
+        doc = tagger(blank_nlp(text))
+        expected = uncached(blank_nlp(text))
+        assert [w._.melt_tagger for w in doc] == [w._.melt_tagger for w in expected]
+    assert tagger.cache.hits > tagger.cache.misses
+    tagger.clear_cache()
+    assert len(tagger.cache) == 0
+
+
+def test_sentence_cache(toy_data_dir, blank_nlp, tmpdir):
+    path = tmpdir.join("sentences.sqlite").strpath
+    tagger = POSTagger(
+        data_dir=toy_data_dir,
+        split_sentences=True,
+        sentence_cache_size=100,
+        sentence_cache_path=path,
+        stats=True,
+    )
+    uncached = POSTagger(data_dir=toy_data_dir, split_sentences=True)
+    texts = ["Le chat mange la souris. Il y a des maisons.", "Le chat mange la souris."]
+    expected = [[w._.melt_tagger for w in uncached(blank_nlp(t))] for t in texts]
+    docs = list(tagger.pipe(blank_nlp(t) for t in texts))
+    assert [[w._.melt_tagger for w in doc] for doc in docs] == expected
+    # the repeated sentence was only tagged once
+    assert tagger.stats.snapshot()["counters"]["sequences_tagged"] == 2
+    assert [w._.melt_tagger for w in tagger(blank_nlp(texts[1]))] == expected[1]
+    assert tagger.stats.snapshot()["caches"]["sentences"]["hits"] == 1
+    assert tagger.stats.snapshot()["counters"]["sequences_tagged"] == 2
+    # other search options are cached apart
+    tagger(blank_nlp(texts[1]), beam_size=1)
+    assert tagger.stats.snapshot()["counters"]["sequences_tagged"] == 3
+    # and so is another feature selection, which still goes through the cache
+    feat_options = dict(feat_select_options, win=1)
+    tagger(blank_nlp(texts[1]), feat_options=feat_options)
+    tagger(blank_nlp(texts[1]), feat_options=dict(feat_options))
+    assert tagger.stats.snapshot()["counters"]["sequences_tagged"] == 4
+    # the file tier outlives the tagger
+    tagger = POSTagger(data_dir=toy_data_dir, sentence_cache_path=path, stats=True)
+    doc = tagger(blank_nlp(texts[1]))
+    assert [w._.melt_tagger for w in doc] == expected[1]
+    assert "sequences_tagged" not in tagger.stats.snapshot()["counters"]
+    assert tagger.sentence_cache.disk_hits == 1
+
+
+def test_ambiguity_classes_cache(toy_tagger):
+    tokens = [Token(string=wd, label="NC") for wd in "le chat zorglub .".split()]
+    kwargs = dict(
+        index=1,
+        tokens=tokens,
+        lex_dict=toy_tagger.lex_dict,
+        tag_dict=toy_tagger.tag_dict,
+        feat_selection=feat_select_options,
+    )
+    cache = LRUCache(100)
+    cached = Instance(ambiguity=cache, **kwargs)
+    uncached = Instance(**kwargs)
+    assert cached.lex_right_tags == uncached.lex_right_tags
+    assert cached.train_left_tags == uncached.train_left_tags
+    assert cached.lex_left_tags == ["|".join(toy_tagger.lex_dict["le"])]
+    assert cached.lex_right_tags[0] == "unk"
+    assert len(cache) == 3
+    # later instances look the classes up
+    Instance(ambiguity=cache, **dict(kwargs, index=2))
+    assert cache.hits == 2 and len(cache) == 4
+
+
+def test_interned_features(tmpdir):
+    build_toy_model(tmpdir.strpath)
+    tagger = POSTagger(data_dir=tmpdir.strpath, mmap=False)
+    classifier = tagger.classifier
+    features = classifier.feature_index()
+    words = ["Il", "y", "a", "des", "MAISONS", "anti-gel", "12", "inconnu", "."]
+    tokens = [Token(string=wd, label="NC") for wd in words]
+    for i in range(len(tokens)):
+        kwargs = dict(
+            index=i,
+            tokens=tokens,
+            lex_dict=tagger.lex_dict,
+            tag_dict=tagger.tag_dict,
+            feat_selection=feat_select_options,
+        )
+        strings = Instance(**kwargs)
+        strings.get_features()
+        ints = Instance(features=features, **kwargs)
+        ints.get_features()
+        # same weight rows, in the same order
+        assert ints.fv == classifier.feature_indices(strings.fv).tolist()
+        assert np.array_equal(
+            classifier.index_distributions([ints.fv]),
+            classifier.class_distributions([strings.fv]),
+        )
+    # memory-mapped models look the same rows up in their feature map
+    compile_model(os.path.join(tmpdir.strpath, PACKAGE, "models/fr"))
+    mapped = POSTagger(data_dir=tmpdir.strpath).classifier
+    assert mapped.compiled_dir is not None
+    assert isinstance(mapped.feature_index(), MappedFeatureIndex)
+    for i in range(len(tokens)):
+        kwargs = dict(
+            index=i,
+            tokens=tokens,
+            lex_dict=tagger.lex_dict,
+            tag_dict=tagger.tag_dict,
+            feat_selection=feat_select_options,
+        )
+        ints = Instance(features=features, **kwargs)
+        ints.get_features()
+        mapped_ints = Instance(features=mapped.feature_index(), **kwargs)
+        mapped_ints.get_features()
+        assert mapped_ints.fv == ints.fv
+
+
+def naive_beam_search(tagger, words, beam_size):
+    """beam search extending every hypothesis with a full copy of the
+    sequence and sorting all the candidates"""
+    tokens = [Token(string=wd) for wd in words]
+    classes = tagger.classifier.classes
+    sequences = [([], 0.0)]
+    for i, token in enumerate(tokens):
+        legal = set(tagger.tag_dict.get(token.string, {}))
+        legal |= set(tagger.lex_dict.get(token.string, {}))
+        candidates = []
+        for seq, log_pr in sequences:
+            inst = Instance(
+                index=i,
+                tokens=seq + tokens[i:],
+                lex_dict=tagger.lex_dict,
+                tag_dict=tagger.tag_dict,
+                feat_selection=feat_select_options,
+            )
+            inst.get_features()
+            for cl, pr in tagger.classifier.class_distribution(inst.fv):
+                if not legal or cl in legal:
+                    labelled = Token(string=token.string, label=cl, proba=pr)
+                    candidates.append((seq + [labelled], log_pr + math.log(pr)))
+        candidates.sort(key=lambda candidate: candidate[1])
+        sequences = candidates[-beam_size:]
+    return [(t.label, t.proba) for t in sequences[-1][0]]
+
+
+def test_beam_search(toy_tagger):
+    words = "Il y a des maisons inconnues à Paris , près de la gare .".split()
+    for beam_size in (1, 3, 5):
+        tagged = toy_tagger.tag_token_sequence(
+            [Token(string=wd) for wd in words], beam_size=beam_size
+        )
+        assert [(t.label, t.proba) for t in tagged] == naive_beam_search(
+            toy_tagger, words, beam_size
+        )
+        assert [t.string for t in tagged] == words
+        assert all(len(t.label_pr_distrib) == 29 for t in tagged)
+
+
+def sequence_log_prob(tagger, tokens, labels):
+    log_pr = 0.0
+    for i, label in enumerate(labels):
+        history = tuple(labels[max(0, i - 2) : i])
+        (fv,) = tagger._hypotheses_features(tokens, i, [history], feat_select_options)
+        distrib = dict(tagger.classifier.class_distribution(fv))
+        log_pr += math.log(distrib[label])
+    return log_pr
+
+
+def test_decodings(toy_tagger):
+    words = "Le zorglub mange la blorp .".split()
+    tokens = [Token(string=wd) for wd in words]
+    # exhaustive search over the legal tag sequences
+    classes = toy_tagger.classifier.classes
+    legal = [[classes[c] for c in toy_tagger._legal_classes(t)] for t in tokens]
+    best = max(
+        itertools.product(*legal),
+        key=lambda labels: sequence_log_prob(toy_tagger, tokens, labels),
+    )
+    viterbi = toy_tagger.tag_token_sequence(tokens, decoding="viterbi")
+    assert tuple(t.label for t in viterbi) == best
+    beam = toy_tagger.tag_token_sequence(tokens, beam_size=3)
+    assert sequence_log_prob(toy_tagger, tokens, best) >= sequence_log_prob(
+        toy_tagger, tokens, [t.label for t in beam]
+    )
+    greedy = toy_tagger.tag_token_sequence(tokens, decoding="greedy")
+    beam_1 = toy_tagger.tag_token_sequence(tokens, beam_size=1)
+    assert [t.label for t in greedy] == [t.label for t in beam_1]
+    with pytest.raises(ValueError):
+        toy_tagger.tag_token_sequence(tokens, decoding="astar")
+
+
+def test_viterbi_unknown_words(toy_tagger, blank_nlp):
+    # unknown words can take every tag: the search keeps one hypothesis
+    # per pair of last tags
+    text = "Xyzzy plugh frobnique les quuxes ."
+    tagger = POSTagger(data_dir=toy_tagger.data_dir, decoding="viterbi")
+    tags = [w._.melt_tagger for w in tagger(blank_nlp(text))]
+    assert len(tags) == 6 and all(tag in tagger.classifier.classes for tag in tags)
+    assert tags == [
+        w._.melt_tagger for w in toy_tagger(blank_nlp(text), decoding="viterbi")
+    ]
+
+
+def test_restrict_scoring(toy_tagger, blank_nlp):
+    classifier = toy_tagger.classifier
+    words = "Le chat mange la souris .".split()
+    tokens = [Token(string=wd, label="NC") for wd in words]
+    inst = Instance(
+        index=2,
+        tokens=tokens,
+        lex_dict=toy_tagger.lex_dict,
+        tag_dict=toy_tagger.tag_dict,
+        feat_selection=feat_select_options,
+    )
+    inst.get_features()
+    indices = classifier.feature_indices(inst.fv)
+    legal = toy_tagger._legal_classes(tokens[2])
+    assert 0 < len(legal) < len(classifier.classes)
+    # the weights of the legal classes are summed as with every class
+    assert classifier.scores(indices, columns=legal).tolist() == (
+        classifier.scores(indices)[list(legal)].tolist()
+    )
+    distribs = classifier.class_distributions([inst.fv], columns=legal)
+    assert distribs.shape == (1, len(legal))
+    assert abs(distribs.sum() - 1) < 1e-12
+
+    text = "Le chat mange zorglub. Il y a des maisons à Paris."
+    tagger = POSTagger(data_dir=toy_tagger.data_dir, restrict_scoring=True)
+    doc = tagger(blank_nlp(text))
+    assert all(w._.melt_tagger in classifier.classes for w in doc)
+    # greedy decoding compares weights, unchanged by the normalization
+    assert [w._.melt_tagger for w in tagger(blank_nlp(text), decoding="greedy")] == [
+        w._.melt_tagger for w in toy_tagger(blank_nlp(text), decoding="greedy")
+    ]
+    # probabilities are normalized over the legal tags of known words
+    sequence = tagger.tag_token_sequence(
+        [Token(string=wd) for wd in "Le chat mange zorglub .".split()]
+    )
+    for token in sequence:
+        labels = [label for label, _ in token.label_pr_distrib]
+        assert token.label in labels
+        assert abs(sum(pr for _, pr in token.label_pr_distrib) - 1) < 1e-9
+    assert len(sequence[3].label_pr_distrib) == len(classifier.classes)
+    assert len(sequence[1].label_pr_distrib) < len(classifier.classes)
+
+
+def test_tagger_pipe(toy_tagger, blank_nlp):
+    texts = [
+        "Le chat mange la souris.",
+        "Paris est une ville française. Il y a des maisons.",
+        "",
+        "Nous avons mangé des pommes rouges.",
+    ]
+    for split in (False, True):
+        expected = [
+            [w._.melt_tagger for w in toy_tagger(blank_nlp(t), split_sentences=split)]
+            for t in texts
+        ]
+        docs = toy_tagger.pipe(
+            (blank_nlp(t) for t in texts), batch_size=3, split_sentences=split
+        )
+        assert [[w._.melt_tagger for w in doc] for doc in docs] == expected
+
+
+def test_mmap_model(toy_tagger, toy_data_dir, blank_nlp):
+    tagger = POSTagger(data_dir=toy_data_dir, mmap=True)
+    assert tagger.classifier.compiled_dir is not None
+    assert dict(tagger.lex_dict) == toy_tagger.lex_dict
+    text = "Nous avons mangé des pommes rouges. Il y a des maisons à Paris."
+    expected = [w._.melt_tagger for w in toy_tagger(blank_nlp(text))]
+    assert [w._.melt_tagger for w in tagger(blank_nlp(text))] == expected
+    # workers unpickle a tagger that maps the same files
+    tagger = pickle.loads(pickle.dumps(tagger))
+    assert isinstance(tagger.classifier.weights, np.memmap)
+    assert [w._.melt_tagger for w in tagger(blank_nlp(text))] == expected
+
+
+def test_compiled_model_autodetect(tmpdir):
+    data_dir = tmpdir.strpath
+    model_dir = build_toy_model(data_dir)
+    assert POSTagger(data_dir=data_dir).classifier.compiled_dir is None
+    compiled_dir = compile_model(model_dir)
+    assert is_compiled(compiled_dir, model_dir)
+    tagger = POSTagger(data_dir=data_dir)
+    assert tagger.classifier.compiled_dir == compiled_dir
+    assert POSTagger(data_dir=data_dir, mmap=False).classifier.compiled_dir is None
+    # a model updated after compilation is not shadowed by the stale copy
+    os.utime(os.path.join(model_dir, "weights.npy"), (1e10, 1e10))
+    assert not is_compiled(compiled_dir, model_dir)
+    assert POSTagger(data_dir=data_dir).classifier.compiled_dir is None
+
+
+def test_compile_missing_model(tmpdir):
+    model_dir = tmpdir.join("tagger", "models", "fr")
+    with pytest.raises(IOError):
+        compile_model(model_dir.strpath)
+    # nothing is created, so the data is still not taken as installed
+    assert not tmpdir.join("tagger").exists()
+    assert not is_set_up(tmpdir.join("tagger").strpath)
+    tmpdir.join("tagger", "models", "fr", "compiled").ensure(dir=True)
+    assert not is_set_up(tmpdir.join("tagger").strpath)
+
+
+def test_shared_cache_dir(toy_tagger, toy_data_dir, blank_nlp, tmpdir, monkeypatch):
+    archive = tmpdir.join("model.tar.gz").strpath
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(os.path.join(toy_data_dir, PACKAGE, "models"), "models")
+    monkeypatch.setenv("SPACY_LEFFF_ARCHIVE", archive)
+    cache_dir = tmpdir.join("cache").strpath
+    read_only = tmpdir.mkdir("data").strpath
+    tagger = POSTagger(data_dir=read_only, cache_dir=cache_dir, mmap=True)
+    # the model and its compiled copy live in the cache, not in data_dir
+    assert tagger.model_dir_path.startswith(os.path.join(cache_dir, PACKAGE))
+    assert tagger.classifier.compiled_dir.startswith(tagger.model_dir_path)
+    assert os.listdir(read_only) == []
+    text = "Nous avons mangé des pommes rouges. Il y a des maisons à Paris."
+    expected = [w._.melt_tagger for w in toy_tagger(blank_nlp(text))]
+    assert [w._.melt_tagger for w in tagger(blank_nlp(text))] == expected
+    # other environments find it there
+    other = POSTagger(data_dir=tmpdir.mkdir("other").strpath, cache_dir=cache_dir)
+    assert other.classifier.compiled_dir == tagger.classifier.compiled_dir
+
+
+def test_serialization(toy_tagger, toy_data_dir, blank_nlp, tmpdir):
+    text = "Nous avons mangé des pommes rouges. Il y a des maisons à Paris."
+    expected = [w._.melt_tagger for w in toy_tagger(blank_nlp(text))]
+    # nothing to read nor download: the model comes from the bytes
+    missing = tmpdir.join("missing").strpath
+    tagger = POSTagger(data_dir=missing, lazy=True)
+    tagger.from_bytes(toy_tagger.to_bytes())
+    assert tagger.loaded and not os.path.exists(missing)
+    assert [w._.melt_tagger for w in tagger(blank_nlp(text))] == expected
+    # a compiled model is written out in the same layout
+    mapped = POSTagger(data_dir=toy_data_dir, mmap=True)
+    mapped.to_disk(tmpdir.join("tagger").strpath)
+    assert os.listdir(tmpdir.join("tagger").strpath) == ["model.msgpack"]
+    tagger = POSTagger(data_dir=missing, lazy=True)
+    tagger.from_disk(tmpdir.join("tagger").strpath)
+    assert tagger.tag_dict == toy_tagger.tag_dict
+    assert tagger.model_id != toy_tagger.model_id
+    assert [w._.melt_tagger for w in tagger(blank_nlp(text))] == expected
+
+
+def test_compile_model_command(toy_tagger, toy_data_dir, tmpdir):
+    archive = tmpdir.join("model.tar.gz").strpath
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(os.path.join(toy_data_dir, PACKAGE, "models"), "models")
+    env = dict(os.environ, SPACY_LEFFF_ARCHIVE=archive)
+    data_dir = tmpdir.mkdir("data").strpath
+    cache_dir = tmpdir.join("cache").strpath
+    command = [sys.executable, "-m", "spacy_lefff", "compile_model"]
+    command += ["-d", data_dir, "--cache_dir", cache_dir]
+    subprocess.check_call(command, env=env)
+    # the tagger using the cache maps the compiled model
+    tagger = POSTagger(data_dir=data_dir, cache_dir=cache_dir)
+    assert tagger.classifier.compiled_dir.startswith(cache_dir)
+    assert os.listdir(data_dir) == []
+
+
+def test_lazy_tagger(toy_tagger, toy_data_dir, blank_nlp):
+    tagger = POSTagger(data_dir=toy_data_dir, lazy=True)
+    assert not tagger.loaded and tagger.classifier is None
+    # a lazy tagger can be shipped to workers before it is loaded
+    copy = pickle.loads(pickle.dumps(tagger))
+    text = "Il y a des maisons à Paris."
+    expected = [w._.melt_tagger for w in toy_tagger(blank_nlp(text))]
+    assert [w._.melt_tagger for w in tagger(blank_nlp(text))] == expected
+    assert tagger.loaded
+    copy.warmup(background=True).join()
+    assert copy.loaded
+    assert [w._.melt_tagger for w in copy(blank_nlp(text))] == expected
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+import gc
+import pickle
+
+from spacy_lefff import POSTagger, LefffLemmatizer
+from spacy_lefff import registry
+from .toy_model import build_toy_model, build_toy_lexicon
+
+
+def test_registry_refcount():
+    loads = []
+    key = ("test", 1)
+    value = registry.acquire(key, lambda: loads.append(1) or object())
+    assert registry.acquire(key, lambda: loads.append(1) or object()) is value
+    assert len(loads) == 1
+    assert registry.loaded()[key] == 2
+    registry.release(key, value)
+    registry.release(key, value)
+    assert key not in registry.loaded()
+
+
+def test_registry_unload():
+    key = ("test", 2)
+    value = registry.acquire(key, object)
+    registry.unload(key)
+    assert key not in registry.loaded()
+    # releasing a value dropped by unload() does not touch a fresh entry
+    fresh = registry.acquire(key, object)
+    registry.release(key, value)
+    assert registry.loaded()[key] == 1
+    registry.release(key, fresh)
+
+
+def test_shared_tagger_model(tmpdir):
+    toy_data_dir = tmpdir.strpath
+    build_toy_model(toy_data_dir)
+    first = POSTagger(data_dir=toy_data_dir)
+    second = POSTagger(data_dir=toy_data_dir)
+    assert first.classifier is second.classifier
+    assert first.lex_dict is second.lex_dict
+    own = POSTagger(data_dir=toy_data_dir, shared=False)
+    assert own.classifier is not first.classifier
+    (key,) = [k for k in registry.loaded() if toy_data_dir in k[1][0]]
+    assert registry.loaded()[key] == 2
+    second.release()
+    assert registry.loaded()[key] == 1
+    # unpickled taggers do not hold a reference
+    copy = pickle.loads(pickle.dumps(first))
+    del copy
+    gc.collect()
+    assert registry.loaded()[key] == 1
+
+
+def test_shared_lemmatizer(tmpdir):
+    toy_data_dir = tmpdir.strpath
+    build_toy_lexicon(toy_data_dir)
+    first = LefffLemmatizer(data_dir=toy_data_dir)
+    second = LefffLemmatizer(data_dir=toy_data_dir)
+    assert first.lemma_dict is second.lemma_dict
+    counts = registry.loaded()
+    (key,) = [k for k in counts if k[0] == "Lefff lexicon" and toy_data_dir in k[1][0]]
+    del second
+    gc.collect()
+    assert registry.loaded()[key] == 1
+    assert LefffLemmatizer(data_dir=toy_data_dir, shared=False).lemma_dict == (
+        first.lemma_dict
+    )
@@ -0,0 +1,39 @@
+# coding: utf-8
+
+from spacy_lefff import POSTagger
+from spacy_lefff.stats import Histogram, Stats
+
+
+def test_histogram():
+    hist = Histogram()
+    assert hist.percentile(0.5) is None
+    for value in [1e-6, 3e-6, 3e-6, 1e-3]:
+        hist.observe(value)
+    snapshot = hist.snapshot()
+    assert snapshot["count"] == 4
+    assert snapshot["min"] == 1e-6 and snapshot["max"] == 1e-3
+    assert snapshot["p50"] == 4e-6
+    assert 1e-3 <= snapshot["p99"] < 2e-3
+
+
+def test_tagger_stats(toy_data_dir, blank_nlp):
+    snapshots = []
+    tagger = POSTagger(data_dir=toy_data_dir, stats=Stats(callback=snapshots.append))
+    docs = [
+        blank_nlp("Il y a des maisons à Paris."),
+        blank_nlp("Le chat mange zorglub."),
+    ]
+    list(tagger.pipe(docs, beam_size=1))
+    assert len(snapshots) == 1
+    counters = snapshots[0]["counters"]
+    assert counters["docs_tagged"] == 2
+    assert counters["tokens_tagged"] == 13
+    assert counters["candidates"] - counters["candidates_pruned"] == 13
+    assert counters["candidates_pruned"] > 0
+    for name in ("feature_extraction", "classifier_scoring", "beam_bookkeeping"):
+        assert snapshots[0]["histograms"][name]["count"] == 1
+    assert snapshots[0]["caches"]["word_features"]["misses"] > 0
+    tagger.stats.reset()
+    assert tagger.stats.snapshot()["counters"] == {}
+    # disabled by default
+    assert POSTagger(data_dir=toy_data_dir).stats is None
@@ -0,0 +1,38 @@
+# coding: utf-8
+
+import pickle
+
+from spacy_lefff.store import StringTable, write_string_table
+
+
+def test_string_table_int(tmpdir):
+    items = {"wd=le": 0, "wd=la": 1, "suff1=e=1": 2, "été": 3}
+    path = write_string_table(tmpdir.join("ints.tbl").strpath, items.items())
+    table = StringTable(path)
+    assert len(table) == 4
+    assert dict(table) == items
+    assert table["été"] == 3
+    assert "wd=les" not in table
+    assert table.get("wd=les") is None
+
+
+def test_string_table_json(tmpdir):
+    items = {"le": {"DET": 1, "CLO": "0"}, "maison": {"NC": 1}}
+    path = write_string_table(tmpdir.join("lex.tbl").strpath, items.items(), "json")
+    table = StringTable(path)
+    assert table["le"] == {"DET": 1, "CLO": "0"}
+    assert list(table["le"]) == ["DET", "CLO"]
+    assert table.get("chat", {}) == {}
+
+
+def test_string_table_pickle(tmpdir):
+    path = write_string_table(tmpdir.join("str.tbl").strpath, [("a", "b")], "str")
+    table = pickle.loads(pickle.dumps(StringTable(path)))
+    assert table.path == path
+    assert table["a"] == "b"
+
+
+def test_string_table_empty(tmpdir):
+    table = StringTable(write_string_table(tmpdir.join("empty.tbl").strpath, []))
+    assert len(table) == 0
+    assert "a" not in table
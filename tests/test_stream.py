@@ -0,0 +1,87 @@
+# coding: utf-8
+
+import io
+import json
+import pytest
+from spacy_lefff import stream
+from spacy_lefff.stream import read_records
+from .toy_model import read_tagged_sentences
+
+
+@pytest.fixture(scope="module")
+def corpus(tmpdir_factory):
+    path = tmpdir_factory.mktemp("corpus").join("corpus.txt")
+    lines = [" ".join(wd for wd, _ in sent) for sent in read_tagged_sentences()]
+    path.write_text("\n".join(lines * 2) + "\n", encoding="utf-8")
+    return path.strpath
+
+
+def run(args, tmpdir, name="out"):
+    output = tmpdir.join(name).strpath
+    assert stream.main(args + ["--output", output]) == 0
+    with io.open(output, encoding="utf-8") as f:
+        return f.read()
+
+
+def test_tag_stream(corpus, toy_data_dir, tmpdir, capsys):
+    args = [corpus, "--data_dir", toy_data_dir, "--batch_size", "4"]
+    text = run(args, tmpdir)
+    lines = text.splitlines()
+    assert lines[0].split()[:5] == [
+        "Il/CLS/cln",
+        "y/CLO/cll",
+        "a/V/avoir",
+        "des/DET/un",
+        "maisons/NC/maison",
+    ]
+    # worker processes write the same output, in the input order
+    assert run(args + ["--workers", "2"], tmpdir, "workers") == text
+    with io.open(corpus, "rb") as f:
+        size = len(f.read())
+    assert capsys.readouterr().err.splitlines()[-1].endswith("offset %d" % size)
+    # resume after the first 10 lines
+    with io.open(corpus, "rb") as f:
+        offset = sum(len(f.readline()) for _ in range(10))
+    resumed = run(args + ["--offset", str(offset)], tmpdir, "resumed")
+    assert resumed.splitlines() == lines[10:]
+
+
+def test_tag_stream_formats(toy_data_dir, tmpdir):
+    conllu = tmpdir.join("in.conllu")
+    conllu.write_text(
+        "# sent_id = 1\n"
+        "1\tIl\t_\tPRON\t_\t_\t2\tnsubj\t_\t_\n"
+        "2\ta\t_\tVERB\t_\t_\t0\troot\t_\t_\n"
+        "3-4\tdes\t_\t_\t_\t_\t_\t_\t_\t_\n"
+        "3\tdes\t_\tDET\t_\t_\t4\tdet\t_\t_\n"
+        "4\tmaisons\t_\tNOUN\t_\t_\t2\tobj\t_\t_\n",
+        encoding="utf-8",
+    )
+    args = [conllu.strpath, "--data_dir", toy_data_dir, "--input_format", "conllu"]
+    lines = run(args + ["--output_format", "conllu"], tmpdir).splitlines()
+    assert lines[0] == "# sent_id = 1"
+    assert lines[3] == "3-4\tdes\t_\t_\t_\t_\t_\t_\t_\t_"
+    assert lines[5].split("\t") == [
+        "4",
+        "maisons",
+        "maison",
+        "NOUN",
+        "NC",
+        "_",
+        "2",
+        "obj",
+        "_",
+        "_",
+    ]
+    jsonl = tmpdir.join("in.jsonl")
+    jsonl.write_text(
+        json.dumps({"id": 7, "body": "Il y a des maisons."}) + "\n\n", encoding="utf-8"
+    )
+    args = [jsonl.strpath, "--data_dir", toy_data_dir, "--input_format", "jsonl"]
+    out = run(args + ["--field", "body", "--output_format", "jsonl"], tmpdir)
+    result = json.loads(out)
+    assert result["id"] == 7
+    assert result["tokens"][4] == {"text": "maisons", "tag": "NC", "lemma": "maison"}
+    assert list(read_records([jsonl.strpath], "jsonl")) == [
+        (jsonl.size() - 1, {"id": 7, "body": "Il y a des maisons."})
+    ]
@@ -0,0 +1,205 @@
+# coding: utf-8
+"""
+Small stand-in MElt model and Lefff lexicon built from a handful of tagged
+French sentences, so the tagger and lemmatizer can be exercised offline
+without downloading the real model.
+"""
+
+import os
+import io
+import json
+
+import numpy as np
+
+from spacy_lefff.melt_tagger import Instance, Token, feat_select_options
+
+TAGGED_SENTENCES = [
+    "Il/CLS y/CLO a/V des/DET maisons/NC à/P Paris/NPP ./PONCT",
+    "Les/DET abaissements/NC de/P température/NC sont/V gênants/ADJ ./PONCT",
+    "J'/CLS ai/V une/DET maison/NC à/P Lyon/NPP ./PONCT",
+    "Apple/NPP cherche/V à/P acheter/VINF une/DET startup/NC anglaise/ADJ ./PONCT",
+    "Le/DET chat/NC mange/V la/DET souris/NC ./PONCT",
+    "Nous/CLS avons/V mangé/VPP des/DET pommes/NC rouges/ADJ ./PONCT",
+    "Elle/CLS ne/ADV veut/V pas/ADV partir/VINF ce/DET soir/NC ./PONCT",
+    "La/DET ville/NC est/V très/ADV belle/ADJ en/P été/NC ./PONCT",
+    "Qui/PROWH a/V vu/VPP le/DET film/NC ?/PONCT",
+    "Le/DET livre/NC que/PROREL je/CLS lis/V est/V long/ADJ ./PONCT",
+    "Il/CLS faut/V que/CS tu/CLS viennes/VS demain/ADV ./PONCT",
+    "Marie/NPP et/CC Paul/NPP vont/V au/P+D marché/NC ./PONCT",
+    "Il/CLS se/CLR lave/V les/DET mains/NC avant/P de/P manger/VINF ./PONCT",
+    "Les/DET enfants/NC jouent/V dans/P le/DET jardin/NC ,/PONCT puis/ADV rentrent/V ./PONCT",
+    "Je/CLS le/CLO vois/V souvent/ADV du/P+D côté/NC de/P la/DET gare/NC ./PONCT",
+    "Mangez/VIMP vos/DET légumes/NC !/PONCT",
+    "Paris/NPP est/V une/DET ville/NC française/ADJ ./PONCT",
+]
+
+CLASSES = [
+    "ADJ",
+    "ADJWH",
+    "ADV",
+    "ADVWH",
+    "CC",
+    "CLO",
+    "CLR",
+    "CLS",
+    "CS",
+    "DET",
+    "DETWH",
+    "ET",
+    "I",
+    "NC",
+    "NPP",
+    "P",
+    "P+D",
+    "P+PRO",
+    "PONCT",
+    "PREF",
+    "PRO",
+    "PROREL",
+    "PROWH",
+    "V",
+    "VIMP",
+    "VINF",
+    "VPP",
+    "VPR",
+    "VS",
+]
+
+# form, Lefff category, lemma
+LEFFF_ENTRIES = [
+    ("il", "cln", "cln"),
+    ("il", "ilimp", "il"),
+    ("y", "cll", "cll"),
+    ("a", "v", "avoir"),
+    ("a", "auxAvoir", "avoir"),
+    ("ai", "v", "avoir"),
+    ("ai", "auxAvoir", "avoir"),
+    ("des", "det", "un"),
+    ("des", "prep", "des"),
+    ("une", "det", "un"),
+    ("une", "nc", "une"),
+    ("maison", "nc", "maison"),
+    ("maisons", "nc", "maison"),
+    ("à", "prep", "à"),
+    ("paris", "np", "Paris"),
+    ("Paris", "np", "Paris"),
+    ("abaissements", "nc", "abaissement"),
+    ("température", "nc", "température"),
+    ("de", "prep", "de"),
+    ("de", "det", "un"),
+    ("sont", "v", "être"),
+    ("gênants", "adj", "gênant"),
+    ("françaises", "nc", "français"),
+    ("françaises", "adj", "français"),
+    ("anglaise", "adj", "anglais"),
+    ("anglaise", "nc", "anglaise"),
+    ("cherche", "v", "chercher"),
+    ("cherche", "nc", "cherche"),
+    ("acheter", "v", "acheter"),
+    ("le", "det", "le"),
+    ("le", "cla", "cla"),
+    ("la", "det", "le"),
+    ("la", "cla", "cla"),
+    ("les", "det", "le"),
+    ("les", "cla", "cla"),
+    ("mange", "v", "manger"),
+    ("chat", "nc", "chat"),
+    ("se", "clr", "clr"),
+    ("que", "prel", "que"),
+    ("que", "csu", "que"),
+    ("qui", "pri", "qui"),
+    ("et", "coo", "et"),
+    ("du", "prep", "du"),
+    ("du", "det", "un"),
+    ("très", "adv", "très"),
+    (".", "poncts", "."),
+    ("?", "poncts", "?"),
+    (",", "ponctw", ","),
+    ("!", "poncts", "!"),
+]
+
+
+def read_tagged_sentences():
+    """list of sentences, each a list of (word, tag) pairs"""
+    return [
+        [tuple(item.rsplit("/", 1)) for item in sent.split(" ")]
+        for sent in TAGGED_SENTENCES
+    ]
+
+
+def _tag_counts(sentences):
+    counts = {}
+    for sent in sentences:
+        for wd, tag in sent:
+            counts.setdefault(wd, {})
+            counts[wd][tag] = counts[wd].get(tag, 0) + 1
+    return counts
+
+
+def build_toy_model(data_dir, package="tagger", seed=0, sentences=None):
+    """Write a small MElt model (lexicon, tag dictionary, classes, feature
+    map and weights) under ``data_dir/package/models/fr`` and return the
+    model directory. The model is built from sentences (lists of (word,
+    tag) pairs), by default the toy sentences."""
+    model_dir = os.path.join(data_dir, package, "models", "fr")
+    os.makedirs(model_dir, exist_ok=True)
+    if sentences is None:
+        sentences = read_tagged_sentences()
+    counts = _tag_counts(sentences)
+    tag_dict = {wd: {t: 1 for t in tags} for wd, tags in counts.items()}
+    # the external lexicon only knows about a subset of the words, and flags
+    # a few entries with a "0" suffix confidence
+    lex_dict = {}
+    for i, (wd, tags) in enumerate(sorted(counts.items())):
+        if i % 3 == 2:
+            continue
+        lex_dict[wd] = {t: ("0" if i % 5 == 0 else 1) for t in tags}
+    lex_dict["DEV"] = {"NPP": 1, "NC": 1}
+    # collect the features the tagger extracts on the gold sequences
+    feature2int = {}
+    events = []
+    for sent in sentences:
+        tokens = [Token(string=wd, label=tag) for wd, tag in sent]
+        for i in range(len(tokens)):
+            inst = Instance(
+                index=i,
+                tokens=tokens,
+                label=tokens[i].label,
+                lex_dict=lex_dict,
+                tag_dict=tag_dict,
+                feat_selection=feat_select_options,
+                cache={},
+            )
+            inst.get_features()
+            for f in inst.fv:
+                if f not in feature2int:
+                    feature2int[f] = len(feature2int)
+            events.append((inst.label, inst.fv))
+    rng = np.random.RandomState(seed)
+    weights = rng.normal(scale=0.05, size=(len(feature2int), len(CLASSES)))
+    for label, fv in events:
+        cl = CLASSES.index(label)
+        for f in fv:
+            weights[feature2int[f], cl] += 0.25
+    bias_weights = rng.normal(scale=0.05, size=len(CLASSES))
+    for name, obj in (
+        ("lexicon.json", lex_dict),
+        ("tag_dict.json", tag_dict),
+        ("classes.json", CLASSES),
+        ("feature_map.json", feature2int),
+    ):
+        with io.open(os.path.join(model_dir, name), "w", encoding="utf-8") as f:
+            f.write(json.dumps(obj, ensure_ascii=False))
+    # the released model ships pickled arrays
+    weights.dump(os.path.join(model_dir, "weights.npy"))
+    bias_weights.dump(os.path.join(model_dir, "bias_weights.npy"))
+    return model_dir
+
+
+def build_toy_lexicon(data_dir, file_name="lefff-3.4.mlex"):
+    """Write a tiny .mlex file and return its path."""
+    path = os.path.join(data_dir, file_name)
+    with io.open(path, "w", encoding="utf-8") as f:
+        for form, cat, lemma in LEFFF_ENTRIES:
+            f.write("%s\t%s\t%s\t\n" % (form, cat, lemma))
+    return path